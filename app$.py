@@ -19,28 +19,66 @@ For permissions or inquiries, please contact priyankagulgari@gmail.com .
 ==================================================
 """
 import sys
-from flask import Flask, request, redirect, url_for, send_file, render_template
+import argparse
+import atexit
+import calendar
+import datetime
+from flask import Flask, request, redirect, url_for, send_file, render_template, jsonify
 import pandas as pd
 import os
-from openpyxl import load_workbook
+from openpyxl import Workbook, load_workbook
 from openpyxl.styles import Alignment, PatternFill, Border, Side, Font
 from openpyxl.utils import get_column_letter
 from openpyxl.worksheet.page import PageMargins
 from openpyxl.utils import get_column_letter
 from openpyxl.utils.dataframe import dataframe_to_rows
 import csv
+import hashlib
+import heapq
+import json
+import multiprocessing
+import pickle
+import plistlib
+import posixpath
+import random
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+import xml.etree.ElementTree as ET
+import zipfile
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+from collections import Counter, OrderedDict, defaultdict
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import webview
 from flaskwebgui import FlaskUI
 import tkinter as tk
 from tkinter import filedialog
 #import win32com.client as win32
 from openpyxl.styles import numbers
-
-
-root = tk.Tk()
-screen_width = root.winfo_screenwidth()
-screen_height = root.winfo_screenheight()
-root.destroy()
+from openpyxl.cell.cell import MergedCell
+from openpyxl.styles.cell_style import StyleArray
+from openpyxl.styles.numbers import BUILTIN_FORMATS, BUILTIN_FORMATS_MAX_SIZE
+from openpyxl.utils.cell import column_index_from_string
+from openpyxl.writer.excel import ExcelWriter
+try:
+    import psutil
+except ImportError:
+    psutil = None  # Memory use is then read from /proc where available
+
+
+def get_screen_size():
+    # Only when the window is opened, not on import, the aggregation and sheet workers import this module too
+    root = tk.Tk()
+    screen_width = root.winfo_screenwidth()
+    screen_height = root.winfo_screenheight()
+    root.destroy()
+    return screen_width, screen_height
 
 def resource_path(relative_path):
     """ Get the absolute path to the resource, works for dev and for PyInstaller """
@@ -59,31 +97,174 @@ app_display_name = "app$"  # Use this for display purposes
 #window = webview.create_window('Pharmacy Data Processing Application',app)
 UPLOAD_FOLDER = 'uploads'
 PROCESSED_FOLDER = 'processed'
+CACHE_FOLDER = 'cache'
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+app.config['CACHE_FOLDER'] = CACHE_FOLDER
+
+# Result cache settings: cached reports older than the retention are dropped,
+# and the oldest reports are evicted once the cache grows past the size limit.
+# Every cache hit renews a report, so the retention counts from its last use, not from its creation.
+app.config['RESULT_CACHE_ENABLED'] = True
+app.config['RESULT_CACHE_RETENTION_DAYS'] = 30
+app.config['RESULT_CACHE_MAX_SIZE_MB'] = 500
+
+# Columns each uploaded file must have
+BESTRX_COLUMNS = ['Drug Name', 'NDC #', 'Total Rxs', 'Quantity', 'Total']
+VENDOR_COLUMNS = ['NDC #', 'Shipped']
+CONVERSION_COLUMNS = ['DRUG NAME', 'ITEM NO', 'NDC #', 'PKG SIZE', 'PRICE']
+# Fixed insurance slots of the report form as (insurance, upload field), in report order
+INSURANCE_FILE_FIELDS = [
+    ('ALL_PBM', 'bestrx_file'),
+    ('CVS', 'cvs_bestrx_file'),
+    ('ESI', 'esi_bestrx_file'),
+    ('OPTUM', 'optum_bestrx_file'),
+    ('MEDIMP', 'medimpact_bestrx_file'),
+    ('NYM', 'nym_bestrx_file'),
+]
+
+# Vendor feeds can be Excel, CSV or X12 EDI (810 invoice / 856 ship notice), the format is
+# detected from the file content. Vendors listed here (file name without extension, lower case)
+# always use the given format: 'excel', 'csv' or 'edi'.
+app.config['VENDOR_FORMATS'] = {}
+VENDOR_EXTENSIONS = ['.xlsx', '.xls', '.csv', '.txt', '.edi', '.x12', '.810', '.856']
+# Header names of the NDC and shipped quantity in vendor CSV exports, compared in lower case
+VENDOR_COLUMN_ALIASES = {
+    'NDC #': ['ndc #', 'ndc', 'ndc number', 'ndc11', 'ndc code', 'item ndc'],
+    'Shipped': ['shipped', 'qty shipped', 'quantity shipped', 'shipped qty', 'ship qty', 'qty ship'],
+}
+# Product id qualifiers of an NDC in EDI IT1/LIN segments
+EDI_NDC_QUALIFIERS = ['N4', 'ND', 'NDC']
+
+# Slots of the members of an uploaded archive by file name, as (pattern, slot, name).
+# The pattern is matched against whole words of the lower-case file name, the first match wins.
+# Members matching none of them are assigned by their header row.
+ARCHIVE_SLOT_PATTERNS = [
+    (r'conversion|master', 'conversion', None),
+    (r'kinray', 'vendor', 'kinray'),
+    (r'cvs', 'bestrx', 'CVS'),
+    (r'esi', 'bestrx', 'ESI'),
+    (r'optum', 'bestrx', 'OPTUM'),
+    (r'medimp|medimpact', 'bestrx', 'MEDIMP'),
+    (r'nym', 'bestrx', 'NYM'),
+    (r'all_?pbm|bestrx', 'bestrx', 'ALL_PBM'),
+]
+
+# Number of worker processes for the aggregation, 1 runs it in this process.
+# The BestRx and vendor rows are split into this many shards by NDC hash.
+app.config['AGGREGATION_WORKERS'] = 1
+
+# Number of worker processes that build the helper sheets, 1 builds them one after another in this process
+app.config['SHEET_WORKERS'] = 1
+
+# zlib level of the saved report: 1 saves fastest, 9 gives the smallest file, 0 stores it uncompressed
+app.config['REPORT_COMPRESSION_LEVEL'] = 6
+
+# Number of worker processes that read and reconcile the stores of a chain rollup,
+# 1 runs the stores one after another in this process
+app.config['CHAIN_WORKERS'] = 1
+# Number of NDCs listed on the "Top Exposure" sheet of a chain rollup
+app.config['CHAIN_TOP_NDCS'] = 50
+
+# Number of NDCs in each list of the quick preview
+app.config['PREVIEW_TOP_COUNT'] = 20
+
+# Layout of the "Processed Data" sheet and the in-memory frames:
+# 'wide' has six columns per insurance, 'sparse' leaves out the insurances without any activity
+# and 'long' has one row per NDC and insurance with activity
+app.config['REPORT_LAYOUT'] = 'wide'
+REPORT_LAYOUTS = ['wide', 'sparse', 'long']
+# First data row of the "Processed Data" sheet in each layout, below the title and header rows
+PROCESSED_DATA_FIRST_ROWS = {'wide': 4, 'sparse': 4, 'long': 3}
+# Insurances kept in the sparse and long layouts even without activity, the helper sheets need them
+REQUIRED_INSURANCES = ['ALL_PBM', 'CVS']
+
+# "Changes Since Last Run" lists an NDC when its To Order (packages) or the _Diff$ of an
+# insurance changed by more than these since the previous report
+app.config['DELTA_TO_ORDER_THRESHOLD'] = 1
+app.config['DELTA_DIFF_THRESHOLD'] = 50
+
+# Limits of one report job, checked between the processing stages; 0 turns a limit off.
+# The memory a job uses is how much the resident set size of the app process grew since the job
+# started, so memory held by earlier jobs or the master in memory is not counted. Jobs running at
+# the same time each count the growth of the others too; the sheet worker processes are not counted.
+app.config['JOB_TIME_LIMIT'] = 600
+app.config['JOB_MEMORY_LIMIT_MB'] = 4096
+
+# Number of data rows checked per file by the pre-flight validation
+app.config['VALIDATION_SAMPLE_ROWS'] = 20
+
+# Lowest score (0 to 1, shown as Match % / 100) of a master row suggested for a missing item.
+# The suggestion columns of an item stay blank when no candidate reaches it.
+app.config['MASTER_SUGGESTION_MIN_SCORE'] = 0.5
+
+# Uploads parsed in the background as soon as they are chosen in the form, see /api/parse.
+# Up to PARSE_CACHE_SIZE parsed files are kept, by content.
+app.config['PARSE_WORKERS'] = 2
+app.config['PARSE_CACHE_SIZE'] = 32
+
+# Number of recent results kept in memory for the JSON API
+app.config['RESULT_STORE_SIZE'] = 5
+# Number of styled "Processed Data" skeletons kept in memory, one per insurance/vendor combination
+app.config['SHEET_TEMPLATE_CACHE_SIZE'] = 16
+# Default and maximum page size of the JSON API
+app.config['API_PAGE_SIZE'] = 500
+app.config['API_MAX_PAGE_SIZE'] = 5000
+
+# Every run's reconciliation rows are kept in this local SQLite database, a rerun of the same
+# pharmacy and date range replaces the earlier rows
+app.config['WAREHOUSE_ENABLED'] = True
+app.config['WAREHOUSE_PATH'] = 'warehouse.db'
+
+# Resident service: keeps the processing stack and the conversion master loaded between runs.
+# MASTER_PATH is preloaded at service start, used for jobs without a conversion file,
+# and checked for changes every MASTER_WATCH_INTERVAL seconds.
+app.config['SERVICE_HOST'] = '127.0.0.1'
+app.config['SERVICE_PORT'] = 5055
+app.config['MASTER_PATH'] = None
+app.config['MASTER_WATCH_INTERVAL'] = 30
+
+# Watch-folder mode: folders laid out as <folder>/<pharmacy name>/<period>/<export files>.
+# A period folder is processed once it has BestRx, vendor and conversion files (or MASTER_PATH)
+# and none of its files changed for WATCH_DEBOUNCE seconds.
+app.config['WATCH_FOLDERS'] = []
+app.config['WATCH_INTERVAL'] = 60
+app.config['WATCH_DEBOUNCE'] = 120
+app.config['WATCH_STATE_PATH'] = 'watch_state.json'
+
+# Bump this whenever the report layout changes so old cached reports are not reused
+RESULT_CACHE_VERSION = 3
 
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 if not os.path.exists(PROCESSED_FOLDER):
     os.makedirs(PROCESSED_FOLDER)
+if not os.path.exists(CACHE_FOLDER):
+    os.makedirs(CACHE_FOLDER)
     
     
+# Scripts added to the report form page: background parsing of the chosen files, and the job progress with its Cancel button
+FORM_PAGE_PARTIALS = ['eager_upload.html', 'job_progress.html']
+
 @app.route('/')
 def index():
-    return render_template('index.html')
+    page = render_template('index.html')
+    partials = ''.join(render_template(partial) for partial in FORM_PAGE_PARTIALS)
+    if '</body>' in page:
+        return page.replace('</body>', partials + '</body>', 1)
+    return page + partials
 
-@app.route('/upload', methods=['POST'])
-def upload_file():
-    
-    pharmacy_name = request.form['pharmacy_name']
-    date_range = request.form['date_range']
-    insurance_files = {
-        'ALL_PBM': request.files.get('bestrx_file'),
-        'CVS': request.files.get('cvs_bestrx_file'),
-        'ESI': request.files.get('esi_bestrx_file'),
-        'OPTUM': request.files.get('optum_bestrx_file'),
-        'MEDIMP': request.files.get('medimpact_bestrx_file'),
-        'NYM': request.files.get('nym_bestrx_file'),
-    }
+def get_insurance_files(prefix=''):
+    # Uploads of the fixed insurance slots by insurance name, the fields of a period or store form start with prefix
+    return {insurance: request.files.get(f'{prefix}{field}') for insurance, field in INSURANCE_FILE_FIELDS}
+
+def save_uploaded_files():
+    """
+    Save the files of the report form to the uploads folder.
+    Returns:
+        The insurance paths, the vendor paths (Kinray first) and the conversion path,
+        or None when a required file is missing.
+    """
+    insurance_files = get_insurance_files()
 
     # Read optional insurances
     optional_insurance_count = int(request.form['optional_insurance_count'])
@@ -99,9 +280,9 @@ def upload_file():
             print(f"{key}: {file.filename}")
 
             
-    kinray_file = request.files['kinray_file']
+    kinray_file = request.files.get('kinray_file')
     vendor_count = int(request.form['vendor_count'])                                  
-    conversion_file = request.files['conversion_file']
+    conversion_file = request.files.get('conversion_file')
                                     
     #Vendor files, dpending on user input
     vendor_files = []
@@ -113,8 +294,8 @@ def upload_file():
         if vendor_file:
             vendor_files.append((vendor_name, vendor_file))
         
-    if kinray_file.filename == '' or conversion_file.filename == '' or not any(insurance_files.values()):
-        return redirect(request.url)
+    if not kinray_file or not conversion_file or not any(insurance_files.values()):
+        return None
     
     insurance_paths = {}
     for key, file in insurance_files.items():
@@ -123,7 +304,7 @@ def upload_file():
             file.save(path)
             insurance_paths[key] = path
             
-    kinray_path = os.path.join(app.config['UPLOAD_FOLDER'], 'kinray.xlsx')
+    kinray_path = os.path.join(app.config['UPLOAD_FOLDER'], f'kinray{get_vendor_extension(kinray_file)}')
     conversion_path = os.path.join(app.config['UPLOAD_FOLDER'], 'conversion.xlsx')
     kinray_file.save(kinray_path)
     conversion_file.save(conversion_path)
@@ -133,14 +314,185 @@ def upload_file():
         #if not vendor_name.strip():  # fallback if vendor name not entered
             #vendor_name = f'vendor{i}'
         safe_name = vendor_name.replace(" ", "_") or f'vendor{i}'  # fallback if empty
-        vendor_path = os.path.join(app.config['UPLOAD_FOLDER'], f'{safe_name}.xlsx')
+        vendor_path = os.path.join(app.config['UPLOAD_FOLDER'], f'{safe_name}{get_vendor_extension(vendor_file)}')
         vendor_file.save(vendor_path)
         vendor_paths.append(vendor_path)
         #vendor_path = os.path.join(app.config['UPLOAD_FOLDER'], f'vendor{i}.xlsx')
         #file.save(vendor_path)
         #vendor_paths.append(vendor_path)
 
-    processed_file_path= process_files(insurance_paths, [kinray_path] + vendor_paths, conversion_path, pharmacy_name, date_range)
+    return insurance_paths, [kinray_path] + vendor_paths, conversion_path
+
+def get_archive_slot(member_path):
+    """
+    Get the slot of an extracted archive member.
+    The file name decides when it matches ARCHIVE_SLOT_PATTERNS, otherwise the header row:
+    BestRx and conversion columns, or a vendor feed. The insurance or vendor of a member
+    found by its header is named after the file.
+    Returns:
+        (slot, name), or None when the member is not one of the inputs.
+    """
+    stem = os.path.splitext(os.path.basename(member_path))[0]
+    words = re.sub(r'[^a-z0-9]+', '_', stem.lower()).strip('_')
+    for pattern, slot, name in ARCHIVE_SLOT_PATTERNS:
+        if re.search(rf'(^|_)({pattern})(_|$)', words):
+            return slot, name
+
+    vendor_format = get_vendor_format(member_path)
+    if vendor_format != 'excel':
+        # Text files are only vendor feeds when the reader finds an NDC and quantity in them
+        return ('vendor', stem) if not validate_vendor_feed(member_path, vendor_format, 1) else None
+    try:
+        wb = load_workbook(member_path, read_only=True)
+        try:
+            header = next(wb.active.iter_rows(max_row=1, values_only=True), ())
+        finally:
+            wb.close()
+    except Exception:
+        return None
+    header = [str(value).strip() for value in header if value is not None]
+    for slot in ['conversion', 'bestrx', 'vendor']:
+        if all(col in header for col in SLOT_COLUMNS[slot]):
+            return slot, stem.upper() if slot == 'bestrx' else stem
+    return None
+
+def extract_archive(archive, folder):
+    """
+    Extract a zip archive of a month's exports and assign each member to its input slot.
+    Members are streamed to disk one at a time. The conversion master starts loading into
+    memory in the background as soon as it is extracted, while the other members follow.
+    Args:
+        archive: Path or seekable file object of the zip archive.
+        folder: Empty folder to extract into, from make_archive_folder.
+    Returns:
+        The insurance paths (fixed insurances first), the vendor paths (Kinray first) and the
+        conversion path, which is None when the archive has no master.
+    Raises ValueError when a slot is found twice or there are no BestRx or vendor files.
+    """
+    insurance_paths = {}
+    vendor_paths = []
+    kinray_path = None
+    conversion_path = None
+    with zipfile.ZipFile(archive) as zf:
+        for member in zf.infolist():
+            member_name = os.path.basename(member.filename)
+            # Skip folders, Mac resource forks and Office lock files
+            if member.is_dir() or not member_name or member_name.startswith(('.', '~$')) or '__MACOSX' in member.filename:
+                continue
+            member_path = os.path.join(folder, re.sub(r'[^A-Za-z0-9._-]+', '_', member_name))
+            with zf.open(member) as source, open(member_path, 'wb') as target:
+                shutil.copyfileobj(source, target, 1024 * 1024)
+
+            slot = get_archive_slot(member_path)
+            if slot is None:
+                print(f"Skipping archive member {member.filename}, it is not a BestRx, vendor or conversion file")
+                os.remove(member_path)
+                continue
+            slot, name = slot
+            print(f"Archive member {member.filename}: {SLOT_NAMES[slot]}{f' {name}' if name else ''}")
+
+            # Name the file after its slot like the form uploads, so VENDOR_FORMATS applies to it
+            extension = os.path.splitext(member_name)[1].lower() or '.xlsx'
+            slot_path = os.path.join(folder, f"{(name or slot).replace(' ', '_')}{extension}")
+            if os.path.exists(slot_path) and slot_path != member_path:
+                slot_path = os.path.join(folder, f"{(name or slot).replace(' ', '_')}_{len(os.listdir(folder))}{extension}")
+            os.replace(member_path, slot_path)
+            member_path = slot_path
+            if slot == 'conversion':
+                if conversion_path:
+                    raise ValueError(f"The archive has more than one conversion/master file ({member.filename})")
+                conversion_path = member_path
+                threading.Thread(target=preload_conversion_data, args=(conversion_path,), daemon=True).start()
+            elif slot == 'bestrx':
+                if name in insurance_paths:
+                    raise ValueError(f"The archive has more than one BestRx file for {name} ({member.filename})")
+                insurance_paths[name] = member_path
+            elif name == 'kinray' and kinray_path is None:
+                kinray_path = member_path
+            else:
+                vendor_paths.append(member_path)
+
+    if not insurance_paths:
+        raise ValueError("The archive has no BestRx insurance files")
+    if not kinray_path and not vendor_paths:
+        raise ValueError("The archive has no vendor files")
+
+    return order_insurance_paths(insurance_paths), ([kinray_path] if kinray_path else []) + vendor_paths, conversion_path
+
+def make_archive_folder():
+    # A new folder for every extracted archive, concurrent uploads and commands do not share one
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    return tempfile.mkdtemp(prefix='archive-', dir=app.config['UPLOAD_FOLDER'])
+
+def preload_conversion_data(conversion_path):
+    # Runs in its own thread, the run reads the master again and reports the error there
+    try:
+        load_conversion_data(conversion_path)
+    except Exception as e:
+        print(f"Could not preload conversion master {conversion_path}: {e}")
+
+def order_insurance_paths(insurance_paths):
+    # Same insurance order as the report form, the fixed insurances first
+    fixed_insurances = ['ALL_PBM', 'CVS', 'ESI', 'OPTUM', 'MEDIMP', 'NYM']
+    ordered_insurances = [name for name in fixed_insurances if name in insurance_paths]
+    ordered_insurances += [name for name in insurance_paths if name not in fixed_insurances]
+    return {name: insurance_paths[name] for name in ordered_insurances}
+
+@app.route('/upload', methods=['POST'])
+def upload_file():
+    # One zip archive of the month's exports can replace the separate file inputs, it is extracted
+    # to a folder of its own that is removed when the request is done
+    archive_folder = None
+    archive_file = request.files.get('archive_file')
+    if archive_file and archive_file.filename:
+        archive_folder = make_archive_folder()
+    try:
+        return process_upload(archive_folder)
+    finally:
+        if archive_folder:
+            shutil.rmtree(archive_folder, ignore_errors=True)
+
+def process_upload(archive_folder):
+    
+    pharmacy_name = request.form['pharmacy_name']
+    date_range = request.form['date_range']
+
+    if archive_folder:
+        try:
+            uploaded_files = extract_archive(request.files['archive_file'].stream, archive_folder)
+        except (ValueError, zipfile.BadZipFile) as e:
+            return f"Error: {e}."
+        if uploaded_files[2] is None:
+            return "Error: The archive has no conversion/master file."
+    else:
+        uploaded_files = save_uploaded_files()
+    if uploaded_files is None:
+        return redirect(request.url)
+    insurance_paths, vendor_paths, conversion_path = uploaded_files
+
+    errors = validate_inputs(insurance_paths, [(os.path.basename(path), path) for path in vendor_paths], conversion_path)
+    if errors:
+        return format_validation_errors(errors)
+
+    job_id = request.form.get('job_id')
+    report_options = {'layout': request.form.get('report_layout') or app.config['REPORT_LAYOUT']}
+    compression_level = request.form.get('compression_level', type=int)
+    if compression_level is not None:
+        report_options['compression_level'] = compression_level
+
+    # Optional previous report for the "Changes Since Last Run" sheet
+    previous_report = request.files.get('previous_report')
+    if previous_report and previous_report.filename:
+        previous_report_path = os.path.join(app.config['UPLOAD_FOLDER'], 'previous_report.xlsx')
+        previous_report.save(previous_report_path)
+        report_options['previous_report'] = previous_report_path
+        report_options['to_order_threshold'] = request.form.get('to_order_threshold', app.config['DELTA_TO_ORDER_THRESHOLD'], type=float)
+        report_options['diff_threshold'] = request.form.get('diff_threshold', app.config['DELTA_DIFF_THRESHOLD'], type=float)
+
+    try:
+        processed_file_path= process_files(insurance_paths, vendor_paths, conversion_path, pharmacy_name, date_range, report_options, job_id=job_id)
+    except JobCancelled as e:
+        return f"Error: The report was stopped, {e}."
         
     # Debugging print statements
     # Ensure the file exists before sending it
@@ -152,8 +504,1153 @@ def upload_file():
         
     return send_file(processed_file_path, as_attachment=True)
 
+# Required columns of each upload slot
+SLOT_COLUMNS = {
+    'bestrx': BESTRX_COLUMNS,
+    'vendor': VENDOR_COLUMNS,
+    'conversion': CONVERSION_COLUMNS,
+}
+SLOT_NAMES = {
+    'bestrx': "BestRx insurance file",
+    'vendor': "vendor file",
+    'conversion': "conversion/master file",
+}
+
+def is_valid_ndc(value):
+    # An NDC is up to 11 digits, with or without hyphens
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    ndc = str(value).strip().replace("-", "")
+    return ndc.isdigit() and len(ndc) <= 11
+
+def validate_upload(file, slot, sample_rows=None):
+    """
+    Check an upload before processing, reading only the header row and a few sample rows.
+    The workbook is opened in read-only streaming mode so this stays fast for large files.
+    Args:
+        file: Path or file object of the upload.
+        slot: 'bestrx', 'vendor' or 'conversion'.
+        sample_rows: Number of data rows to check, defaults to VALIDATION_SAMPLE_ROWS.
+    Returns:
+        List of error messages, empty when the file looks right.
+    """
+    if sample_rows is None:
+        sample_rows = app.config['VALIDATION_SAMPLE_ROWS']
+    if slot == 'vendor':
+        vendor_format = get_vendor_format(file)
+        if vendor_format != 'excel':
+            return validate_vendor_feed(file, vendor_format, sample_rows)
+    try:
+        wb = load_workbook(file, read_only=True, data_only=True)
+    except Exception as e:
+        return [f"could not be opened as an Excel (.xlsx) workbook: {e}"]
+
+    try:
+        rows = list(wb.active.iter_rows(min_row=1, max_row=sample_rows + 1, values_only=True))
+    finally:
+        wb.close()
+    if not rows:
+        return ["is empty"]
+
+    header = [str(value).strip() if value is not None else '' for value in rows[0]]
+    missing_columns = [col for col in SLOT_COLUMNS[slot] if col not in header]
+    if missing_columns:
+        error = f"is missing the column(s) {', '.join(missing_columns)}"
+        # Point out when the file belongs in another slot
+        for other_slot, columns in SLOT_COLUMNS.items():
+            if other_slot != slot and all(col in header for col in columns):
+                error += f"; it looks like a {SLOT_NAMES[other_slot]}"
+                break
+        return [error]
+
+    errors = []
+    ndc_idx = header.index('NDC #')
+    sample = [row for row in rows[1:] if any(value is not None for value in row)]
+    if not sample:
+        errors.append("has no data rows")
+    bad_ndcs = [row[ndc_idx] for row in sample if ndc_idx < len(row) and row[ndc_idx] is not None and not is_valid_ndc(row[ndc_idx])]
+    if bad_ndcs:
+        errors.append(f"has values in 'NDC #' that are not NDCs, for example '{bad_ndcs[0]}'")
+    return errors
+
+def validate_vendor_feed(file, vendor_format, sample_rows):
+    # Check a CSV or EDI vendor feed by parsing it with its reader
+    try:
+        vendor_data = VENDOR_READERS[vendor_format](file)
+    except (ValueError, UnicodeDecodeError, pd.errors.ParserError) as e:
+        return [f"could not be read as a {vendor_format.upper()} vendor feed: {e}"]
+    if vendor_data.empty:
+        return ["has no data rows"]
+    bad_ndcs = [ndc for ndc in vendor_data['NDC #'].head(sample_rows) if not is_valid_ndc(ndc)]
+    if bad_ndcs:
+        return [f"has values in 'NDC #' that are not NDCs, for example '{bad_ndcs[0]}'"]
+    return []
+
+def validate_inputs(insurance_files, vendor_files, conversion_file):
+    """
+    Validate every input of a report.
+    Args:
+        insurance_files: Dict of insurance name to path or file object.
+        vendor_files: List of (vendor name, path or file object).
+        conversion_file: Path or file object of the conversion/master file, None to leave it out.
+    Returns:
+        Dict of input name to its list of errors, only for inputs with errors.
+    """
+    checks = [(f'{insurance} BestRx file', file, 'bestrx') for insurance, file in insurance_files.items()]
+    checks += [(f'{vendor_name} vendor file', file, 'vendor') for vendor_name, file in vendor_files]
+    if conversion_file is not None:
+        checks.append(("Conversion file", conversion_file, 'conversion'))
+
+    errors = {}
+    for name, file, slot in checks:
+        file_errors = validate_upload(file, slot)
+        if hasattr(file, 'seek'):
+            file.seek(0)  # Leave uploads ready to be saved
+        if file_errors:
+            errors[name] = file_errors
+    return errors
+
+def validate_group_inputs(groups, conversion_path):
+    """
+    Validate the inputs of a multi-period or chain upload, the same checks as a single report.
+    Args:
+        groups: List of (period or store name, insurance paths, vendor paths).
+        conversion_path: Path of the conversion/master file shared by the groups.
+    Returns:
+        Dict of input name, prefixed with its group, to its list of errors.
+    """
+    errors = validate_inputs({}, [], conversion_path)
+    for group_name, insurance_paths, vendor_paths in groups:
+        group_errors = validate_inputs(insurance_paths, [(os.path.basename(path), path) for path in vendor_paths], None)
+        errors.update((f'{group_name}: {name}', file_errors) for name, file_errors in group_errors.items())
+    return errors
+
+def format_validation_errors(errors):
+    return "Error: " + " ".join(f"{name} {'; '.join(file_errors)}." for name, file_errors in errors.items())
+
+@app.route('/validate', methods=['POST'])
+def validate_files():
+    # Check the uploads of the report form without saving or processing them
+    insurance_files = get_insurance_files()
+    optional_insurance_count = request.form.get('optional_insurance_count', 0, type=int)
+    for i in range(1, optional_insurance_count + 1):
+        insurance_files[request.form.get(f'optional_insurance_name{i}', f'Optional {i}')] = request.files.get(f'optional_insurance_file{i}')
+    insurance_files = {insurance: file.stream for insurance, file in insurance_files.items() if file and file.filename != ''}
+
+    vendor_files = []
+    kinray_file = request.files.get('kinray_file')
+    if kinray_file and kinray_file.filename != '':
+        vendor_files.append(('Kinray', kinray_file.stream))
+    vendor_count = request.form.get('vendor_count', 0, type=int)
+    for i in range(1, vendor_count + 1):
+        vendor_file = request.files.get(f'vendor{i}_file')
+        if vendor_file and vendor_file.filename != '':
+            vendor_files.append((request.form.get(f'vendor{i}_name', f'vendor{i}').strip() or f'vendor{i}', vendor_file.stream))
+
+    errors = {}
+    conversion_file = request.files.get('conversion_file')
+    if not insurance_files:
+        errors['BestRx files'] = ["at least one insurance file is required"]
+    if not kinray_file or kinray_file.filename == '':
+        errors['Kinray file'] = ["is required"]
+    if not conversion_file or conversion_file.filename == '':
+        errors['Conversion file'] = ["is required"]
+    if not errors:
+        errors = validate_inputs(insurance_files, vendor_files, conversion_file.stream)
+    return jsonify({'valid': not errors, 'errors': errors})
+
+@app.route('/api/parse', methods=['POST'])
+def api_parse():
+    """
+    Save and parse one upload of the form in the background, as soon as it is chosen.
+    The form fields are slot ('bestrx', 'vendor' or 'conversion'), file and, for vendor files,
+    vendor_name. The file is checked first; when it is valid, its parse starts and the file id to
+    follow it with /api/parse/<file_id> is returned. When the form is submitted, the parsed rows
+    of the same content are used instead of reading the file again.
+    """
+    slot = request.form.get('slot')
+    file = request.files.get('file')
+    if slot not in SLOT_COLUMNS or not file or file.filename == '':
+        return jsonify({'error': "A slot of bestrx, vendor or conversion and a file are required"}), 400
+
+    # Named like the uploads of the report form, the vendor format can depend on the name
+    if slot == 'bestrx':
+        file_name = 'bestrx.xlsx'
+    elif slot == 'vendor':
+        file_name = f"{request.form.get('vendor_name', '').strip().replace(' ', '_') or 'vendor'}{get_vendor_extension(file)}"
+    else:
+        file_name = 'conversion.xlsx'
+    # Saved in a folder of its own first, start_parse moves it to the folder of its file id
+    parsed_folder = os.path.join(app.config['UPLOAD_FOLDER'], 'parsed')
+    os.makedirs(parsed_folder, exist_ok=True)
+    path = os.path.join(tempfile.mkdtemp(dir=parsed_folder), file_name)
+    file.save(path)
+
+    errors = validate_upload(path, slot)
+    if errors:
+        shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+        return jsonify({'error': f"{file.filename} {'; '.join(errors)}.", 'errors': errors}), 400
+    return jsonify({'file_id': start_parse(slot, path), 'status': 'parsing'})
+
+@app.route('/api/parse/<file_id>')
+def api_parse_status(file_id):
+    # State of a background parse started by /api/parse: parsing, ready or failed
+    with parsed_files_lock:
+        parsed_file = parsed_files.get(file_id)
+    if parsed_file is None:
+        return jsonify({'error': f"Unknown file '{file_id}'"}), 404
+    future = parsed_file['future']
+    if not future.done():
+        return jsonify({'file_id': file_id, 'status': 'parsing'})
+    if future.exception() is not None:
+        return jsonify({'file_id': file_id, 'status': 'failed', 'error': str(future.exception())})
+    return jsonify({'file_id': file_id, 'status': 'ready', 'rows': len(future.result()), 'seconds': round(parsed_file['seconds'], 1)})
+
+# Recent reconciliation results by result id, oldest first
+results_store = OrderedDict()
+results_store_lock = threading.Lock()
+
+def store_result(final_data, missing_items, insurance_names, vendor_names, pharmacy_name, date_range, report_layout='wide', inputs=None):
+    """
+    Keep the computed frames of a run in memory so they can be served without building a workbook.
+    The parsed inputs from get_session_inputs are kept too, what-if runs start from them.
+    Returns:
+        The id of the result.
+    """
+    result_id = uuid.uuid4().hex
+    result = {
+        'final_data': final_data,
+        'missing_items': missing_items,
+        'insurance_names': list(insurance_names),
+        'vendor_names': list(vendor_names),
+        'pharmacy_name': pharmacy_name,
+        'date_range': date_range,
+        'report_layout': report_layout,
+        'inputs': inputs,
+        'created_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'tables': {},
+    }
+    with results_store_lock:
+        results_store[result_id] = result
+        while len(results_store) > app.config['RESULT_STORE_SIZE']:
+            results_store.popitem(last=False)
+    return result_id
+
+def get_result(result_id):
+    # A stored result, None when the id is unknown or the result was evicted
+    with results_store_lock:
+        return results_store.get(result_id)
+
+def get_session_inputs(combined_bestrx_data, combined_vendor_data, vendor_names, conversion_data, insurance_names, report_options=None, previous=None):
+    # Parsed inputs of a run, kept with its result so a what-if run does not read any file again
+    return {
+        'bestrx_data': combined_bestrx_data,
+        'vendor_data': combined_vendor_data,
+        'vendor_names': list(vendor_names),
+        'conversion_data': conversion_data,
+        'insurance_names': list(insurance_names),
+        'report_options': dict(report_options or {}),
+        'previous': previous,
+    }
+
+def get_result_table(result, table):
+    """
+    Get one table of a stored result.
+    Args:
+        result: A stored result.
+        table: One of 'rows', 'needs_to_order', 'do_not_order', 'missing_items' or 'never_ordered'.
+            The rows are one per NDC and insurance for a result in the long layout.
+    Returns:
+        The table as a data frame, or None for an unknown table.
+    """
+    # The tables are kept with the result, paging through a table asks for it again and again
+    with results_store_lock:
+        data = result['tables'].get(table)
+    if data is None:
+        # Built outside the lock, two requests for a new table may both build it and keep the same result
+        data = build_result_table(result, table)
+        if data is None:
+            return None
+        with results_store_lock:
+            data = result['tables'].setdefault(table, data)
+    return data
+
+def build_result_table(result, table):
+    final_data = result['final_data']
+    if table == 'rows' and result.get('report_layout') == 'long':
+        return to_long_format(final_data, result['insurance_names'], result['vendor_names'])
+    if table == 'rows':
+        desired_columns = get_report_columns(result['insurance_names'], result['vendor_names'])
+        return final_data[desired_columns].sort_values(by='Drug Name')
+    if table == 'needs_to_order':
+        return get_needs_to_order(final_data)[0]
+    if table == 'do_not_order':
+        return get_do_not_order(final_data)[0]
+    if table == 'missing_items':
+        return result['missing_items']
+    if table == 'never_ordered':
+        return get_never_ordered(final_data)
+    return None
+
+# Tables of the review page and the report sheet each one matches
+REVIEW_TABLES = [
+    ('rows', "Processed Data"),
+    ('needs_to_order', "Needs to be ordered - All"),
+    ('do_not_order', "Do Not Order - ALL"),
+    ('missing_items', "Missing Items"),
+    ('never_ordered', "Never Ordered - Check"),
+]
+
+FILTER_PATTERN = re.compile(r'^(.+?)(<=|>=|==|!=|<|>)(.*)$')
+
+def apply_filters(data, filters):
+    """
+    Filter a table with expressions like "CVS_D<0" or "Drug Name==ASPIRIN 81MG".
+    Numeric columns are compared with numbers, the other columns as text.
+    Raises ValueError for a malformed filter, an unknown column or a value that does not fit the column.
+    """
+    for expression in filters:
+        match = FILTER_PATTERN.match(expression)
+        if not match:
+            raise ValueError(f"Invalid filter '{expression}'")
+        column, operator, value = match.group(1).strip(), match.group(2), match.group(3).strip()
+        if column not in data.columns:
+            raise ValueError(f"Unknown filter column '{column}'")
+        values = data[column]
+        if pd.api.types.is_numeric_dtype(values):
+            try:
+                value = float(value)
+            except ValueError:
+                raise ValueError(f"Filter column '{column}' is numeric, '{value}' is not a number")
+        try:
+            if operator == '<':
+                data = data[values < value]
+            elif operator == '<=':
+                data = data[values <= value]
+            elif operator == '>':
+                data = data[values > value]
+            elif operator == '>=':
+                data = data[values >= value]
+            elif operator == '==':
+                data = data[values == value]
+            else:
+                data = data[values != value]
+        except TypeError:
+            # Mixed numbers and text in one column
+            raise ValueError(f"Filter '{expression}' cannot compare the values of '{column}'")
+    return data
+
+def apply_sort(data, sort):
+    """
+    Sort a table by a column, "Drug Name" sorts ascending and "-To Order" descending.
+    Missing values go last. Raises ValueError for an unknown column.
+    """
+    descending = sort.startswith('-')
+    column = sort[1:] if descending else sort
+    if column not in data.columns:
+        raise ValueError(f"Unknown sort column '{column}'")
+    try:
+        return data.sort_values(by=column, ascending=not descending, kind='stable', na_position='last')
+    except TypeError:
+        # Mixed numbers and text in one column
+        return data.sort_values(by=column, ascending=not descending, kind='stable', na_position='last', key=lambda values: values.astype(str))
+
+def paginate_table(data, cursor, limit, columns=None):
+    """
+    Get one page of a table as JSON-ready records.
+    The cursor is the position of the first row of the page, as returned in next_cursor.
+    """
+    if columns:
+        unknown_columns = [col for col in columns if col not in data.columns]
+        if unknown_columns:
+            raise ValueError(f"Unknown columns: {', '.join(unknown_columns)}")
+        data = data[columns]
+    try:
+        start = int(cursor) if cursor else 0
+    except ValueError:
+        raise ValueError(f"Invalid cursor '{cursor}'")
+    if start < 0:
+        raise ValueError(f"Invalid cursor '{cursor}', it cannot be negative")
+    if limit < 1:
+        raise ValueError(f"Invalid limit {limit}, it must be at least 1")
+    records = get_records(data.iloc[start:start + limit])
+    next_cursor = str(start + limit) if start + limit < len(data) else None
+    return {'rows': records, 'next_cursor': next_cursor, 'total_rows': len(data), 'columns': list(data.columns)}
+
+def get_records(data):
+    # Rows of a data frame as JSON-ready records, missing values become null
+    return data.astype(object).where(data.notnull(), None).to_dict(orient='records')
+
+@app.route('/api/reconcile', methods=['POST'])
+def api_reconcile():
+    # Reconcile the uploaded files without building a workbook
+    pharmacy_name = request.form.get('pharmacy_name', '').strip()
+    date_range = request.form.get('date_range', '').strip()
+    if not pharmacy_name or not date_range:
+        return jsonify({'error': "pharmacy_name and date_range are required"}), 400
+    report_layout = request.form.get('report_layout') or app.config['REPORT_LAYOUT']
+    if report_layout not in REPORT_LAYOUTS:
+        return jsonify({'error': f"Unknown report layout '{report_layout}'"}), 400
+    for field in ['optional_insurance_count', 'vendor_count']:
+        if not request.form.get(field, '').isdigit():
+            return jsonify({'error': f"{field} must be a number"}), 400
+    missing_names = [f'optional_insurance_name{i}' for i in range(1, int(request.form['optional_insurance_count']) + 1) if not request.form.get(f'optional_insurance_name{i}')]
+    if missing_names:
+        return jsonify({'error': f"Missing fields: {', '.join(missing_names)}"}), 400
+
+    uploaded_files = save_uploaded_files()
+    if uploaded_files is None:
+        return jsonify({'error': "Kinray, conversion and at least one insurance file are required"}), 400
+    insurance_paths, vendor_paths, conversion_path = uploaded_files
+
+    errors = validate_inputs(insurance_paths, [(os.path.basename(path), path) for path in vendor_paths], conversion_path)
+    if errors:
+        return jsonify({'error': "Invalid input files", 'errors': errors}), 400
+
+    combined_bestrx_data = read_bestrx_data(insurance_paths)
+    combined_vendor_data, vendor_names = read_vendor_data(vendor_paths)
+    conversion_data = load_conversion_data(conversion_path)
+    final_data, missing_items = reconcile_data(combined_bestrx_data, combined_vendor_data, vendor_names, conversion_data, insurance_paths.keys())
+
+    insurance_names = list(insurance_paths.keys())
+    if report_layout != 'wide':
+        final_data, insurance_names = drop_inactive_insurances(final_data, insurance_names)
+
+    inputs = get_session_inputs(combined_bestrx_data, combined_vendor_data, vendor_names, conversion_data, insurance_paths.keys())
+    result_id = store_result(final_data, missing_items, insurance_names, vendor_names, pharmacy_name, date_range, report_layout, inputs)
+    return jsonify({'result_id': result_id, 'rows': len(final_data)})
+
+@app.route('/api/preview', methods=['POST'])
+def api_preview():
+    # Largest discrepancies of the uploaded files without building a workbook, the full report is generated afterwards with /upload
+    pharmacy_name = request.form['pharmacy_name']
+    date_range = request.form['date_range']
+    # Checked before the files are saved, a blank or non-integer top would otherwise fall back to the default
+    top = request.form.get('top', str(app.config['PREVIEW_TOP_COUNT'])).strip()
+    if not top.isdigit() or int(top) < 1:
+        return jsonify({'error': "top must be a positive integer"}), 400
+    top_count = int(top)
+
+    uploaded_files = save_uploaded_files()
+    if uploaded_files is None:
+        return jsonify({'error': "Kinray, conversion and at least one insurance file are required"}), 400
+    insurance_paths, vendor_paths, conversion_path = uploaded_files
+
+    errors = validate_inputs(insurance_paths, [(os.path.basename(path), path) for path in vendor_paths], conversion_path)
+    if errors:
+        return jsonify({'error': "Invalid input files", 'errors': errors}), 400
+
+    top_count = min(top_count, app.config['API_MAX_PAGE_SIZE'])
+    top_diff, top_order = preview_files(insurance_paths, vendor_paths, conversion_path, pharmacy_name, date_range, top_count)
+    return jsonify({'columns': PREVIEW_COLUMNS, 'top_diff': get_records(top_diff), 'top_order': get_records(top_order)})
+
+@app.route('/api/results')
+def api_results():
+    # List the results kept in memory, newest first
+    with results_store_lock:
+        results = list(results_store.items())
+    return jsonify([
+        {'result_id': result_id, 'pharmacy_name': result['pharmacy_name'], 'date_range': result['date_range'],
+         'created_at': result['created_at'], 'insurances': result['insurance_names'], 'vendors': result['vendor_names']}
+        for result_id, result in reversed(results)
+    ])
+
+@app.route('/review')
+@app.route('/review/<result_id>')
+def review(result_id=None):
+    # Review the results kept in memory in scrolling grids, the rows are fetched a page at a time from the JSON API
+    return render_template('review.html', result_id=result_id or '', tables=REVIEW_TABLES, page_size=app.config['API_PAGE_SIZE'])
+
+@app.route('/api/results/<result_id>/<table>')
+def api_result_table(result_id, table):
+    result = get_result(result_id)
+    if result is None:
+        return jsonify({'error': f"Unknown result '{result_id}'"}), 404
+    data = get_result_table(result, table)
+    if data is None:
+        return jsonify({'error': f"Unknown table '{table}'"}), 404
+
+    limit = min(request.args.get('limit', app.config['API_PAGE_SIZE'], type=int), app.config['API_MAX_PAGE_SIZE'])
+    columns = [col for col in request.args.get('columns', '').split(',') if col]
+    try:
+        data = apply_filters(data, request.args.getlist('filter'))
+        if request.args.get('sort'):
+            data = apply_sort(data, request.args['sort'])
+        page = paginate_table(data, request.args.get('cursor'), limit, columns)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(page)
+
+@app.route('/api/results/<result_id>/whatif', methods=['POST'])
+def api_whatif(result_id):
+    # Regenerate the report of a result with master edits, excluded vendors or insurances or other thresholds, see rerun_result
+    result = get_result(result_id)
+    if result is None:
+        return jsonify({'error': f"Unknown result '{result_id}'"}), 404
+    if result['inputs'] is None:
+        return jsonify({'error': f"The inputs of result '{result_id}' were not kept"}), 400
+    overrides = request.get_json(silent=True) or {}
+    try:
+        new_result_id, output_file = rerun_result(result, overrides, job_id=overrides.get('job_id'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except JobCancelled as e:
+        return jsonify({'error': f"The report was stopped, {e}"}), 409
+    new_result = get_result(new_result_id)
+    rows = len(new_result['final_data']) if new_result is not None else None
+    return jsonify({'result_id': new_result_id, 'output_file': output_file, 'rows': rows})
+
+def save_period_uploads(period_index):
+    """
+    Save the BestRx and vendor uploads of one period of a multi-period upload.
+    The form fields are the same as the single report form, prefixed with "period<i>_".
+    Returns:
+        The period name, the insurance paths and the vendor paths (Kinray first).
+    """
+    period_name = request.form.get(f'period{period_index}_name', '').strip() or f'Period {period_index}'
+    return (period_name,) + save_prefixed_uploads(f'period{period_index}_', os.path.join(app.config['UPLOAD_FOLDER'], f'period{period_index}'))
+
+def save_prefixed_uploads(prefix, period_folder):
+    # Save the BestRx and vendor uploads of the form fields starting with prefix, returns the insurance and vendor paths
+    if not os.path.exists(period_folder):
+        os.makedirs(period_folder)
+
+    insurance_files = get_insurance_files(prefix)
+    optional_insurance_count = request.form.get(f'{prefix}optional_insurance_count', 0, type=int)
+    for i in range(1, optional_insurance_count + 1):
+        name = request.form[f'{prefix}optional_insurance_name{i}']
+        insurance_files[name] = request.files.get(f'{prefix}optional_insurance_file{i}')
+
+    insurance_paths = {}
+    for key, file in insurance_files.items():
+        if file and file.filename != '':
+            path = os.path.join(period_folder, f'{key}.xlsx')
+            file.save(path)
+            insurance_paths[key] = path
+
+    vendor_paths = []
+    kinray_file = request.files.get(f'{prefix}kinray_file')
+    if kinray_file and kinray_file.filename != '':
+        kinray_path = os.path.join(period_folder, f'kinray{get_vendor_extension(kinray_file)}')
+        kinray_file.save(kinray_path)
+        vendor_paths.append(kinray_path)
+
+    vendor_count = request.form.get(f'{prefix}vendor_count', 0, type=int)
+    for i in range(1, vendor_count + 1):
+        vendor_name = request.form.get(f'{prefix}vendor{i}_name', f'vendor{i}').strip()
+        vendor_file = request.files.get(f'{prefix}vendor{i}_file')
+        if vendor_file and vendor_file.filename != '':
+            safe_name = vendor_name.replace(" ", "_") or f'vendor{i}'  # fallback if empty
+            vendor_path = os.path.join(period_folder, f'{safe_name}{get_vendor_extension(vendor_file)}')
+            vendor_file.save(vendor_path)
+            vendor_paths.append(vendor_path)
+
+    return insurance_paths, vendor_paths
+
+@app.route('/upload_periods', methods=['POST'])
+def upload_periods():
+    # Compare several periods (oldest first) against one conversion file in a single report
+    pharmacy_name = request.form['pharmacy_name']
+    period_count = int(request.form['period_count'])
+    conversion_file = request.files['conversion_file']
+
+    periods = [save_period_uploads(i) for i in range(1, period_count + 1)]
+    if conversion_file.filename == '' or any(not insurance_paths or not vendor_paths for _, insurance_paths, vendor_paths in periods):
+        return redirect(request.url)
+
+    conversion_path = os.path.join(app.config['UPLOAD_FOLDER'], 'conversion.xlsx')
+    conversion_file.save(conversion_path)
+
+    errors = validate_group_inputs(periods, conversion_path)
+    if errors:
+        return format_validation_errors(errors)
+
+    processed_file_path = process_period_files(periods, conversion_path, pharmacy_name)
+    if os.path.exists(processed_file_path):
+        return render_template('success.html', message="Your file has been downloaded successfully.")
+    else:
+        return "Error: File not found."
+
+@app.route('/upload_chain', methods=['POST'])
+def upload_chain():
+    # Roll several stores of a chain up into one report, the store fields are prefixed with "store<i>_"
+    chain_name = request.form['chain_name']
+    date_range = request.form['date_range']
+    store_count = int(request.form['store_count'])
+    conversion_file = request.files['conversion_file']
+
+    stores = []
+    for i in range(1, store_count + 1):
+        store_name = request.form.get(f'store{i}_name', '').strip() or f'Store {i}'
+        insurance_paths, vendor_paths = save_prefixed_uploads(f'store{i}_', os.path.join(app.config['UPLOAD_FOLDER'], f'store{i}'))
+        stores.append((store_name, insurance_paths, vendor_paths))
+    if conversion_file.filename == '' or any(not insurance_paths or not vendor_paths for _, insurance_paths, vendor_paths in stores):
+        return redirect(request.url)
+    if len({store_name for store_name, _, _ in stores}) != len(stores):
+        return "Error: Every store needs its own name."
+
+    conversion_path = os.path.join(app.config['UPLOAD_FOLDER'], 'conversion.xlsx')
+    conversion_file.save(conversion_path)
+
+    errors = validate_group_inputs(stores, conversion_path)
+    if errors:
+        return format_validation_errors(errors)
+
+    processed_file_path = process_chain_files(stores, conversion_path, chain_name, date_range)
+    if os.path.exists(processed_file_path):
+        return render_template('success.html', message="Your file has been downloaded successfully.")
+    else:
+        return "Error: File not found."
+
+@app.route('/api/chain', methods=['POST'])
+def api_chain():
+    # Roll up results that are already in memory, {"chain_name", "date_range", "stores": {store name: result id}}
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        return jsonify({'error': "The request body must be a JSON object"}), 400
+    chain_name = payload.get('chain_name')
+    if not isinstance(chain_name, str) or not chain_name.strip():
+        return jsonify({'error': "No chain_name given"}), 400
+    store_results = payload.get('stores') or {}
+    if not isinstance(store_results, dict) or not store_results:
+        return jsonify({'error': "No stores given"}), 400
+    with results_store_lock:
+        results = {store_name: results_store.get(result_id) for store_name, result_id in store_results.items()}
+    unknown = [store_results[store_name] for store_name, result in results.items() if result is None]
+    if unknown:
+        return jsonify({'error': f"Unknown result '{unknown[0]}'"}), 404
+
+    store_rollups = {}
+    missing_items = {}
+    for store_name, result in results.items():
+        store_rollups[store_name] = get_store_rollup(result['final_data'])
+        missing_items[store_name] = result['missing_items']
+    date_range = payload.get('date_range') or next(iter(results.values()))['date_range']
+    output_file = write_chain_report(store_rollups, missing_items, None, chain_name.strip(), date_range)
+    return jsonify({'output_file': output_file})
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """
+    Get the SHA-256 hash of a file's content.
+    Args:
+        path: Path to the file.
+        chunk_size: Number of bytes read at a time.
+    Returns:
+        The hex digest of the file content.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def build_cache_key(insurance_paths, vendor_paths, conversion_path, pharmacy_name, date_range, report_options=None):
+    """
+    Build the result cache key for one report.
+    The key covers the content of every input file (not the file names, which are
+    always the same in the uploads folder) together with the report parameters.
+    Insurance and vendor order is kept because it decides the column order.
+    Args:
+        insurance_paths: Dict of insurance name to BestRx file path.
+        vendor_paths: List of vendor file paths (Kinray first).
+        conversion_path: Path of the conversion/master file.
+        pharmacy_name: Pharmacy name shown in the report title.
+        date_range: Date range shown in the report title.
+        report_options: Optional dict of extra report options.
+    Returns:
+        The cache key as a hex string.
+    """
+    key_data = {
+        'version': RESULT_CACHE_VERSION,
+        'insurances': [[insurance, file_sha256(path)] for insurance, path in insurance_paths.items()],
+        'vendors': [file_sha256(path) for path in vendor_paths],
+        'conversion': file_sha256(conversion_path),
+        'pharmacy_name': pharmacy_name,
+        'date_range': date_range,
+        'report_options': report_options or {},
+        # The suggestions on the Missing Items sheet depend on it
+        'master_suggestion_min_score': app.config['MASTER_SUGGESTION_MIN_SCORE'],
+    }
+    key_json = json.dumps(key_data, sort_keys=True, default=str)
+    return hashlib.sha256(key_json.encode('utf-8')).hexdigest()
+
+def get_cached_report(cache_key):
+    """
+    Get the path of a cached report for the given key.
+    Returns None if the report is not cached or has expired. A hit renews the report, so
+    RESULT_CACHE_RETENTION_DAYS counts from its last use.
+    """
+    cached_path = os.path.join(app.config['CACHE_FOLDER'], f'{cache_key}.xlsx')
+    if not os.path.exists(cached_path):
+        return None
+
+    retention_seconds = app.config['RESULT_CACHE_RETENTION_DAYS'] * 24 * 60 * 60
+    if time.time() - os.path.getmtime(cached_path) > retention_seconds:
+        remove_cached_report(cached_path)
+        return None
+
+    # Mark the report as recently used so it is evicted last
+    os.utime(cached_path, None)
+    return cached_path
+
+def store_cached_report(cache_key, report_path, result=None):
+    """
+    Copy the generated report into the cache folder and keep the cache within its limits.
+    The stored result of the run (see store_result) is pickled next to it, so a cache hit can
+    be reviewed, paged through the API and rerun as a what-if like a computed report.
+    """
+    cached_path = os.path.join(app.config['CACHE_FOLDER'], f'{cache_key}.xlsx')
+    if result is not None:
+        cached_result = {key: result[key] for key in CACHED_RESULT_KEYS}
+        with open(get_cached_result_path(cached_path), 'wb') as f:
+            pickle.dump(cached_result, f, protocol=pickle.HIGHEST_PROTOCOL)
+    shutil.copyfile(report_path, cached_path)
+    prune_result_cache()
+    return cached_path
+
+# Arguments of store_result kept with a cached report
+CACHED_RESULT_KEYS = ['final_data', 'missing_items', 'insurance_names', 'vendor_names', 'pharmacy_name', 'date_range', 'report_layout', 'inputs']
+
+def get_cached_result_path(cached_path):
+    return os.path.splitext(cached_path)[0] + '.pkl'
+
+def load_cached_result(cached_path):
+    # The result pickled with a cached report, None for reports cached before results were kept
+    try:
+        with open(get_cached_result_path(cached_path), 'rb') as f:
+            return pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError) as e:
+        print(f"No stored result for the cached report {cached_path}: {e}")
+        return None
+
+def remove_cached_report(cached_path):
+    # Remove a cached report together with its stored result
+    for path in [cached_path, get_cached_result_path(cached_path)]:
+        if os.path.exists(path):
+            os.remove(path)
+
+def prune_result_cache():
+    """
+    Remove expired reports from the cache folder, then remove the least recently
+    used reports until the cache is below the configured size limit.
+    """
+    cache_folder = app.config['CACHE_FOLDER']
+    retention_seconds = app.config['RESULT_CACHE_RETENTION_DAYS'] * 24 * 60 * 60
+    max_size = app.config['RESULT_CACHE_MAX_SIZE_MB'] * 1024 * 1024
+    now = time.time()
+
+    cached_files = []
+    for file_name in os.listdir(cache_folder):
+        if not file_name.endswith('.xlsx'):
+            continue
+        path = os.path.join(cache_folder, file_name)
+        modified = os.path.getmtime(path)
+        if now - modified > retention_seconds:
+            remove_cached_report(path)
+        else:
+            result_path = get_cached_result_path(path)
+            result_size = os.path.getsize(result_path) if os.path.exists(result_path) else 0
+            cached_files.append((modified, os.path.getsize(path) + result_size, path))
+
+    # Oldest first
+    cached_files.sort()
+    total_size = sum(size for _, size, _ in cached_files)
+    for modified, size, path in cached_files:
+        if total_size <= max_size:
+            break
+        remove_cached_report(path)
+        total_size -= size
+
+def name_trigrams(name):
+    """
+    Get the set of character trigrams of a drug name.
+    The name is upper-cased and punctuation is collapsed to spaces so that
+    "AMOXICILLIN 500MG CAP" and "Amoxicillin-500mg cap" give the same trigrams.
+    """
+    if not isinstance(name, str):
+        return set()
+    normalized = ' '.join(re.sub(r'[^A-Z0-9]+', ' ', name.upper()).split())
+    if not normalized:
+        return set()
+    padded = f'  {normalized} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class MasterNameIndex:
+    """
+    Trigram index over the DRUG NAME column of the conversion master.
+    Used to suggest master rows for items that have no ITEM NO. Each lookup only
+    rescores the rows that share the rarest trigrams of the name (or the NDC
+    labeler/product prefix), instead of comparing against every master row.
+    """
+    # Number of the rarest query trigrams used to find candidate rows
+    QUERY_TRIGRAMS = 8
+    # Number of candidate rows rescored per lookup
+    CANDIDATE_LIMIT = 50
+    # Weight of the drug name similarity versus the NDC prefix match in the score
+    NAME_WEIGHT = 0.75
+
+    def __init__(self, conversion_data):
+        # Only rows with an item number are useful suggestions
+        master = conversion_data[conversion_data['ITEM NO'].notnull() & conversion_data['DRUG NAME'].notnull()]
+        self.item_numbers = master['ITEM NO'].tolist()
+        self.ndcs = master['NDC #'].tolist()
+        self.drug_names = master['DRUG NAME'].astype(str).tolist()
+        self.name_trigrams = [name_trigrams(name) for name in self.drug_names]
+
+        self.trigram_rows = defaultdict(list)
+        for row, trigrams in enumerate(self.name_trigrams):
+            for trigram in trigrams:
+                self.trigram_rows[trigram].append(row)
+
+        # Package sizes of the same drug share the labeler + product part (first 9 digits) of the NDC
+        self.product_rows = defaultdict(list)
+        for row, ndc in enumerate(self.ndcs):
+            if isinstance(ndc, str) and len(ndc) == 11:
+                self.product_rows[ndc[:9]].append(row)
+
+    def ndc_similarity(self, ndc, master_ndc):
+        # 1 for the same labeler and product, 0.5 for the same labeler only
+        if not isinstance(ndc, str) or not isinstance(master_ndc, str):
+            return 0
+        if ndc[:9] == master_ndc[:9]:
+            return 1
+        if ndc[:5] == master_ndc[:5]:
+            return 0.5
+        return 0
+
+    def suggest(self, ndc, drug_name, top_k=3):
+        """
+        Get the best matching master rows for an item.
+        Args:
+            ndc: The 11 digit NDC of the item.
+            drug_name: The drug name of the item.
+            top_k: Number of suggestions to return.
+        Returns:
+            List of (score, row) tuples, best first. Score is between 0 and 1.
+        """
+        query = name_trigrams(drug_name)
+
+        # Count shared trigrams using only the rarest ones, common trigrams like "TAB" match everything
+        rare_trigrams = sorted((trigram for trigram in query if trigram in self.trigram_rows), key=lambda trigram: len(self.trigram_rows[trigram]))
+        counts = Counter()
+        for trigram in rare_trigrams[:self.QUERY_TRIGRAMS]:
+            counts.update(self.trigram_rows[trigram])
+        candidates = {row for row, _ in counts.most_common(self.CANDIDATE_LIMIT)}
+        if isinstance(ndc, str):
+            candidates.update(self.product_rows.get(ndc[:9], []))
+
+        scored = []
+        for row in candidates:
+            trigrams = self.name_trigrams[row]
+            name_similarity = 2 * len(query & trigrams) / (len(query) + len(trigrams)) if query and trigrams else 0
+            score = self.NAME_WEIGHT * name_similarity + (1 - self.NAME_WEIGHT) * self.ndc_similarity(ndc, self.ndcs[row])
+            if score > 0:
+                scored.append((score, row))
+        return heapq.nlargest(top_k, scored)
+
+def add_master_suggestions(missing_items, conversion_data, top_k=3):
+    """
+    Add the top candidate master rows to each missing item, only candidates scoring at least MASTER_SUGGESTION_MIN_SCORE.
+    Returns one row per missing item with its columns followed by Suggestion 1 to top_k, each as
+    Item No, NDC #, Drug Name and Match %, the suggestions an item does not have are left blank.
+    """
+    index = get_master_index(conversion_data)
+    min_score = app.config['MASTER_SUGGESTION_MIN_SCORE']
+    fields = ['Item No', 'NDC #', 'Drug Name', 'Match %']
+    columns = [f'Suggestion {rank} {field}' for rank in range(1, top_k + 1) for field in fields]
+    rows = []
+    for ndc, drug_name in missing_items[['NDC #', 'Drug Name']].itertuples(index=False):
+        row = []
+        for score, master_row in index.suggest(ndc, drug_name, top_k):
+            if score >= min_score:
+                row += [index.item_numbers[master_row], index.ndcs[master_row], index.drug_names[master_row], round(score * 100)]
+        rows.append(row + [''] * (len(columns) - len(row)))
+    suggestions = pd.DataFrame(rows, columns=columns)
+    return pd.concat([missing_items.reset_index(drop=True), suggestions], axis=1)
+
+# Stored in PRAGMA user_version, bump it when a migration is added to init_warehouse
+WAREHOUSE_SCHEMA_VERSION = 1
+
+def get_warehouse_connection():
+    # Open the warehouse database, initialising it if it is new or on an older schema
+    conn = sqlite3.connect(app.config['WAREHOUSE_PATH'])
+    if conn.execute("PRAGMA user_version").fetchone()[0] < WAREHOUSE_SCHEMA_VERSION:
+        init_warehouse(conn)
+    return conn
+
+def init_warehouse(conn):
+    """
+    Create the warehouse tables and indexes and migrate a database made by an older version.
+
+    Args:
+        conn (sqlite3.Connection): Connection to the warehouse database
+    """
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS runs (
+            run_id TEXT PRIMARY KEY,
+            pharmacy_name TEXT NOT NULL,
+            date_range TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            output_file TEXT,
+            period_end TEXT
+        );
+        CREATE TABLE IF NOT EXISTS reconciliation (
+            run_id TEXT NOT NULL REFERENCES runs(run_id),
+            pharmacy_name TEXT NOT NULL,
+            date_range TEXT NOT NULL,
+            ndc TEXT NOT NULL,
+            drug_name TEXT,
+            item_number TEXT,
+            package_size REAL,
+            price REAL,
+            total_purchased REAL,
+            insurance TEXT NOT NULL,
+            quantity_billed REAL,
+            package_size_billed REAL,
+            package_size_difference REAL,
+            dollar_paid REAL,
+            dollar_purchased REAL,
+            dollar_difference REAL
+        );
+        CREATE INDEX IF NOT EXISTS idx_reconciliation_ndc ON reconciliation (ndc, insurance);
+        CREATE INDEX IF NOT EXISTS idx_reconciliation_insurance ON reconciliation (insurance);
+        CREATE INDEX IF NOT EXISTS idx_reconciliation_run ON reconciliation (run_id);
+        CREATE INDEX IF NOT EXISTS idx_runs_pharmacy ON runs (pharmacy_name, date_range);
+    """)
+    # Databases created before the data period was kept
+    if 'period_end' not in [row[1] for row in conn.execute("PRAGMA table_info(runs)")]:
+        conn.execute("ALTER TABLE runs ADD COLUMN period_end TEXT")
+        runs = conn.execute("SELECT run_id, date_range FROM runs").fetchall()
+        conn.executemany("UPDATE runs SET period_end = ? WHERE run_id = ?", [(get_period_end(date_range), run_id) for run_id, date_range in runs])
+    conn.execute(f"PRAGMA user_version = {WAREHOUSE_SCHEMA_VERSION}")
+    conn.commit()
+
+MONTH_NAMES = {name.lower(): number for number, name in enumerate(calendar.month_abbr) if name}
+
+def get_period_end(date_range):
+    """
+    Get the last day of the data period from a free text date range, such as
+    "01/01/2024 - 01/31/2024", "2024-01-01 to 2024-01-31", "Jan 2024" or "January-March 2024".
+    Returns:
+        The latest date found as YYYY-MM-DD, a month without a day counts as its last day.
+        None when no date is found.
+    """
+    text = str(date_range).lower()
+    dates = []
+
+    def add_date(year, month, day=None):
+        year, month = int(year), int(month)
+        if year < 100:
+            year += 2000
+        if not 1 <= month <= 12:
+            return
+        day = int(day) if day else calendar.monthrange(year, month)[1]
+        try:
+            dates.append(datetime.date(year, month, day))
+        except ValueError:
+            pass
+
+    for year, month, day in re.findall(r'\b(\d{4})[-/.](\d{1,2})[-/.](\d{1,2})\b', text):
+        add_date(year, month, day)
+    for month, day, year in re.findall(r'\b(\d{1,2})[-/.](\d{1,2})[-/.](\d{4}|\d{2})\b', text):
+        add_date(year, month, day)
+    # Full dates are taken out first, their last part would read as a month and year
+    text = re.sub(r'\b(\d{4}[-/.]\d{1,2}[-/.]\d{1,2}|\d{1,2}[-/.]\d{1,2}[-/.](\d{4}|\d{2}))\b', ' ', text)
+    for month, year in re.findall(r'\b(\d{1,2})[-/.](\d{4})\b', text):
+        add_date(year, month)
+    for month, day, year in re.findall(r'\b([a-z]{3})[a-z]*\.?\s*(\d{1,2})?,?\s+(\d{4})\b', text):
+        if month in MONTH_NAMES:
+            add_date(year, MONTH_NAMES[month], day)
+    return max(dates).isoformat() if dates else None
+
+def store_run_results(final_data, insurance_names, pharmacy_name, date_range, output_file=None):
+    """
+    Store the per-NDC reconciliation rows of one run in the warehouse, in place of the earlier
+    runs of the same pharmacy and date range.
+    Rows are stored one per NDC and insurance so they can be queried across runs.
+    Args:
+        final_data: The reconciled data frame of the run.
+        insurance_names: The insurance names of the run.
+        pharmacy_name: Pharmacy name of the run.
+        date_range: Date range of the run.
+        output_file: Path of the generated report.
+    Returns:
+        The run id.
+    """
+    run_id = uuid.uuid4().hex
+    created_at = time.strftime('%Y-%m-%d %H:%M:%S')
+    row_count = len(final_data)
+
+    def column_values(column):
+        # Plain python values so sqlite can store them, 0 when the column is missing
+        if column in final_data.columns:
+            return final_data[column].tolist()
+        return [0] * row_count
+
+    ndcs = column_values('NDC #')
+    drug_names = column_values('Drug Name')
+    item_numbers = [None if pd.isnull(item) else str(item) for item in column_values('Item Number')]
+    package_sizes = column_values('Package Size')
+    prices = column_values('PRICE')
+    total_purchased = column_values('Total Purchased')
+
+    rows = []
+    for insurance in insurance_names:
+        rows.extend(zip(
+            [run_id] * row_count, [pharmacy_name] * row_count, [date_range] * row_count,
+            ndcs, drug_names, item_numbers, package_sizes, prices, total_purchased,
+            [insurance] * row_count,
+            column_values(f'{insurance}_Q'),
+            column_values(f'{insurance}_P'),
+            column_values(f'{insurance}_D'),
+            column_values(f'{insurance}_T'),
+            column_values(f'{insurance}_Pur'),
+            column_values(f'{insurance}_Diff$'),
+        ))
+
+    conn = get_warehouse_connection()
+    try:
+        with conn:
+            # A rerun of the same period would count its rows twice in the history
+            earlier_runs = [row[0] for row in conn.execute("SELECT run_id FROM runs WHERE pharmacy_name = ? AND date_range = ?", (pharmacy_name, date_range))]
+            conn.executemany("DELETE FROM reconciliation WHERE run_id = ?", [(earlier_run,) for earlier_run in earlier_runs])
+            conn.executemany("DELETE FROM runs WHERE run_id = ?", [(earlier_run,) for earlier_run in earlier_runs])
+            conn.execute(
+                "INSERT INTO runs (run_id, pharmacy_name, date_range, created_at, output_file, period_end) VALUES (?, ?, ?, ?, ?, ?)",
+                (run_id, pharmacy_name, date_range, created_at, output_file, get_period_end(date_range)),
+            )
+            conn.executemany("INSERT INTO reconciliation VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    finally:
+        conn.close()
+    print(f"Stored {len(rows)} reconciliation rows for run {run_id}")
+    return run_id
+
+def query_ndc_shortfall(ndc, months=12, pharmacy_name=None, insurance=None):
+    """
+    Get the purchased vs billed history of one NDC across the runs of the last months.
+    The months count back from today to the end of each run's data period (period_end, read from
+    its date range). Runs whose date range has no recognizable date use the day they were processed.
+    Args:
+        ndc: The NDC, with or without hyphens.
+        months: Number of months to look back.
+        pharmacy_name: Optional pharmacy to limit the history to.
+        insurance: Optional insurance to limit the history to.
+    Returns:
+        List of dicts, one per run and insurance, oldest period first.
+        Shortfall is the number of packages billed but not purchased.
+    """
+    ndc = str(ndc).replace("-", "").zfill(11)
+    query = """
+        SELECT r.pharmacy_name, r.date_range, COALESCE(runs.period_end, date(runs.created_at)) AS period_end,
+               runs.created_at, r.run_id, r.insurance,
+               r.total_purchased, r.package_size_billed, r.package_size_difference,
+               CASE WHEN r.package_size_difference < 0 THEN -r.package_size_difference ELSE 0 END AS shortfall,
+               r.dollar_difference
+        FROM reconciliation r
+        JOIN runs ON runs.run_id = r.run_id
+        WHERE r.ndc = ? AND COALESCE(runs.period_end, date(runs.created_at)) >= date('now', 'localtime', ?)
+    """
+    params = [ndc, f'-{int(months)} months']
+    if pharmacy_name:
+        query += " AND r.pharmacy_name = ?"
+        params.append(pharmacy_name)
+    if insurance:
+        query += " AND r.insurance = ?"
+        params.append(insurance)
+    query += " ORDER BY period_end, runs.created_at, r.insurance"
+
+    conn = get_warehouse_connection()
+    conn.row_factory = sqlite3.Row
+    try:
+        return [dict(row) for row in conn.execute(query, params)]
+    finally:
+        conn.close()
+
+@app.route('/history/<ndc>')
+def ndc_history(ndc):
+    months = request.args.get('months', 12, type=int)
+    history = query_ndc_shortfall(ndc, months, request.args.get('pharmacy_name'), request.args.get('insurance'))
+    return jsonify(history)
+
+def round_values(values, decimals):
+    # Same result as round() on every value: np.round works on the scaled value, which can land on
+    # the other side of a tie, so the values close to a tie are rounded one by one with round()
+    rounded = values.round(decimals)
+    scaled = values * 10 ** decimals
+    near_tie = ((scaled % 1) - 0.5).abs() <= scaled.abs().clip(lower=1) * 1e-9
+    if near_tie.any():
+        rounded[near_tie] = [round(value, decimals) for value in values[near_tie]]
+    return rounded
+
+def round_report_values(data, decimals=2):
+    """
+    Round the float values of a frame before it is written to a report sheet.
+    Float columns are rounded a column at a time, floats in text columns one by one.
+    Returns:
+        A rounded copy of the frame.
+    """
+    data = data.copy()
+    for col_idx, dtype in enumerate(data.dtypes):
+        if pd.api.types.is_float_dtype(dtype):
+            data.isetitem(col_idx, round_values(data.iloc[:, col_idx], decimals))
+        elif dtype == object:
+            data.isetitem(col_idx, data.iloc[:, col_idx].map(lambda value: round(value, decimals) if isinstance(value, float) else value))
+    return data
+
+def make_cell_style(wb, font=None, fill=None, border=None, alignment=None):
+    """
+    Register a combination of styles with the workbook once.
+    Setting cell.font, cell.border, ... looks the style up in the workbook's tables for every
+    cell; cells that share a style take a copy of this instead: cell._style = StyleArray(style).
+    """
+    style = StyleArray()
+    if font is not None:
+        style.fontId = wb._fonts.add(font)
+    if fill is not None:
+        style.fillId = wb._fills.add(fill)
+    if border is not None:
+        style.borderId = wb._borders.add(border)
+    if alignment is not None:
+        style.alignmentId = wb._alignments.add(alignment)
+    return style
+
+def set_cells_border(cells, border):
+    # Give the cells the border, restyling each distinct cell style once
+    bordered_styles = {}
+    for cell in cells:
+        key = tuple(cell._style)
+        if key not in bordered_styles:
+            cell.border = border
+            bordered_styles[key] = StyleArray(cell._style)
+        else:
+            cell._style = StyleArray(bordered_styles[key])
+
+def set_default_row_height(sheet, first_row, height=20):
+    # Rows from first_row on get the height as the sheet's default row height,
+    # the rows above keep their own height (15 when they have none)
+    for row_idx in range(1, first_row):
+        if sheet.row_dimensions[row_idx].height is None:
+            sheet.row_dimensions[row_idx].height = 15
+    sheet.sheet_format.defaultRowHeight = height
+    sheet.sheet_format.customHeight = True
+
+def save_report_workbook(wb, output_file, compression_level=None):
+    # Save the workbook like wb.save, with a selectable zip compression level
+    if compression_level is None:
+        compression_level = app.config['REPORT_COMPRESSION_LEVEL']
+    if compression_level:
+        archive = zipfile.ZipFile(output_file, 'w', zipfile.ZIP_DEFLATED, allowZip64=True, compresslevel=compression_level)
+    else:
+        archive = zipfile.ZipFile(output_file, 'w', zipfile.ZIP_STORED, allowZip64=True)
+    ExcelWriter(wb, archive).save()
+
+def add_missing_items_sheet(wb, missing_items, conversion_data=None):
+    # Suggest matching master rows for each missing item when the master is available
+    if conversion_data is not None:
+        missing_items = add_master_suggestions(missing_items, conversion_data)
+    missing_items = round_report_values(missing_items)
 
-def add_missing_items_sheet(wb, missing_items):
     ws_missing = wb.create_sheet(title="Missing Items")
 
     # Set the header
@@ -164,17 +1661,20 @@ def add_missing_items_sheet(wb, missing_items):
     cell.font = Font(size=20, bold=True)
     ws_missing.row_dimensions[1].height = 30
     # Add the missing items data
+    data_style = make_cell_style(wb, font=Font(size=12), alignment=Alignment(horizontal='center', vertical='center'),
+                                 border=Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin')))
     for r_idx, row in enumerate(dataframe_to_rows(missing_items, index=False, header=True), start=2):
         for c_idx, value in enumerate(row, start=1):
             cell = ws_missing.cell(row=r_idx, column=c_idx, value=value)
-            cell.alignment = Alignment(horizontal='center', vertical='center')
-            cell.font = Font(size=12)
-            cell.border = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
+            cell._style = StyleArray(data_style)
     # Set fixed column widths for specific columns
     column_widths = {
         'A': 20,  # Column A
         'B': 80,  # Column B
     }
+    for col_idx, col in enumerate(missing_items.columns, start=1):
+        if col.startswith('Suggestion') and col.endswith('Drug Name'):
+            column_widths[get_column_letter(col_idx)] = 50
     ws_missing.freeze_panes = 'A3'
     for col_letter, width in column_widths.items():
         ws_missing.column_dimensions[col_letter].width = width
@@ -327,49 +1827,97 @@ def add_do_not_order(wb, final_data):
     #ws_needs_order.page_setup.orientation = ws_needs_order.ORIENTATION_LANDSCAPE
     ws_needs_order.print_options.gridLines = True
     
-def get_column_index(ws, header_name):
+class SheetLayout:
     """
-    Get the column index for a specific header name in the given worksheet.
-    Args:
-        ws: The worksheet object.
-        header_name: The header name to search for.
-    Returns:
-        The column index (1-based) if found, otherwise None.
+    Column layout of the "Processed Data" sheet.
+    Built once from the report columns and the insurance/vendor lists so the
+    formatting code can look up column positions directly instead of scanning
+    the header row for every lookup.
     """
-    for cell in ws[3]:  # Assuming headers are in row 3
-        if cell.value == header_name:
-            return cell.column  # Return 1-based index
-    return None
-
-def add_autosum(ws, insurance_paths, start_row, end_row):
-    # Loop through each insurance to add autosum for columns _T, _Pur, and _Diff$
-    for insurance in insurance_paths.keys():
-        # Get column indices dynamically for _T, _Pur, and _Diff$
-        t_col = get_column_index(ws, f'{insurance}_T')
-        pur_col = get_column_index(ws, f'{insurance}_Pur')
-        diff_col = get_column_index(ws, f'{insurance}_Diff$')
-
-        # Add autosum formula for each column
-        if t_col:
-            cell = ws.cell(row=end_row + 1, column=t_col)
-            cell.value = f"=SUM({get_column_letter(t_col)}{start_row}:{get_column_letter(t_col)}{end_row})"
-            cell.number_format = "#,##0"  # Format large numbers with commas
-            cell.font = Font(size=12, bold=False)
-            cell.alignment = Alignment(horizontal='center', vertical='center')
-
-        if pur_col:
-            cell = ws.cell(row=end_row + 1, column=pur_col)
-            cell.value = f"=SUM({get_column_letter(pur_col)}{start_row}:{get_column_letter(pur_col)}{end_row})"
-            cell.number_format = "#,##0.00"  # Format as currency or decimal
-            cell.font = Font(size=12, bold=False)
-            cell.alignment = Alignment(horizontal='center', vertical='center')
-
-        if diff_col:
-            cell = ws.cell(row=end_row + 1, column=diff_col)
-            cell.value = f"=SUM({get_column_letter(diff_col)}{start_row}:{get_column_letter(diff_col)}{end_row})"
-            cell.number_format = '"$"#,##0.00'  # Format as currency
-            cell.font = Font(size=12, bold=False)
-            cell.alignment = Alignment(horizontal='center', vertical='center')
+    # Column suffix and merged header title for each per-insurance column group
+    INSURANCE_GROUPS = [
+        ('Q', "Quantity Billed"),
+        ('P', "Package size Billed"),
+        ('D', "Package size Difference"),
+        ('T', "$$ Paid"),
+        ('Pur', "$$ Purchased"),
+        ('Diff$', "$$ Difference"),
+    ]
+
+    # Column suffix and number format of the autosum row for each insurance
+    AUTOSUM_FORMATS = [
+        ('T', "#,##0"),  # Format large numbers with commas
+        ('Pur', "#,##0.00"),  # Format as currency or decimal
+        ('Diff$', '"$"#,##0.00'),  # Format as currency
+    ]
+
+    def __init__(self, desired_columns, insurances, vendor_names):
+        self.columns = list(desired_columns)
+        self.insurances = list(insurances)
+        self.vendor_names = list(vendor_names)
+
+        self.column_indices = {header: col_idx for col_idx, header in enumerate(self.columns, start=1)}
+        self.column_letters = {header: get_column_letter(col_idx) for header, col_idx in self.column_indices.items()}
+
+        # Column indices of each per-insurance group, in insurance order
+        self.insurance_group_indices = {
+            suffix: [self.column_indices[f'{insurance}_{suffix}'] for insurance in self.insurances
+                     if f'{insurance}_{suffix}' in self.column_indices]
+            for suffix, _ in self.INSURANCE_GROUPS
+        }
+
+        # Cells in these columns are highlighted when negative
+        self.package_size_diff_columns = set(self.insurance_group_indices['D'])
+        self.dollar_diff_columns = set(self.insurance_group_indices['Diff$'])
+
+        # Merged headers in row 2 as (title, start column, end column)
+        self.group_ranges = []
+        for suffix, title in self.INSURANCE_GROUPS:
+            start_col = self.index(f'ALL_PBM_{suffix}')
+            if start_col is None:
+                raise ValueError(f"Header 'ALL_PBM_{suffix}' not found in the worksheet")
+            self.group_ranges.append((title, start_col, start_col + len(self.insurances) - 1))
+
+        total_purchased_col = self.index('Total Purchased')
+        if total_purchased_col is None:
+            raise ValueError("Header 'Total Purchased' not found in the worksheet")
+
+        # Column groups outlined with a thick border
+        self.border_groups = [
+            self.insurance_group_indices['Q'],
+            self.insurance_group_indices['P'],
+            self.insurance_group_indices['D'],
+            [total_purchased_col],
+            self.insurance_group_indices['T'],
+            self.insurance_group_indices['Pur'],
+            self.insurance_group_indices['Diff$'],
+        ]
+
+        # Autosum columns as (column index, number format)
+        self.autosum_targets = []
+        for insurance in self.insurances:
+            for suffix, number_format in self.AUTOSUM_FORMATS:
+                col_idx = self.index(f'{insurance}_{suffix}')
+                if col_idx:
+                    self.autosum_targets.append((col_idx, number_format))
+
+    def index(self, header_name):
+        # 1-based column index of a header, or None if the header is not in the sheet
+        return self.column_indices.get(header_name)
+
+    def letter(self, header_name):
+        # Column letter of a header, or None if the header is not in the sheet
+        return self.column_letters.get(header_name)
+
+def add_autosum(ws, layout, start_row, end_row):
+    # Add autosum for the _T, _Pur and _Diff$ columns of each insurance
+    for col_idx, number_format in layout.autosum_targets:
+        col_letter = get_column_letter(col_idx)
+        cell = ws.cell(row=end_row + 1, column=col_idx)
+        cell.value = f"=SUM({col_letter}{start_row}:{col_letter}{end_row})"
+        cell.number_format = number_format
+        cell.font = Font(size=12, bold=False)
+        cell.alignment = Alignment(horizontal='center', vertical='center')
                 
 def adjust_specific_columns(ws, columns_to_adjust):
     """
@@ -388,7 +1936,15 @@ def adjust_specific_columns(ws, columns_to_adjust):
                 pass
         ws.column_dimensions[col_letter].width = max_length  # Exact fit, no padding
         
-def add_max_difference_sheet(wb, final_data, insurance_paths):
+def get_needs_to_order(final_data):
+    """
+    Get the items that need to be ordered: billed more packages than purchased for any insurance except ALL_PBM.
+    Args:
+        final_data: The reconciled data.
+    Returns:
+        The items sorted by Drug Name, with the _D columns (positive values replaced with 0),
+        To Order, PRICE and Total Order Price, and the list of _D columns.
+    """
     # Identify all difference columns ending with '_D'
     difference_columns = [col for col in final_data.columns if col.endswith('_D') and col != 'ALL_PBM_D']
 
@@ -402,24 +1958,31 @@ def add_max_difference_sheet(wb, final_data, insurance_paths):
     # Filter rows where any of the selected `_D` columns have values less than 0
     needs_to_order = filtered_data[filtered_data[difference_columns].lt(0).any(axis=1)][['NDC #', 'Drug Name', 'Package Size'] + difference_columns + ['PRICE']].copy()
 
-    # Create a new sheet for maximum differences
-    ws_max_diff = wb.create_sheet(title="Needs to be ordered - All")
-    
-    if needs_to_order.empty:
-        print("No rows with negative values in the selected difference columns.")
-        return  # Return if no rows meet the condition
-
     # Ignore the negative sign and calculate the maximum absolute difference for each row
     needs_to_order['To Order'] = needs_to_order[difference_columns].abs().max(axis=1)
-    needs_to_order['Paper Work'] = " "
     # Calculate the total order price (Max Difference * PRICE)
     needs_to_order['Total Order Price'] = needs_to_order['To Order'] * needs_to_order['PRICE']
     needs_to_order.rename(columns={'Package Size': 'Pkg Size'}, inplace=True)
     # Select the columns to display
-    display_columns = ['NDC #', 'Drug Name', 'Pkg Size'] + difference_columns + ['To Order','Paper Work','PRICE', 'Total Order Price']
-    
+    display_columns = ['NDC #', 'Drug Name', 'Pkg Size'] + difference_columns + ['To Order', 'PRICE', 'Total Order Price']
+
     # Sort by Drug Name for better readability
     needs_to_order = needs_to_order[display_columns].sort_values(by='Drug Name')
+    return needs_to_order, difference_columns
+
+def add_max_difference_sheet(wb, final_data, insurance_paths):
+    needs_to_order, difference_columns = get_needs_to_order(final_data)
+
+    # Create a new sheet for maximum differences
+    ws_max_diff = wb.create_sheet(title="Needs to be ordered - All")
+    
+    if needs_to_order.empty:
+        print("No rows with negative values in the selected difference columns.")
+        return  # Return if no rows meet the condition
+
+    needs_to_order.insert(needs_to_order.columns.get_loc('PRICE'), 'Paper Work', " ")
+    needs_to_order = round_report_values(needs_to_order)
+    display_columns = list(needs_to_order.columns)
         
     # Set the header
     ws_max_diff.merge_cells(start_row=1, start_column=1, end_row=1, end_column=len(display_columns))
@@ -430,17 +1993,14 @@ def add_max_difference_sheet(wb, final_data, insurance_paths):
     ws_max_diff.row_dimensions[1].height = 30
     
     # Add the data to the sheet
+    drug_name_style = make_cell_style(wb, font=Font(size=12), alignment=Alignment(horizontal='left', vertical='center', wrap_text=True))
+    data_style = make_cell_style(wb, font=Font(size=12), alignment=Alignment(horizontal='center', vertical='center'))
+    drug_name_col = display_columns.index("Drug Name") + 1
     for r_idx, row in enumerate(dataframe_to_rows(needs_to_order, index=False, header=True), start=2):
         for c_idx, value in enumerate(row, start=1):
             
             cell = ws_max_diff.cell(row=r_idx, column=c_idx, value=value)
-            
-            if c_idx == display_columns.index("Drug Name") + 1:
-                cell.alignment = Alignment(horizontal='left', vertical='center', wrap_text=True)
-            else:
-                cell.alignment = Alignment(horizontal='center', vertical='center')
-
-            cell.font = Font(size=12)
+            cell._style = StyleArray(drug_name_style if c_idx == drug_name_col else data_style)
 
     # Set column width for "Paper Work"
     paper_work_col_idx = display_columns.index("Paper Work") + 1
@@ -459,10 +2019,8 @@ def add_max_difference_sheet(wb, final_data, insurance_paths):
 
     # Apply thick borders to column edges only
     def apply_column_border(ws, col_idx):
-        col_letter = get_column_letter(col_idx)
-        for row in ws.iter_rows(min_row=3, max_row=ws.max_row):
-            cell = ws[f"{col_letter}{row[0].row}"]
-            cell.border = Border(left=Side(style='thick'), right=Side(style='thick'))
+        cells = (ws.cell(row=row_idx, column=col_idx) for row_idx in range(3, ws.max_row + 1))
+        set_cells_border(cells, Border(left=Side(style='thick'), right=Side(style='thick')))
 
     # Apply thick borders to specific columns
     thick_border_columns = ['NDC #', 'Drug Name', 'Pkg Size', 'PRICE', 'To Order', 'Total Order Price','Paper Work']
@@ -523,7 +2081,15 @@ def add_max_difference_sheet(wb, final_data, insurance_paths):
     total_label_cell.alignment = Alignment(horizontal='center', vertical='center')
     total_value_cell.alignment = Alignment(horizontal='center', vertical='center')
 
-def min_difference_sheet(wb, final_data, insurance_paths):
+def get_do_not_order(final_data):
+    """
+    Get the items that should not be ordered: purchased more packages than billed for every insurance except ALL_PBM.
+    Args:
+        final_data: The reconciled data.
+    Returns:
+        The items sorted by Drug Name, with the _D columns (negative values replaced with 0) and
+        Min Positive, and the list of _D columns.
+    """
     # Identify all difference columns ending with '_D'
     difference_columns = [col for col in final_data.columns if col.endswith('_D') and col != 'ALL_PBM_D']
 
@@ -545,20 +2111,27 @@ def min_difference_sheet(wb, final_data, insurance_paths):
 
     #do_not_order = filtered_data[['NDC #', 'Drug Name', 'Package Size'] + difference_columns + ['Min Positive', 'PRICE']].copy()
 
-    # Create a new sheet for maximum differences
-    ws_max_diff = wb.create_sheet(title="Do Not Order - ALL")#Do Not Order - All
-    
-    if do_not_order.empty:
-        print("No rows with negative values in the selected difference columns.")
-        return  # Return if no rows meet the condition
-
-    do_not_order['Paper\nWork'] = " "
     do_not_order.rename(columns={'Package Size': 'Pkg Size'}, inplace=True)
     # Select the columns to display
-    display_columns = ['NDC #', 'Drug Name', 'Pkg Size'] + difference_columns + ['Min Positive', 'Paper\nWork']
-    
+    display_columns = ['NDC #', 'Drug Name', 'Pkg Size'] + difference_columns + ['Min Positive']
+
     # Sort by Drug Name for better readability
     do_not_order = do_not_order[display_columns].sort_values(by='Drug Name')
+    return do_not_order, difference_columns
+
+def min_difference_sheet(wb, final_data, insurance_paths):
+    do_not_order, difference_columns = get_do_not_order(final_data)
+
+    # Create a new sheet for maximum differences
+    ws_max_diff = wb.create_sheet(title="Do Not Order - ALL")#Do Not Order - All
+    
+    if do_not_order.empty:
+        print("No rows with negative values in the selected difference columns.")
+        return  # Return if no rows meet the condition
+
+    do_not_order['Paper\nWork'] = " "
+    do_not_order = round_report_values(do_not_order)
+    display_columns = list(do_not_order.columns)
         
     # Set the header
     ws_max_diff.merge_cells(start_row=1, start_column=1, end_row=1, end_column=len(display_columns))
@@ -569,16 +2142,14 @@ def min_difference_sheet(wb, final_data, insurance_paths):
     ws_max_diff.row_dimensions[1].height = 30
     
     # Add the data to the sheet
+    drug_name_style = make_cell_style(wb, font=Font(size=12), alignment=Alignment(horizontal='left', vertical='center', wrap_text=True))
+    data_style = make_cell_style(wb, font=Font(size=12), alignment=Alignment(horizontal='center', vertical='center'))
+    drug_name_col = display_columns.index("Drug Name") + 1
     for r_idx, row in enumerate(dataframe_to_rows(do_not_order, index=False, header=True), start=2):
         for c_idx, value in enumerate(row, start=1):
             
             cell = ws_max_diff.cell(row=r_idx, column=c_idx, value=value)
-            if c_idx == display_columns.index("Drug Name") + 1:
-                cell.alignment = Alignment(horizontal='left', vertical='center', wrap_text=True)
-            else:
-                cell.alignment = Alignment(horizontal='center', vertical='center')
-
-            cell.font = Font(size=12)
+            cell._style = StyleArray(drug_name_style if c_idx == drug_name_col else data_style)
 
     # Set column width for "Paper Work"
     paper_work_col_idx = display_columns.index("Paper\nWork") + 1
@@ -596,10 +2167,8 @@ def min_difference_sheet(wb, final_data, insurance_paths):
 
     # Apply thick borders to column edges only
     def apply_column_border(ws, col_idx):
-        col_letter = get_column_letter(col_idx)
-        for row in ws.iter_rows(min_row=3, max_row=ws.max_row):
-            cell = ws[f"{col_letter}{row[0].row}"]
-            cell.border = Border(left=Side(style='thick'), right=Side(style='thick'))
+        cells = (ws.cell(row=row_idx, column=col_idx) for row_idx in range(3, ws.max_row + 1))
+        set_cells_border(cells, Border(left=Side(style='thick'), right=Side(style='thick')))
 
     # Apply thick borders to specific columns
     thick_border_columns = ['NDC #', 'Drug Name', 'Pkg Size','Min Positive','Paper\nWork']
@@ -645,22 +2214,32 @@ def min_difference_sheet(wb, final_data, insurance_paths):
     # Adjust row height for row 2
     ws_max_diff.row_dimensions[2].height = 80
 
-# Main Function to Create "Never Ordered - Check" Sheet
-def create_never_ordered_check_sheet(wb, final_data):
+def get_never_ordered(final_data):
+    """
+    Get the items that were billed but never purchased (Total Purchased is 0).
+    Args:
+        final_data: The reconciled data.
+    Returns:
+        The items sorted by Drug Name, with Pkg Size, Total Purchased and the _P column of every insurance.
+    """
     # Filter rows where 'Total Purchased' is 0
     never_ordered_data = final_data[final_data['Total Purchased'] == 0]
 
     # Select the required columns and include quantity billed columns for all insurance paths
     insurance_columns = [col for col in final_data.columns if col.endswith('_P')]
     columns_to_select = ['Drug Name', 'NDC #', 'Package Size', 'Total Purchased'] + insurance_columns
-    never_ordered_data = never_ordered_data[columns_to_select]
-    never_ordered_data.rename(columns={'Package Size': 'Pkg Size'}, inplace=True)
+    never_ordered_data = never_ordered_data[columns_to_select].rename(columns={'Package Size': 'Pkg Size'})
+    return never_ordered_data.sort_values(by='Drug Name')
+
+# Main Function to Create "Never Ordered - Check" Sheet
+def create_never_ordered_check_sheet(wb, final_data):
+    never_ordered_data = get_never_ordered(final_data)
 
     if never_ordered_data.empty:
         print("No rows with Total Purchased = 0 to report.")
         return
 
-    never_ordered_data = never_ordered_data.sort_values(by='Drug Name')
+    never_ordered_data = round_report_values(never_ordered_data)
 
     # Create a new sheet in the workbook
     ws = wb.create_sheet(title="Never Ordered - Check")
@@ -674,17 +2253,15 @@ def create_never_ordered_check_sheet(wb, final_data):
     ws.row_dimensions[1].height = 30
 
     # Add the data to the sheet
+    drug_name_style = make_cell_style(wb, font=Font(size=12), alignment=Alignment(horizontal='left', vertical='center', wrap_text=True))
+    data_style = make_cell_style(wb, font=Font(size=12), alignment=Alignment(horizontal='center', vertical='center'))
     for r_idx, row in enumerate(dataframe_to_rows(never_ordered_data, index=False, header=True), start=2):
         for c_idx, value in enumerate(row, start=1):
             cell = ws.cell(row=r_idx, column=c_idx, value=value)
-            if c_idx == 1:  # Drug Name column
-                cell.alignment = Alignment(horizontal='left', vertical='center', wrap_text=True)
-            else:
-                cell.alignment = Alignment(horizontal='center', vertical='center')
-            cell.font = Font(size=12)
+            cell._style = StyleArray(drug_name_style if c_idx == 1 else data_style)  # Drug Name column
 
     # Apply thick borders to Row 2 (Header Row)
-    for col_idx in range(1, len(columns_to_select) + 1):
+    for col_idx in range(1, len(never_ordered_data.columns) + 1):
         cell = ws.cell(row=2, column=col_idx)
         cell.border = Border(
             top=Side(style='thick'),
@@ -695,10 +2272,8 @@ def create_never_ordered_check_sheet(wb, final_data):
 
     # Apply thick borders to specific columns
     def apply_column_border(ws, col_idx):
-        col_letter = get_column_letter(col_idx)
-        for row in ws.iter_rows(min_row=3, max_row=ws.max_row):
-            cell = ws[f"{col_letter}{row[0].row}"]
-            cell.border = Border(left=Side(style='thick'), right=Side(style='thick'))
+        cells = (ws.cell(row=row_idx, column=col_idx) for row_idx in range(3, ws.max_row + 1))
+        set_cells_border(cells, Border(left=Side(style='thick'), right=Side(style='thick')))
 
     thick_border_columns = ['Drug Name', 'NDC #', 'Pkg Size', 'Total Purchased']
     for col_name in thick_border_columns:
@@ -719,25 +2294,248 @@ def create_never_ordered_check_sheet(wb, final_data):
     #print("Sheet 'Never Ordered - Check' created successfully.")
 
        
-def process_files(insurance_paths, vendor_paths, conversion_path, pharmacy_name, date_range):
-    
-    dropped_data = []
+def read_bestrx_file(path):
+    # Read one BestRx export with the necessary columns
+    data = pd.read_excel(path, usecols=BESTRX_COLUMNS, dtype={'NDC': str})
+    print(f"Columns in {path}: {data.columns.tolist()}")
+    if 'Total' in data.columns:
+        data['Total'] = data['Total'].round(0)
+    return data
+
+def read_bestrx_data(insurance_paths):
     # Read data from BestRx software with NDC as string and necessary columns
     all_bestrx_data = []
     for insurance, path in insurance_paths.items():
-        data = pd.read_excel(path, usecols=['Drug Name', 'NDC #', 'Total Rxs', 'Quantity','Total'], dtype={'NDC': str})
-        print(f"Columns in {path}: {data.columns.tolist()}")
+        data = get_parsed_upload('bestrx', path)
         data['Insurance'] = insurance
         all_bestrx_data.append(data)
-
-        if 'Total' in data.columns:
-            data['Total'] = data['Total'].round(0)
     #combined_bestrx_data = pd.concat(all_bestrx_data)
     combined_bestrx_data = pd.concat(all_bestrx_data)
     #print("Combined BestRx Data:")
     #print(combined_bestrx_data.head())
     #print("Combined BestRx Data shape:", combined_bestrx_data.shape)
 
+    # Ensure NDC numbers are treated as strings and remove hyphens
+    combined_bestrx_data['NDC #'] = combined_bestrx_data['NDC #'].str.replace("-", "").str.zfill(11)
+    return combined_bestrx_data
+
+def get_vendor_extension(file):
+    # Extension to save a vendor upload with, .xlsx unless it is a known feed format
+    extension = os.path.splitext(file.filename or '')[1].lower()
+    return extension if extension in VENDOR_EXTENSIONS else '.xlsx'
+
+def read_file_head(file, size=512):
+    # First bytes of a path or file object, the file object is left at the start
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, 'rb') as f:
+            return f.read(size)
+    head = file.read(size)
+    file.seek(0)
+    return head if isinstance(head, bytes) else head.encode('latin-1')
+
+def get_vendor_format(file, vendor_name=None):
+    """
+    Get the reader format of a vendor file: 'excel', 'csv' or 'edi'.
+    VENDOR_FORMATS decides for known vendors, otherwise the file content does.
+    Args:
+        file: Path or file object of the vendor file.
+        vendor_name: Vendor name, defaults to the file name without extension for a path.
+    """
+    if vendor_name is None and isinstance(file, (str, os.PathLike)):
+        vendor_name = os.path.splitext(os.path.basename(file))[0]
+    vendor_format = app.config['VENDOR_FORMATS'].get((vendor_name or '').lower())
+    if vendor_format:
+        return vendor_format
+
+    head = read_file_head(file)
+    # xlsx is a zip package, xls an OLE compound document
+    if head.startswith(b'PK\x03\x04') or head.startswith(b'\xd0\xcf\x11\xe0'):
+        return 'excel'
+    if head.lstrip(b'\xef\xbb\xbf \t\r\n').startswith(b'ISA'):
+        return 'edi'
+    return 'csv'
+
+def read_vendor_excel(file):
+    return pd.read_excel(file, usecols=VENDOR_COLUMNS, dtype={'NDC #': str})
+
+def read_vendor_csv(file):
+    """
+    Read a vendor CSV export with the C parser, only the NDC and shipped quantity columns.
+    The delimiter (comma, tab, pipe or semicolon) is taken from the header line and the
+    columns are found by the names in VENDOR_COLUMN_ALIASES.
+    """
+    head = read_file_head(file, 4096).decode('latin-1')
+    header_line = head.splitlines()[0] if head else ''
+    delimiter = max([',', '\t', '|', ';'], key=header_line.count)
+    column_names = {alias: column for column, aliases in VENDOR_COLUMN_ALIASES.items() for alias in aliases}
+
+    vendor_data = pd.read_csv(file, sep=delimiter, dtype=str, encoding='utf-8-sig', encoding_errors='replace', skipinitialspace=True,
+                              usecols=lambda col: col.strip().lower() in column_names)
+    vendor_data = vendor_data.rename(columns=lambda col: column_names[col.strip().lower()])
+    # Keep the first matching column when an export has more than one alias of the same column
+    vendor_data = vendor_data.loc[:, ~vendor_data.columns.duplicated()]
+    missing_columns = [col for col in VENDOR_COLUMNS if col not in vendor_data.columns]
+    if missing_columns:
+        raise ValueError(f"no column for {', '.join(missing_columns)} in the header")
+
+    vendor_data = vendor_data[VENDOR_COLUMNS].dropna(subset=['NDC #'])
+    vendor_data['NDC #'] = vendor_data['NDC #'].str.strip()
+    vendor_data['Shipped'] = pd.to_numeric(vendor_data['Shipped'].str.replace(',', ''), errors='coerce')
+    return vendor_data
+
+def get_edi_ndc(elements):
+    # NDC among the (qualifier, product id) pairs of an IT1 or LIN segment
+    for qualifier, product_id in zip(elements[::2], elements[1::2]):
+        if qualifier in EDI_NDC_QUALIFIERS and product_id:
+            return product_id
+    return None
+
+def read_vendor_edi(file):
+    """
+    Read an X12 EDI 810 invoice or 856 ship notice.
+    810: one row per IT1 line with its invoiced quantity.
+    856: one row per SN1 with the shipped quantity of the item in the LIN before it.
+    The separators are taken from the fixed-width ISA segment.
+    Raises ValueError naming the file, the segment number and the value of a quantity that is not a number.
+    """
+    if isinstance(file, (str, os.PathLike)):
+        file_name = os.path.basename(file)
+        with open(file, 'rb') as f:
+            content = f.read()
+    else:
+        file_name = os.path.basename(getattr(file, 'name', None) or '') or 'the EDI file'
+        content = file.read()
+    if isinstance(content, bytes):
+        content = content.decode('latin-1')
+    content = content.lstrip('\ufeff \t\r\n')
+    if not content.startswith('ISA') or len(content) < 106:
+        raise ValueError("no ISA interchange header")
+    element_separator = content[3]
+    segment_terminator = content[105]
+
+    def get_quantity(segment_number, tag, value):
+        try:
+            return float(value or 0)
+        except ValueError:
+            raise ValueError(f"{file_name}, segment {segment_number} ({tag}): quantity '{value}' is not a number")
+
+    rows = []
+    item_ndc = None
+    for segment_number, segment in enumerate(content.split(segment_terminator), start=1):
+        elements = segment.strip().split(element_separator)
+        tag = elements[0]
+        if tag == 'IT1' and len(elements) > 2:
+            ndc = get_edi_ndc(elements[6:])
+            if ndc:
+                rows.append((ndc, get_quantity(segment_number, tag, elements[2])))
+        elif tag == 'HL':
+            item_ndc = None
+        elif tag == 'LIN':
+            item_ndc = get_edi_ndc(elements[2:])
+        elif tag == 'SN1' and item_ndc and len(elements) > 2:
+            rows.append((item_ndc, get_quantity(segment_number, tag, elements[2])))
+    return pd.DataFrame(rows, columns=VENDOR_COLUMNS)
+
+VENDOR_READERS = {
+    'excel': read_vendor_excel,
+    'csv': read_vendor_csv,
+    'edi': read_vendor_edi,
+}
+
+def read_vendor_file(vendor_path):
+    # Read one vendor file with the reader of its format, as NDC # and Shipped columns
+    return get_parsed_upload('vendor', vendor_path)
+
+# Background parses of single uploads by file id ("<reader>-<content hash>"), oldest first
+parsed_files = OrderedDict()
+parsed_files_lock = threading.Lock()
+parse_executor = None
+
+def get_upload_reader(slot, path):
+    # Reader of an upload: 'bestrx', 'conversion' or the vendor format
+    return get_vendor_format(path) if slot == 'vendor' else slot
+
+def parse_upload(reader, path):
+    # Parse one upload with its reader
+    started = time.monotonic()
+    if reader == 'bestrx':
+        data = read_bestrx_file(path)
+    elif reader == 'conversion':
+        data = load_conversion_data(path)
+    else:
+        data = VENDOR_READERS[reader](path)
+    return data, time.monotonic() - started
+
+def start_parse(slot, path):
+    """
+    Parse an upload in a background thread, unless the same content is already parsed or being parsed.
+    Conversion files go through load_conversion_data, so the master in memory is replaced ahead of the run.
+    Args:
+        slot: 'bestrx', 'vendor' or 'conversion'.
+        path: The saved upload, alone in its folder. The file is moved to uploads/parsed/<file id>,
+            or removed when the same content is already parsed with the same reader.
+    Returns:
+        The file id of the parse.
+    """
+    global parse_executor
+    reader = get_upload_reader(slot, path)
+    file_id = f'{reader}-{file_sha256(path)}'
+    evicted_files = []
+    with parsed_files_lock:
+        parsed_file = parsed_files.get(file_id)
+        if parsed_file is None or (parsed_file['future'].done() and parsed_file['future'].exception() is not None):
+            if parse_executor is None:
+                parse_executor = ThreadPoolExecutor(max_workers=app.config['PARSE_WORKERS'])
+            folder = os.path.join(app.config['UPLOAD_FOLDER'], 'parsed', file_id)
+            os.makedirs(folder, exist_ok=True)
+            parsed_path = os.path.join(folder, os.path.basename(path))
+            os.replace(path, parsed_path)
+            parsed_file = {'path': parsed_path, 'seconds': 0.0}
+            parsed_file['future'] = parse_executor.submit(finish_parse, parsed_file, reader, parsed_path)
+            parsed_files[file_id] = parsed_file
+        parsed_files.move_to_end(file_id)
+        while len(parsed_files) > app.config['PARSE_CACHE_SIZE']:
+            evicted_files.append(parsed_files.popitem(last=False))
+    shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+
+    # Outside the lock, a callback added to a finished future runs right away
+    for evicted_id, evicted in evicted_files:
+        evicted['future'].add_done_callback(lambda future, evicted_id=evicted_id: remove_parsed_folder(evicted_id))
+    return file_id
+
+def remove_parsed_folder(file_id):
+    # Remove the upload of an evicted parse once it is finished, unless the same file was chosen again meanwhile
+    with parsed_files_lock:
+        if file_id not in parsed_files:
+            shutil.rmtree(os.path.join(app.config['UPLOAD_FOLDER'], 'parsed', file_id), ignore_errors=True)
+
+def finish_parse(parsed_file, reader, path):
+    # Runs in the parse thread, keeps the parse time for the status
+    data, parsed_file['seconds'] = parse_upload(reader, path)
+    return data
+
+def get_parsed_upload(slot, path):
+    """
+    Get the rows of a BestRx or vendor file, from its background parse when the same content was
+    chosen in the form (waiting for the parse if it is still running), otherwise by reading it.
+    Returns:
+        The rows, a copy the caller may modify.
+    """
+    reader = get_upload_reader(slot, path)
+    if parsed_files:
+        with parsed_files_lock:
+            parsed_file = parsed_files.get(f'{reader}-{file_sha256(path)}')
+        if parsed_file is not None:
+            try:
+                data = parsed_file['future'].result()
+                print(f"Using the rows of {path} parsed in the background")
+                return data.copy()
+            except Exception:
+                # Read it again so a failure is reported like any other read error
+                pass
+    return parse_upload(reader, path)[0]
+
+def read_vendor_data(vendor_paths):
     # Read data from Kinray vendor with NDC as string and necessary columns
     #kinray_data = pd.read_excel(kinray_path, usecols=['NDC', 'Shipped'], dtype={'NDC': str})
     
@@ -746,7 +2544,7 @@ def process_files(insurance_paths, vendor_paths, conversion_path, pharmacy_name,
     all_vendor_data = []
     vendor_names=[]
     for vendor_index, vendor_path in enumerate(vendor_paths, start =1):
-        vendor_data = pd.read_excel(vendor_path, usecols=['NDC #', 'Shipped'], dtype={'NDC #': str})
+        vendor_data = read_vendor_file(vendor_path)
         vendor_data['Vendor'] = f'Vendor{vendor_index}'
         all_vendor_data.append(vendor_data)
         vendor_names.append(f'Vendor{vendor_index}')
@@ -758,9 +2556,12 @@ def process_files(insurance_paths, vendor_paths, conversion_path, pharmacy_name,
     #print(combined_vendor_data.head())
     #print("Combined Vendor Data shape:", combined_vendor_data.shape)
 
+    combined_vendor_data['NDC #'] = combined_vendor_data['NDC #'].str.replace("-", "").str.zfill(11)
+    return combined_vendor_data, vendor_names
+
+def read_conversion_data(conversion_path):
     # Read the conversion data with NDC and package size
-    conversion_columns = ['DRUG NAME', 'ITEM NO', 'NDC #', 'PKG SIZE','PRICE']
-    conversion_data = pd.read_excel(conversion_path, usecols=conversion_columns, dtype={'NDC #': str})
+    conversion_data = pd.read_excel(conversion_path, usecols=CONVERSION_COLUMNS, dtype={'NDC #': str})
     if 'PRICE' in conversion_data.columns:
         conversion_data['PRICE'] = conversion_data['PRICE'].round(0)
 
@@ -768,13 +2569,111 @@ def process_files(insurance_paths, vendor_paths, conversion_path, pharmacy_name,
     #print(conversion_data.head())
     #print("Conversion Data shape:", conversion_data.shape)
     
-    # Ensure NDC numbers are treated as strings and remove hyphens
-    combined_bestrx_data['NDC #'] = combined_bestrx_data['NDC #'].str.replace("-", "").str.zfill(11)
-    combined_vendor_data['NDC #'] = combined_vendor_data['NDC #'].str.replace("-", "").str.zfill(11)
     conversion_data['NDC #'] = conversion_data['NDC #'].str.replace("-", "").str.zfill(11)
+    return conversion_data
 
-    
+# Parsed conversion master kept in memory, reloaded only when the file changes
+master_cache = {}
+master_cache_lock = threading.Lock()
 
+def load_conversion_data(conversion_path):
+    """
+    Get the parsed conversion data, reusing the copy in memory when the file has not changed.
+    The file size and modification time are checked first. When they changed the content hash
+    decides, so uploading the same master again does not parse it again.
+    The returned data frame is shared, it must not be modified.
+    """
+    conversion_path = os.path.abspath(conversion_path)
+    stat = os.stat(conversion_path)
+    file_state = (conversion_path, stat.st_size, stat.st_mtime_ns)
+    with master_cache_lock:
+        if master_cache.get('file_state') == file_state:
+            return master_cache['conversion_data']
+
+        content_hash = file_sha256(conversion_path)
+        if master_cache.get('content_hash') == content_hash:
+            master_cache['file_state'] = file_state
+            return master_cache['conversion_data']
+
+        conversion_data = read_conversion_data(conversion_path)
+        master_cache.update({
+            'file_state': file_state,
+            'content_hash': content_hash,
+            'conversion_data': conversion_data,
+            'index': None,
+            'loaded_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+        })
+        print(f"Loaded conversion master {conversion_path} ({len(conversion_data)} rows)")
+        return conversion_data
+
+def apply_master_edits(conversion_data, edits):
+    """
+    Get a copy of the conversion data with some rows changed, for what-if runs.
+    Args:
+        conversion_data: The conversion data, it is not modified.
+        edits: List of dicts with the 'NDC #' of a row and new values for any of the other CONVERSION_COLUMNS.
+            An NDC that is not in the master is added, so a missing item can be tried out too.
+    Returns:
+        The edited copy, or the conversion data itself when there are no edits.
+    """
+    if not edits:
+        return conversion_data
+    conversion_data = conversion_data.copy()
+    for edit in edits:
+        unknown_columns = [col for col in edit if col not in CONVERSION_COLUMNS]
+        if unknown_columns:
+            raise ValueError(f"Unknown master columns: {', '.join(unknown_columns)}")
+        if not edit.get('NDC #'):
+            raise ValueError("Every master edit needs an 'NDC #'")
+        values = dict(edit, **{'NDC #': str(edit['NDC #']).replace("-", "").zfill(11)})
+        try:
+            for col in ['PKG SIZE', 'PRICE']:
+                if col in values:
+                    values[col] = float(values[col])
+        except (TypeError, ValueError):
+            raise ValueError(f"PKG SIZE and PRICE of NDC {values['NDC #']} must be numbers")
+        if values.get('PKG SIZE', 1) <= 0:
+            raise ValueError(f"PKG SIZE of NDC {values['NDC #']} must be positive")
+        if 'PKG SIZE' in values and values['PKG SIZE'].is_integer():
+            values['PKG SIZE'] = int(values['PKG SIZE'])
+        if 'PRICE' in values:
+            # Rounded like the prices read from the master file
+            values['PRICE'] = float(round(values['PRICE']))
+
+        rows = conversion_data['NDC #'] == values['NDC #']
+        if rows.any():
+            for col, value in values.items():
+                # where changes the column's type when the value needs it, such as a text ITEM NO
+                conversion_data[col] = conversion_data[col].where(~rows, value)
+        else:
+            conversion_data = pd.concat([conversion_data, pd.DataFrame([values])], ignore_index=True)
+    return conversion_data
+
+def get_master_index(conversion_data):
+    # Trigram index of the conversion data, built once for the master kept in memory
+    with master_cache_lock:
+        if master_cache.get('conversion_data') is conversion_data:
+            if master_cache['index'] is None:
+                master_cache['index'] = MasterNameIndex(conversion_data)
+            return master_cache['index']
+    return MasterNameIndex(conversion_data)
+
+def reconcile_data(combined_bestrx_data, combined_vendor_data, vendor_names, conversion_data, insurance_names, group_keys=None):
+    """
+    Aggregate the BestRx and vendor data and reconcile billed against purchased packages.
+    Args:
+        combined_bestrx_data: BestRx rows of all insurances, with an Insurance column.
+        combined_vendor_data: Vendor rows of all vendors, with a Vendor column.
+        vendor_names: The vendor column names.
+        conversion_data: The conversion/master data.
+        insurance_names: The insurance names.
+        group_keys: Optional extra columns (such as Period) present in both the BestRx and
+            vendor rows. The reconciliation is done separately for each value of these columns.
+    Returns:
+        The reconciled data (one row per NDC and drug name) and the missing items.
+    """
+    group_keys = list(group_keys or [])
+    insurance_names = list(insurance_names)
     # Create a mapping for item number and package sizes
     item_no_mapping = conversion_data.set_index('NDC #')['ITEM NO'].to_dict()
     pkg_size_mapping = conversion_data.set_index('NDC #')['PKG SIZE'].to_dict()
@@ -792,7 +2691,7 @@ def process_files(insurance_paths, vendor_paths, conversion_path, pharmacy_name,
 
 
     # Aggregate the number of used bottles for each NDC in combined BestRx data
-    bestrx_aggregated = combined_bestrx_data.groupby(['NDC #', 'Drug Name', 'Insurance']).agg({'Package size': 'sum', 'Quantity':'sum', 'Total': 'sum'}).reset_index()
+    bestrx_aggregated = combined_bestrx_data.groupby(group_keys + ['NDC #', 'Drug Name', 'Insurance']).agg({'Package size': 'sum', 'Quantity':'sum', 'Total': 'sum'}).reset_index()
     bestrx_aggregated = bestrx_aggregated.sort_values(by='Drug Name')
     #bestrx_aggregated = combined_bestrx_data.groupby(['NDC', 'Drug Name']).agg({'Package size': 'sum', 'Quantity':'sum'}).reset_index()
     #print("BestRx Aggregated Data:")
@@ -803,12 +2702,12 @@ def process_files(insurance_paths, vendor_paths, conversion_path, pharmacy_name,
     #kinray_aggregated = kinray_filtered.groupby('NDC')['Shipped'].sum().reset_index()
     #combined_vendor_data['Shipped'].fillna(0, inplace=True)
     combined_vendor_data['Shipped'] = combined_vendor_data['Shipped'].fillna(0)
-    vendor_aggregated = combined_vendor_data.groupby(['NDC #', 'Vendor']).agg({'Shipped': 'sum'}).reset_index()
+    vendor_aggregated = combined_vendor_data.groupby(group_keys + ['NDC #', 'Vendor']).agg({'Shipped': 'sum'}).reset_index()
     #print("Vendor Aggregated Data:")
     #print(vendor_aggregated.head())
 
     
-    vendor_pivot = vendor_aggregated.pivot(index='NDC #', columns='Vendor', values='Shipped').fillna(0).reset_index()
+    vendor_pivot = vendor_aggregated.pivot(index=group_keys + ['NDC #'], columns='Vendor', values='Shipped').fillna(0).reset_index()
     #print("Vendor Pivot Data:")
     #print(vendor_pivot.head())
 
@@ -818,7 +2717,7 @@ def process_files(insurance_paths, vendor_paths, conversion_path, pharmacy_name,
     #print(vendor_pivot.head())
     
     # Merge the aggregated BestRx and Kinray data on NDC number
-    merged_data = pd.merge(bestrx_aggregated, vendor_pivot, on='NDC #', how='left')
+    merged_data = pd.merge(bestrx_aggregated, vendor_pivot, on=group_keys + ['NDC #'], how='left')
     #print("Merged Data:")
     #print(merged_data.head())
 
@@ -826,6 +2725,8 @@ def process_files(insurance_paths, vendor_paths, conversion_path, pharmacy_name,
     for vendor in vendor_names:
         if vendor in merged_data.columns:
             merged_data[vendor] = pd.to_numeric(merged_data[vendor], errors='coerce').fillna(0)
+        else:
+            merged_data[vendor] = 0.0
             
     merged_data['Total Purchased'] = merged_data[vendor_names].sum(axis=1)
     
@@ -834,8 +2735,11 @@ def process_files(insurance_paths, vendor_paths, conversion_path, pharmacy_name,
     #merged_data['Total Purchased'] = merged_data['Shipped']
 
     # Pivot to create columns for each insurance company's difference
-    pivot_data = merged_data.pivot_table(index=['NDC #', 'Drug Name'], columns='Insurance', values=['Package size', 'Quantity', 'Total'], aggfunc='sum').fillna(0).infer_objects()
+    pivot_data = merged_data.pivot_table(index=group_keys + ['NDC #', 'Drug Name'], columns='Insurance', values=['Package size', 'Quantity', 'Total'], aggfunc='sum').fillna(0).infer_objects()
     pivot_data.columns = [f'{col[1]}_{col[0][0].upper()}' for col in pivot_data.columns]
+    # Keep a column for every insurance even when it has no rows here, in the same order as the pivot
+    pivot_insurances = sorted(set(insurance_names) | set(merged_data['Insurance']))
+    pivot_data = pivot_data.reindex(columns=[f'{insurance}_{suffix}' for suffix in ['P', 'Q', 'T'] for insurance in pivot_insurances], fill_value=0)
     pivot_data = pivot_data.reset_index()
      
     # Print column names after pivot
@@ -843,7 +2747,7 @@ def process_files(insurance_paths, vendor_paths, conversion_path, pharmacy_name,
     #print(pivot_data.columns)
 
      # Merge pivot data with total purchased
-    final_data = pd.merge(pivot_data, merged_data[['NDC #', 'Total Purchased'] + vendor_names], on='NDC #', how='left').fillna(0)
+    final_data = pd.merge(pivot_data, merged_data[group_keys + ['NDC #', 'Total Purchased'] + vendor_names], on=group_keys + ['NDC #'], how='left').fillna(0)
 
     #print("Final Data Before Dropping Duplicates:")
     #print(final_data.head())
@@ -854,17 +2758,17 @@ def process_files(insurance_paths, vendor_paths, conversion_path, pharmacy_name,
     final_data['Package Size'] = final_data['NDC #'].map(pkg_size_mapping)
 
     # Calculate differences for each insurance
-    for insurance in insurance_paths.keys():
+    for insurance in insurance_names:
         final_data[f'{insurance}_D'] = final_data['Total Purchased'] - final_data.get(f'{insurance}_P', 0)
 
     price_mapping = conversion_data.set_index('NDC #')['PRICE'].to_dict()
     final_data['PRICE'] = final_data['NDC #'].map(price_mapping)  # Add price column to the final data
     final_data['Total Order Price'] = abs(final_data['CVS_D']) * final_data['PRICE']  # Calculate the order price
 
-    for insurance in insurance_paths.keys():
+    for insurance in insurance_names:
         final_data[f'{insurance}_Pur'] = final_data.get(f'{insurance}_P', 0) * final_data['PRICE']
 
-    for insurance in insurance_paths.keys():
+    for insurance in insurance_names:
         final_data[f'{insurance}_Diff$'] = final_data.get(f'{insurance}_T', 0) - final_data.get(f'{insurance}_Pur', 0)
 
     
@@ -872,9 +2776,73 @@ def process_files(insurance_paths, vendor_paths, conversion_path, pharmacy_name,
     #print(final_data.columns)
     
     
-    #Excel 
-    
-    
+    initial_row_count = final_data.shape[0]
+    final_data = final_data.drop_duplicates(subset=group_keys + ['NDC #', 'Drug Name'])
+
+    # Check for dropped rows
+    if initial_row_count != final_data.shape[0]:
+        print(f"Dropped {initial_row_count - final_data.shape[0]} duplicate rows")
+
+    return final_data, missing_items
+
+def get_ndc_shards(ndcs, shard_count):
+    # Stable shard number of each NDC, the same NDC always lands in the same shard
+    return pd.util.hash_pandas_object(ndcs, index=False).to_numpy() % shard_count
+
+def reconcile_data_parallel(combined_bestrx_data, combined_vendor_data, vendor_names, conversion_data, insurance_names, group_keys=None, workers=None):
+    """
+    Same as reconcile_data, with the work split across worker processes.
+    The BestRx, vendor and conversion rows are hash-partitioned by NDC, so every shard holds
+    all rows of its NDCs and can be reconciled on its own. The shard results are put back in
+    the order the serial path produces, so the result is identical.
+    Args:
+        workers: Number of worker processes, defaults to AGGREGATION_WORKERS.
+    Returns:
+        The reconciled data and the missing items.
+    """
+    workers = workers or app.config['AGGREGATION_WORKERS']
+    group_keys = list(group_keys or [])
+    insurance_names = list(insurance_names)
+
+    # Row positions are used to restore the serial order of the missing items, then their own index
+    bestrx_index = combined_bestrx_data.index
+    combined_bestrx_data = combined_bestrx_data.reset_index(drop=True)
+
+    bestrx_shards = get_ndc_shards(combined_bestrx_data['NDC #'], workers)
+    vendor_shards = get_ndc_shards(combined_vendor_data['NDC #'], workers)
+    conversion_shards = get_ndc_shards(conversion_data['NDC #'], workers)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(
+                reconcile_data,
+                combined_bestrx_data[bestrx_shards == shard],
+                combined_vendor_data[vendor_shards == shard],
+                vendor_names,
+                conversion_data[conversion_shards == shard],
+                insurance_names,
+                group_keys,
+            )
+            for shard in range(workers)
+            if (bestrx_shards == shard).any()
+        ]
+        shard_results = [future.result() for future in futures]
+
+    final_data = pd.concat([shard_final_data for shard_final_data, _ in shard_results])
+    final_data = final_data.sort_values(by=group_keys + ['NDC #', 'Drug Name'], kind='stable').reset_index(drop=True)
+    # Restore the serial index, the position of each row in the serial merge. Every row of an NDC is merged
+    # once for each drug name and insurance of that NDC, and only the first copy is kept.
+    key_columns = group_keys + ['NDC #']
+    merged_rows = combined_bestrx_data.groupby(key_columns + ['Drug Name', 'Insurance']).size().groupby(level=key_columns).size()
+    row_counts = final_data[key_columns].merge(merged_rows.rename('rows').reset_index(), on=key_columns, how='left')['rows']
+    final_data.index = (row_counts.cumsum() - row_counts).to_numpy()
+    missing_items = pd.concat([shard_missing_items for _, shard_missing_items in shard_results]).sort_index()
+    missing_items.index = bestrx_index[missing_items.index]
+    return final_data, missing_items
+
+def get_report_columns(insurance_names, vendor_names):
+    # Columns of the "Processed Data" sheet, in order
+    insurance_names = list(insurance_names)
     desired_columns = [
     'Item Number',
     'NDC #', 
@@ -883,58 +2851,265 @@ def process_files(insurance_paths, vendor_paths, conversion_path, pharmacy_name,
 ] + vendor_names + [
     'Total Purchased'
 ] + \
-[f'{insurance}_Q' for insurance in insurance_paths.keys()] + \
-[f'{insurance}_P' for insurance in insurance_paths.keys()] + \
-[f'{insurance}_D' for insurance in insurance_paths.keys()] + \
-[f'{insurance}_T' for insurance in insurance_paths.keys()] + \
-[f'{insurance}_Pur' for insurance in insurance_paths.keys()] +\
-[f'{insurance}_Diff$' for insurance in insurance_paths.keys()]
-    initial_row_count = final_data.shape[0]
-
+[f'{insurance}_Q' for insurance in insurance_names] + \
+[f'{insurance}_P' for insurance in insurance_names] + \
+[f'{insurance}_D' for insurance in insurance_names] + \
+[f'{insurance}_T' for insurance in insurance_names] + \
+[f'{insurance}_Pur' for insurance in insurance_names] +\
+[f'{insurance}_Diff$' for insurance in insurance_names]
+    return desired_columns
+
+def set_print_setup(ws, orientation=None, centered=False):
+    # Print settings of the report sheets: the title rows repeat on every page, page numbers in the footer, one page wide
+    if orientation:
+        ws.page_setup.orientation = orientation
+    ws.print_title_rows = '1:2'
+    ws.oddFooter.left.text = "Page &P of &N"
+    ws.oddFooter.left.size = 8  # Font size for footer
+    ws.oddFooter.left.font = "Arial,Bold"
+    ws.page_margins = PageMargins(left=0, right=0, top=0, bottom=0, header=0, footer=0.1)
+    ws.sheet_properties.pageSetUpPr.fitToPage = True
+    ws.page_setup.fitToWidth = 1
+    ws.page_setup.fitToHeight = 0
+    if centered:
+        ws.print_options.horizontalCentered = True
+        ws.print_options.verticalCentered = True
+    ws.print_options.gridLines = True
+
+def finish_sheet(sheet, pharmacy_name, date_range, report_layout='wide'):
+    # Final formatting of a report sheet: title, row heights and print settings.
+    # The values are rounded in the frames before they are written.
+    # Set the title in the first row based on the sheet title
+    orientation = None
+    if sheet.title == "Processed Data":
+        sheet.cell(row=1, column=1).value = f"{pharmacy_name} ({date_range})"
+        cell = sheet.cell(row=1, column=1)
+        cell.alignment = Alignment(horizontal='center', vertical='center')
+        cell.font = Font(size=35, bold=True)
+        set_default_row_height(sheet, PROCESSED_DATA_FIRST_ROWS[report_layout])
+        orientation = "landscape"
+    elif sheet.title == "Needs to be Ordered":
+        sheet.cell(row=1, column=1).value = f"{pharmacy_name} ({date_range}) - NTO CVS"
+        cell = sheet.cell(row=1, column=1)
+        cell.alignment = Alignment(horizontal='center', vertical='center')
+        cell.font = Font(size=25, bold=True)
+        set_default_row_height(sheet, 2)
+        orientation = "landscape"
+    elif sheet.title == "Missing Items":
+        sheet.cell(row=1, column=1).value = f"{pharmacy_name} ({date_range}) - Missing items, To be updated in master file"
+        cell = sheet.cell(row=1, column=1)
+        cell.alignment = Alignment(horizontal='center', vertical='center')
+        cell.font = Font(size=15, bold=True)
+        set_default_row_height(sheet, 2)
+        orientation = "landscape"
+    elif sheet.title == "Do Not Order CVS":
+        sheet.cell(row=1, column=1).value = f"{pharmacy_name} ({date_range}) - DNO CVS"
+        cell = sheet.cell(row=1, column=1)
+        cell.alignment = Alignment(horizontal='center', vertical='center')
+        cell.font = Font(size=25, bold=True)
+        set_default_row_height(sheet, 2)
+        orientation = "landscape"
+
+    elif sheet.title == "Needs to be ordered - All":
+        sheet.cell(row=1, column=1).value = f"{pharmacy_name} ({date_range}) - Needs to ordered - ALL"
+        cell = sheet.cell(row=1, column=1)
+        cell.alignment = Alignment(horizontal='center', vertical='center')
+        cell.font = Font(size=25, bold=True)
+        set_default_row_height(sheet, 3)
+        orientation = "landscape"
+            
+    elif sheet.title == "Do Not Order - ALL":#Do Not Order - All
+        sheet.cell(row=1, column=1).value = f"{pharmacy_name} ({date_range})-Do Not Order"
+        cell = sheet.cell(row=1, column=1)
+        cell.alignment = Alignment(horizontal='center', vertical='center')
+        cell.font = Font(size=25, bold=True)
+        set_default_row_height(sheet, 3)
+        orientation = "portrait"
 
-    #print(type(final_data))
-    #print(final_data[-1])
-    #print(final_data)
-    final_data = final_data.drop_duplicates(subset=['NDC #', 'Drug Name'])
+    elif sheet.title == "Never Ordered  - Check":
+        sheet.cell(row=1, column=1).value = f"{pharmacy_name} ({date_range})-Never Ordered Package - Check"
+        cell = sheet.cell(row=1, column=1)
+        cell.alignment = Alignment(horizontal='center', vertical='center')
+        cell.font = Font(size=25, bold=True)
+        set_default_row_height(sheet, 3)
 
-    # Sort the final data by Drug Name in ascending order
-    sorted_data = final_data[desired_columns].sort_values(by='Drug Name')
+        orientation = "landscape"
 
-   #with open('final_data.csv', 'w', newline='', encoding='utf-8') as file:
-        #writer = csv.writer(file)
-        #writer.writerows(sorted_data)
-        #file.write(sorted_data)
+    set_print_setup(sheet, orientation, centered=True)
 
-    #print("sorted data")    
-    #print(sorted_data)
-    #print(sorted_data[-1])
-    # Check for dropped rows after sorting
-    sorted_row_count = sorted_data.shape[0]
-    if initial_row_count != sorted_row_count:
-        dropped_data.append(('sorted_data', initial_row_count - sorted_row_count))
+# Helper sheets in workbook order, each built independently from final_data/missing_items
+AUX_SHEETS = ['needs_to_order', 'do_not_order', 'missing_items', 'never_ordered']
 
-    
-    #Save the sorted data to a new Excel file
-    output_file = os.path.join(os.path.expanduser('~'), 'Downloads', f'{pharmacy_name} ({date_range}).xlsx')
-
-    sorted_data.to_excel(output_file, index=False, float_format="%.3f")
-    print(f"Processed file saved at: {output_file}")  # Debugging line
+def build_aux_sheet(aux_sheet, final_data, missing_items, conversion_data, insurance_names, pharmacy_name, date_range):
+    """
+    Build one helper sheet in a workbook of its own and return it as sheet parts.
+    Runs in a worker process; the parts are put into the report workbook with import_sheet_part.
+    """
+    wb = Workbook()
+    wb.remove(wb.active)
+    if aux_sheet == 'needs_to_order':
+        add_max_difference_sheet(wb, final_data, insurance_names)
+    elif aux_sheet == 'do_not_order':
+        min_difference_sheet(wb, final_data, insurance_names)
+    elif aux_sheet == 'missing_items':
+        add_missing_items_sheet(wb, missing_items, conversion_data)
+    elif aux_sheet == 'never_ordered':
+        create_never_ordered_check_sheet(wb, final_data)
 
-    written_data = pd.read_excel(output_file)
-    if not os.path.exists(output_file):
-        raise FileNotFoundError(f"Processed file not found at {output_file}")
+    for sheet in wb.worksheets:
+        finish_sheet(sheet, pharmacy_name, date_range)
+    return [export_sheet_part(sheet) for sheet in wb.worksheets]
 
+def export_sheet_part(ws):
+    """
+    Get a worksheet as plain data that can be sent between processes.
+    Cell styles are kept as indexes into the style tables of the source workbook, which are
+    sent along so the receiving workbook can map them to its own tables.
+    Raises ValueError for a sheet with features that are not carried over, such as conditional
+    formatting or data validation, rather than leaving them out of the report.
+    """
+    wb = ws.parent
+    cells = []
+    unsupported = set()
+    for cell in ws._cells.values():
+        if cell.hyperlink is not None:
+            unsupported.add("hyperlinks")
+        if cell.comment is not None:
+            unsupported.add("comments")
+        cells.append((cell.row, cell.column, None if isinstance(cell, MergedCell) else cell._value, cell.data_type,
+                      tuple(cell._style) if cell._style is not None else None))
+    if ws.conditional_formatting:
+        unsupported.add("conditional formatting")
+    if ws.data_validations.dataValidation:
+        unsupported.add("data validation")
+    if ws.auto_filter.ref:
+        unsupported.add("an auto filter")
+    if unsupported:
+        raise ValueError(f"Sheet '{ws.title}' uses {', '.join(sorted(unsupported))}, which cannot be sent between processes")
+
+    return {
+        'title': ws.title,
+        'cells': cells,
+        'fonts': list(wb._fonts),
+        'fills': list(wb._fills),
+        'borders': list(wb._borders),
+        'alignments': list(wb._alignments),
+        'protections': list(wb._protections),
+        'number_formats': list(wb._number_formats),
+        'merged_cells': [str(merged_range) for merged_range in ws.merged_cells.ranges],
+        'column_dimensions': {col_letter: (dimension.width, dimension.hidden) for col_letter, dimension in ws.column_dimensions.items()},
+        'row_dimensions': {
+            row_idx: (dimension.height, dimension.hidden)
+            for row_idx, dimension in ws.row_dimensions.items()
+            if dimension.height is not None or dimension.hidden
+        },
+        'sheet_format': ws.sheet_format,
+        'freeze_panes': ws.freeze_panes,
+        'print_title_rows': ws.print_title_rows,
+        'page_setup': {
+            'orientation': ws.page_setup.orientation,
+            'fitToWidth': ws.page_setup.fitToWidth,
+            'fitToHeight': ws.page_setup.fitToHeight,
+        },
+        'fit_to_page': ws.sheet_properties.pageSetUpPr.fitToPage if ws.sheet_properties.pageSetUpPr else None,
+        'page_margins': ws.page_margins,
+        'print_options': ws.print_options,
+        'odd_footer': ws.oddFooter,
+        'show_grid_lines': ws.sheet_view.showGridLines,
+    }
 
-    
-    #Set column widths using openpyxl
-    wb = load_workbook(output_file)
+def get_style_mapper(wb, sheet_part):
+    # Function that maps a style of an exported sheet part to a StyleArray of the workbook's style tables
+    fonts = [wb._fonts.add(font) for font in sheet_part['fonts']]
+    fills = [wb._fills.add(fill) for fill in sheet_part['fills']]
+    borders = [wb._borders.add(border) for border in sheet_part['borders']]
+    alignments = [wb._alignments.add(alignment) for alignment in sheet_part['alignments']]
+    protections = [wb._protections.add(protection) for protection in sheet_part['protections']]
+    custom_number_formats = [wb._number_formats.add(number_format) + BUILTIN_FORMATS_MAX_SIZE for number_format in sheet_part['number_formats']]
+
+    def map_style(style):
+        font_id, fill_id, border_id, number_format_id, protection_id, alignment_id = style[:6]
+        if number_format_id >= BUILTIN_FORMATS_MAX_SIZE:
+            number_format_id = custom_number_formats[number_format_id - BUILTIN_FORMATS_MAX_SIZE]
+        return StyleArray([fonts[font_id], fills[fill_id], borders[border_id], number_format_id,
+                           protections[protection_id], alignments[alignment_id]] + list(style[6:]))
+    return map_style
+
+def import_sheet_part(wb, sheet_part):
+    # Add a worksheet exported with export_sheet_part to the workbook, mapping its styles to the workbook's style tables
+    ws = wb.create_sheet(title=sheet_part['title'])
+    map_style = get_style_mapper(wb, sheet_part)
+
+    # Merge first, the merged cells keep their own styles below
+    for merged_range in sheet_part['merged_cells']:
+        ws.merge_cells(merged_range)
+
+    for row_idx, col_idx, value, data_type, style in sheet_part['cells']:
+        cell = ws.cell(row=row_idx, column=col_idx)
+        if not isinstance(cell, MergedCell):
+            cell._value = value
+            cell.data_type = data_type
+        if style is not None:
+            cell._style = map_style(style)
+
+    for col_letter, (width, hidden) in sheet_part['column_dimensions'].items():
+        ws.column_dimensions[col_letter].width = width
+        ws.column_dimensions[col_letter].hidden = hidden
+    for row_idx, (height, hidden) in sheet_part['row_dimensions'].items():
+        ws.row_dimensions[row_idx].height = height
+        ws.row_dimensions[row_idx].hidden = hidden
+    ws.sheet_format = sheet_part['sheet_format']
+
+    ws.freeze_panes = sheet_part['freeze_panes']
+    if sheet_part['print_title_rows']:
+        ws.print_title_rows = sheet_part['print_title_rows']
+    ws.page_setup.orientation = sheet_part['page_setup']['orientation']
+    ws.page_setup.fitToWidth = sheet_part['page_setup']['fitToWidth']
+    ws.page_setup.fitToHeight = sheet_part['page_setup']['fitToHeight']
+    ws.sheet_properties.pageSetUpPr.fitToPage = sheet_part['fit_to_page']
+    ws.page_margins = sheet_part['page_margins']
+    ws.print_options = sheet_part['print_options']
+    ws.oddFooter = sheet_part['odd_footer']
+    ws.sheet_view.showGridLines = sheet_part['show_grid_lines']
+    return ws
+
+# Styled "Processed Data" skeletons by (insurance names, vendor names), least recently used first
+sheet_templates = OrderedDict()
+sheet_templates_lock = threading.Lock()
+
+def build_wide_sheet_template(insurance_names, vendor_names):
+    """
+    Build the styled skeleton of the "Processed Data" sheet for one insurance/vendor combination.
+    The sheet formatting runs once over a few prototype rows, chosen so that every style a
+    data cell can get shows up: plain, red (negative difference) and blue (in a row with a
+    negative package size difference). Runs then only stream their rows into the skeleton.
+    Returns:
+        A dict with the title and header rows as a sheet part (see export_sheet_part), the plain,
+        red and blue style of every column, the columns with a thick outline and the sheet layout.
+    """
+    desired_columns = get_report_columns(insurance_names, vendor_names)
+    layout = SheetLayout(desired_columns, insurance_names, vendor_names)
+
+    # Row 4 plain, row 5 red differences in a blue row, rows 6 and 7 blue differences.
+    # Row 8 gets the thick bottom border, which is added to the real last row instead.
+    first_diff_col = layout.insurance_group_indices['D'][0]
+    last_diff_col = layout.insurance_group_indices['D'][-1]
+    negative_columns = layout.package_size_diff_columns | layout.dollar_diff_columns
+    prototype_rows = [[0] * len(desired_columns) for _ in range(5)]
+    for col_idx in negative_columns:
+        prototype_rows[1][col_idx - 1] = -1
+    prototype_rows[2][first_diff_col - 1] = -1
+    prototype_rows[3][last_diff_col - 1] = -1
+
+    prototype_file = BytesIO()
+    pd.DataFrame(prototype_rows, columns=desired_columns).to_excel(prototype_file, index=False, float_format="%.3f")
+    wb = load_workbook(prototype_file)
     ws = wb.active
     
 
-    # Merge the first row and set the pharmacy name and date range in the center
+    # Merge the first row, the pharmacy name and date range are set in the center for each run
     ws.merge_cells(start_row=1, start_column=1, end_row=1, end_column=len(desired_columns))
     cell = ws.cell(row=1, column=1)
-    cell.value = f"{pharmacy_name} ({date_range})"
     cell.alignment = Alignment(horizontal='center', vertical='center')
     cell.font = Font(size=35, bold=True)
     ws.row_dimensions[1].height = 60
@@ -954,78 +3129,12 @@ def process_files(insurance_paths, vendor_paths, conversion_path, pharmacy_name,
         cell.font = Font(bold=False, size = 15)
 
 
-    #Dynamically calculate the start and end columns for each merged cell
-    def get_column_index(ws, header_name):
-        for cell in ws[3]:
-            if cell.value == header_name:
-                return cell.col_idx
-        return None
-
-    #Get the starting column indices for merging
-    quantity_billed_start_col = get_column_index(ws, 'ALL_PBM_Q')
-    if quantity_billed_start_col is None:
-        raise ValueError("Header 'All_Pbm_Q' not found in the worksheet")
-
-    package_size_billed_start_col = get_column_index(ws, 'ALL_PBM_P')
-    if package_size_billed_start_col is None:
-        raise ValueError("Header 'ALL_PBM_P' not found in the worksheet")
-
-    package_size_difference_start_col = get_column_index(ws, 'ALL_PBM_D')
-    if package_size_difference_start_col is None:
-        raise ValueError("Header 'ALL_PBM_D' not found in the worksheet")
-
-    quantity_dollar_billed_start_col = get_column_index(ws, 'ALL_PBM_T')
-    if quantity_dollar_billed_start_col is None:
-        raise ValueError("Header 'ALL_PBM_T' not found in the worksheet")
-
-    
-    quantity_dollar_purchased_start_col = get_column_index(ws, 'ALL_PBM_Pur')
-    if quantity_dollar_purchased_start_col is None:
-        raise ValueError("Header 'ALL_PBM_Pur' not found in the worksheet")
-
-    quantity_dollar_difference_start_col = get_column_index(ws, 'ALL_PBM_Diff$')
-    if quantity_dollar_difference_start_col is None:
-        raise ValueError("Header 'ALL_PBM_Diff$' not found in the worksheet")
-    
-
-    # Calculate the end columns dynamically based on the number of insurance columns
-    quantity_billed_end_col = quantity_billed_start_col + len(insurance_paths) - 1
-    package_size_billed_end_col = package_size_billed_start_col + len(insurance_paths) - 1
-    package_size_difference_end_col = package_size_difference_start_col + len(insurance_paths) - 1
-    quantity_dollar_billed_end_col = quantity_dollar_billed_start_col + len(insurance_paths) - 1
-    quantity_dollar_purchased_end_col = quantity_dollar_purchased_start_col + len(insurance_paths) - 1
-    quantity_dollar_difference_end_col = quantity_dollar_difference_start_col + len(insurance_paths) - 1
-
-    # Merge cells and set the header values dynamically
-    ws.merge_cells(start_row=2, start_column=quantity_billed_start_col, end_row=2, end_column=quantity_billed_end_col)
-    cell = ws.cell(row=2, column=quantity_billed_start_col)
-    cell.value = "Quantity Billed"
-    cell.alignment = Alignment(horizontal='center', vertical='center')
-
-    ws.merge_cells(start_row=2, start_column=package_size_billed_start_col, end_row=2, end_column=package_size_billed_end_col)
-    cell = ws.cell(row=2, column=package_size_billed_start_col)
-    cell.value = "Package size Billed"
-    cell.alignment = Alignment(horizontal='center', vertical='center')
-
-    ws.merge_cells(start_row=2, start_column=package_size_difference_start_col, end_row=2, end_column=package_size_difference_end_col)
-    cell = ws.cell(row=2, column=package_size_difference_start_col)
-    cell.value = "Package size Difference"
-    cell.alignment = Alignment(horizontal='center', vertical='center')
-
-    ws.merge_cells(start_row=2, start_column=quantity_dollar_billed_start_col, end_row=2, end_column=quantity_dollar_billed_end_col)
-    cell = ws.cell(row=2, column=quantity_dollar_billed_start_col)
-    cell.value = "$$ Paid"
-    cell.alignment = Alignment(horizontal='center', vertical='center')
-
-    ws.merge_cells(start_row=2, start_column=quantity_dollar_purchased_start_col, end_row=2, end_column=quantity_dollar_purchased_end_col)
-    cell = ws.cell(row=2, column=quantity_dollar_purchased_start_col)
-    cell.value = "$$ Purchased"
-    cell.alignment = Alignment(horizontal='center', vertical='center')
-
-    ws.merge_cells(start_row=2, start_column=quantity_dollar_difference_start_col, end_row=2, end_column=quantity_dollar_difference_end_col)
-    cell = ws.cell(row=2, column=quantity_dollar_difference_start_col)
-    cell.value = "$$ Difference"
-    cell.alignment = Alignment(horizontal='center', vertical='center')
+    # Merge cells and set the group header values from the precomputed layout
+    for title, start_col, end_col in layout.group_ranges:
+        ws.merge_cells(start_row=2, start_column=start_col, end_row=2, end_column=end_col)
+        cell = ws.cell(row=2, column=start_col)
+        cell.value = title
+        cell.alignment = Alignment(horizontal='center', vertical='center')
     
     
     # Set the desired column widths
@@ -1048,7 +3157,6 @@ def process_files(insurance_paths, vendor_paths, conversion_path, pharmacy_name,
     ws.row_dimensions[1].height = 35
 
     # Set header styles
-    header_font = Font(bold=True, color="FFFFFF")
     header_fill = PatternFill(start_color="D0CECE", end_color="D0CECE", fill_type="solid")
     # Set border style
     thin_border = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
@@ -1081,13 +3189,7 @@ def process_files(insurance_paths, vendor_paths, conversion_path, pharmacy_name,
         row[1].alignment = Alignment(horizontal='left')
         row[2].alignment = Alignment(horizontal='left')
 
-    #Setting up thick border for columns: F to K
-    start_col = 6  # Column F
-    end_col = 11   # Column K
-    start_row = 3
-    end_row = ws.max_row
-    # Function to apply thick border to all cells
-                
+    # Function to apply a thick outline around a block of columns
     def apply_thick_border(ws, start_col, end_col, start_row, end_row):
        # Apply the thick border to the top row
        for col_num in range(start_col, end_col + 1):
@@ -1131,32 +3233,6 @@ def process_files(insurance_paths, vendor_paths, conversion_path, pharmacy_name,
     start_row = 1
     end_row = ws.max_row
 
-    def style_sheet(ws):
-        for row in ws.iter_rows(min_row=1, max_row=ws.max_row):
-            for cell in row:
-                cell.border = thin_border
-
-    
-    def get_column_indices(ws, column_names):
-        indices = []
-        for col in ws[3]:
-            if col.value in column_names:
-                indices.append(col.col_idx)
-        return indices
-    total_purchased_col = get_column_index(ws, 'Total Purchased')
-    if total_purchased_col is None:
-        raise ValueError("Header 'Total Purchased' not found in the worksheet")
-    
-    # Apply thick border for specific column ranges
-    quantity_billed_indices = get_column_indices(ws, [f'{insurance}_Q' for insurance in insurance_paths.keys()])
-    package_size_billed_indices = get_column_indices(ws, [f'{insurance}_P' for insurance in insurance_paths.keys()])
-    package_size_difference_indices = get_column_indices(ws, [f'{insurance}_D' for insurance in insurance_paths.keys()])
-    total_purchased_indices = [total_purchased_col]
-    dollar_billed_size_difference_indices = get_column_indices(ws, [f'{insurance}_T' for insurance in insurance_paths.keys()])
-    dollar_purchased_difference_indices = get_column_indices(ws, [f'{insurance}_Pur' for insurance in insurance_paths.keys()])
-    dollar_purchased_difference_indices_ind = get_column_indices(ws, [f'{insurance}_Diff$' for insurance in insurance_paths.keys()])
-    
-    
     def apply_thick_border_to_groups(ws, column_groups, start_row, end_row):
         for group in column_groups:
             if group:
@@ -1175,8 +3251,8 @@ def process_files(insurance_paths, vendor_paths, conversion_path, pharmacy_name,
     cell_fill_red = PatternFill(start_color="F88379", end_color="F88379", fill_type="solid")
     row_fill_blue = PatternFill(start_color="ADD8E6", end_color="ADD8E6", fill_type="solid")
     
-    package_size_diff_columns = [get_column_index(ws, f'{insurance}_D') for insurance in insurance_paths.keys()]
-    dollar_diff_columns = [get_column_index(ws, f'{insurance}_Diff$') for insurance in insurance_paths.keys()]
+    package_size_diff_columns = layout.package_size_diff_columns
+    dollar_diff_columns = layout.dollar_diff_columns
 
     # Highlight rows and cells based on conditions
     for row in ws.iter_rows(min_row=4, max_row=ws.max_row):
@@ -1198,8 +3274,7 @@ def process_files(insurance_paths, vendor_paths, conversion_path, pharmacy_name,
                 cell.border = thin_border
                 
     # Grouping column indices
-    column_groups = [quantity_billed_indices, package_size_billed_indices, package_size_difference_indices, total_purchased_indices, dollar_billed_size_difference_indices, dollar_purchased_difference_indices, dollar_purchased_difference_indices_ind]
-    apply_thick_border_to_groups(ws, column_groups, start_row, end_row)
+    apply_thick_border_to_groups(ws, layout.border_groups, start_row, end_row)
     apply_thick_border(ws, start_col=1, end_col=1, start_row=start_row, end_row = end_row)
     apply_thick_border(ws, start_col=2, end_col=2, start_row=start_row, end_row = end_row)
     apply_thick_border(ws, start_col=3, end_col=3, start_row=start_row, end_row = end_row)
@@ -1213,136 +3288,1823 @@ def process_files(insurance_paths, vendor_paths, conversion_path, pharmacy_name,
 
     # Set the title of the active worksheet
     ws.title = "Processed Data"
-            
-    # Inside the process_files function
-    # After saving the workbook with the processed data:
-
-    # Add the "Needs to be Ordered" sheet
-    add_max_difference_sheet(wb, final_data, insurance_paths)
-    min_difference_sheet(wb, final_data, insurance_paths)
-    #add_needs_to_order_sheet(wb, final_data, conversion_data) 
-    #add_do_not_order(wb, final_data)
-    add_missing_items_sheet(wb, missing_items)
-    create_never_ordered_check_sheet(wb, final_data)
-    
 
-    for sheet in wb.worksheets:
-        #adding row height as 20
-        for row in sheet.iter_rows(min_row=1, max_row=sheet.max_row, min_col=1, max_col=sheet.max_column):    
-            for cell in row:
-                if isinstance(cell.value, float):  # Check if the cell contains a float value
-                    cell.value = round(cell.value, 2) 
-        
-    # Set the title in the first row based on the sheet title
-        if sheet.title == "Processed Data":
-            sheet.cell(row=1, column=1).value = f"{pharmacy_name} ({date_range})"
-            cell = sheet.cell(row=1, column=1)
-            cell.alignment = Alignment(horizontal='center', vertical='center')
-            cell.font = Font(size=35, bold=True)
-            for row in sheet.iter_rows(min_row=4, max_row=sheet.max_row):
-                sheet.row_dimensions[row[0].row].height = 20
-            sheet.page_setup.orientation = "landscape"
-        elif sheet.title == "Needs to be Ordered":
-            sheet.cell(row=1, column=1).value = f"{pharmacy_name} ({date_range}) - NTO CVS"
-            cell = sheet.cell(row=1, column=1)
-            cell.alignment = Alignment(horizontal='center', vertical='center')
-            cell.font = Font(size=25, bold=True)
-            for row in sheet.iter_rows(min_row=2, max_row=sheet.max_row):
-                sheet.row_dimensions[row[0].row].height = 20
-            sheet.page_setup.orientation = "landscape"
-        elif sheet.title == "Missing Items":
-            sheet.cell(row=1, column=1).value = f"{pharmacy_name} ({date_range}) - Missing items, To be updated in master file"
-            cell = sheet.cell(row=1, column=1)
-            cell.alignment = Alignment(horizontal='center', vertical='center')
-            cell.font = Font(size=15, bold=True)
-            for row in sheet.iter_rows(min_row=2, max_row=sheet.max_row):
-                sheet.row_dimensions[row[0].row].height = 20
-            sheet.page_setup.orientation = "landscape"
-        elif sheet.title == "Do Not Order CVS":
-            sheet.cell(row=1, column=1).value = f"{pharmacy_name} ({date_range}) - DNO CVS"
-            cell = sheet.cell(row=1, column=1)
-            cell.alignment = Alignment(horizontal='center', vertical='center')
-            cell.font = Font(size=25, bold=True)
-            for row in sheet.iter_rows(min_row=2, max_row=sheet.max_row):
-                sheet.row_dimensions[row[0].row].height = 20
-            sheet.page_setup.orientation = "landscape"
-
-        elif sheet.title == "Needs to be ordered - All":
-            sheet.cell(row=1, column=1).value = f"{pharmacy_name} ({date_range}) - Needs to ordered - ALL"
-            cell = sheet.cell(row=1, column=1)
-            cell.alignment = Alignment(horizontal='center', vertical='center')
-            cell.font = Font(size=25, bold=True)
-            for row in sheet.iter_rows(min_row=3, max_row=sheet.max_row):
-                sheet.row_dimensions[row[0].row].height = 20
-            sheet.page_setup.orientation = "landscape"
-                
-        elif sheet.title == "Do Not Order - ALL":#Do Not Order - All
-            sheet.cell(row=1, column=1).value = f"{pharmacy_name} ({date_range})-Do Not Order"
-            cell = sheet.cell(row=1, column=1)
-            cell.alignment = Alignment(horizontal='center', vertical='center')
-            cell.font = Font(size=25, bold=True)
-            for row in sheet.iter_rows(min_row=3, max_row=sheet.max_row):
-                sheet.row_dimensions[row[0].row].height = 20
-            sheet.page_setup.orientation = "portrait"
-
-        elif sheet.title == "Never Ordered  - Check":
-            sheet.cell(row=1, column=1).value = f"{pharmacy_name} ({date_range})-Never Ordered Package - Check"
-            cell = sheet.cell(row=1, column=1)
-            cell.alignment = Alignment(horizontal='center', vertical='center')
-            cell.font = Font(size=25, bold=True)
-            for row in sheet.iter_rows(min_row=3, max_row=sheet.max_row):
-                sheet.row_dimensions[row[0].row].height = 20
+    column_styles = []
+    for col_idx in range(1, len(desired_columns) + 1):
+        blue_row = 5 if col_idx not in negative_columns else 7 if col_idx == first_diff_col else 6
+        column_styles.append({
+            'plain': tuple(ws.cell(row=4, column=col_idx)._style),
+            'red': tuple(ws.cell(row=5, column=col_idx)._style),
+            'blue': tuple(ws.cell(row=blue_row, column=col_idx)._style),
+        })
+
+    sheet_part = export_sheet_part(ws)
+    sheet_part['cells'] = [cell for cell in sheet_part['cells'] if cell[0] <= 3]
+    outlined_columns = {1, 2, 3, 4}
+    for group in layout.border_groups:
+        if group:
+            outlined_columns.update(range(group[0], group[-1] + 1))
+    return {'sheet_part': sheet_part, 'column_styles': column_styles, 'outlined_columns': sorted(outlined_columns), 'layout': layout}
+
+def get_wide_sheet_template(insurance_names, vendor_names):
+    # Skeleton of the "Processed Data" sheet, built on the first run with this insurance/vendor combination
+    key = (tuple(insurance_names), tuple(vendor_names))
+    with sheet_templates_lock:
+        if key in sheet_templates:
+            sheet_templates.move_to_end(key)
+            return sheet_templates[key]
+    template = build_wide_sheet_template(list(insurance_names), list(vendor_names))
+    with sheet_templates_lock:
+        sheet_templates[key] = template
+        while len(sheet_templates) > app.config['SHEET_TEMPLATE_CACHE_SIZE']:
+            sheet_templates.popitem(last=False)
+    return template
+
+def get_sheet_value(value):
+    # Cell value as the data rows were always written: missing values empty, infinite values as text
+    if isinstance(value, float):
+        if value != value:
+            return ''
+        if value in (float('inf'), float('-inf')):
+            return '-inf' if value < 0 else 'inf'
+    return value
+
+def write_wide_data_sheet(final_data, insurance_names, vendor_names, pharmacy_name, date_range, job=None):
+    # Write the "Processed Data" sheet with six columns per insurance, returns the workbook, the sheet and its layout
+    template = get_wide_sheet_template(insurance_names, vendor_names)
+    layout = template['layout']
 
-            sheet.page_setup.orientation = "landscape"
+    # Sort the final data by Drug Name in ascending order
+    sorted_data = final_data[layout.columns].sort_values(by='Drug Name')
+    # The highlighting looks at the values rounded to three decimals, the cells show two
+    sorted_data = round_report_values(sorted_data, 3)
+
+    wb = Workbook()
+    wb.remove(wb.active)
+    ws = import_sheet_part(wb, template['sheet_part'])
+    ws.cell(row=1, column=1).value = f"{pharmacy_name} ({date_range})"
+    map_style = get_style_mapper(wb, template['sheet_part'])
+    column_styles = [{variant: map_style(style) for variant, style in styles.items()} for styles in template['column_styles']]
+
+    if job:
+        job.checkpoint('formatting the Processed Data sheet')
+    # Red for negative differences, blue for the other cells of a row with a negative package size difference
+    package_size_diff_columns = [col_idx - 1 for col_idx in layout.insurance_group_indices['D']]
+    negative_columns = sorted(col_idx - 1 for col_idx in layout.package_size_diff_columns | layout.dollar_diff_columns)
+    has_negative = sorted_data.iloc[:, package_size_diff_columns].lt(0).any(axis=1).tolist()
+    negative_cells = sorted_data.iloc[:, negative_columns].lt(0).to_numpy().tolist()
+
+    data_columns = [values.tolist() for _, values in round_report_values(sorted_data).items()]
+    for r_idx, (values, row_has_negative, row_negative_cells) in enumerate(zip(zip(*data_columns), has_negative, negative_cells), start=4):
+        row_variants = ['blue' if row_has_negative else 'plain'] * len(values)
+        for c_idx, is_negative in zip(negative_columns, row_negative_cells):
+            if is_negative:
+                row_variants[c_idx] = 'red'
+        for c_idx, (value, variant) in enumerate(zip(values, row_variants)):
+            cell = ws.cell(row=r_idx, column=c_idx + 1, value=get_sheet_value(value))
+            cell._style = StyleArray(column_styles[c_idx][variant])
+
+    if job:
+        job.checkpoint('formatting the Processed Data sheet')
+    # The last row closes the thick outlines
+    last_row = ws.max_row
+    for col_idx in template['outlined_columns']:
+        cell = ws.cell(row=last_row, column=col_idx)
+        cell.border = Border(bottom=Side(style='thick'), left=cell.border.left, right=cell.border.right, top=cell.border.top)
+    return wb, ws, layout
+
+LONG_ID_COLUMNS = ['Item Number', 'NDC #', 'Drug Name', 'Package Size']
+
+def to_long_format(final_data, insurance_names, vendor_names):
+    """
+    Turn the reconciled data into one row per NDC and insurance.
+    Rows of an insurance that did not bill the NDC (no quantity, packages or payment) are left out.
+    Args:
+        final_data: The reconciled data.
+        insurance_names: The insurance names, in column order.
+        vendor_names: The vendor column names.
+    Returns:
+        The rows sorted by Drug Name, with an Insurance column and one column per insurance
+        group titled as in the wide layout.
+    """
+    id_columns = LONG_ID_COLUMNS + list(vendor_names) + ['Total Purchased']
+    value_titles = [title for _, title in SheetLayout.INSURANCE_GROUPS]
+    insurance_parts = []
+    for insurance in insurance_names:
+        value_columns = [f'{insurance}_{suffix}' for suffix, _ in SheetLayout.INSURANCE_GROUPS]
+        part = final_data[id_columns + value_columns].set_axis(id_columns + value_titles, axis=1)
+        part = part[part[["Quantity Billed", "Package size Billed", "$$ Paid"]].ne(0).any(axis=1)]
+        part.insert(len(id_columns), 'Insurance', insurance)
+        insurance_parts.append(part)
+    long_data = pd.concat(insurance_parts, ignore_index=True)
+    # Stable sort keeps the insurance order within each NDC
+    return long_data.sort_values(by=['Drug Name', 'NDC #'], kind='stable').reset_index(drop=True)
+
+def get_active_insurances(final_data, insurance_names):
+    # Insurances that billed anything in this run, plus the ones the helper sheets always need
+    active_insurances = []
+    for insurance in insurance_names:
+        value_columns = [f'{insurance}_{suffix}' for suffix in ['Q', 'P', 'T']]
+        if insurance in REQUIRED_INSURANCES or final_data[value_columns].to_numpy().any():
+            active_insurances.append(insurance)
+    return active_insurances
+
+def drop_inactive_insurances(final_data, insurance_names):
+    """
+    Drop the columns of the insurances without any activity.
+    An inactive insurance only repeats Total Purchased in its _D column, so the helper sheets are unchanged.
+    Returns:
+        The reconciled data without those columns and the remaining insurance names.
+    """
+    active_insurances = get_active_insurances(final_data, insurance_names)
+    inactive_columns = [f'{insurance}_{suffix}' for insurance in insurance_names if insurance not in active_insurances
+                        for suffix, _ in SheetLayout.INSURANCE_GROUPS]
+    if inactive_columns:
+        print(f"Leaving out {len(insurance_names) - len(active_insurances)} insurances without activity")
+    return final_data.drop(columns=inactive_columns, errors='ignore'), active_insurances
+
+def write_long_data_sheet(final_data, insurance_names, vendor_names, pharmacy_name, date_range):
+    # Write the "Processed Data" sheet with one row per NDC and insurance, returns the workbook and the sheet
+    long_data = to_long_format(final_data, insurance_names, vendor_names)
+    columns = list(long_data.columns)
+
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "Processed Data"
 
+    ws.merge_cells(start_row=1, start_column=1, end_row=1, end_column=len(columns))
+    ws.row_dimensions[1].height = 35
 
-                
-        # Set the first two rows to repeat on each printed page
-        sheet.print_title_rows = '1:2'
-    
-        # Set footer with page numbers
-        sheet.oddFooter.left.text = "Page &P of &N"
-        sheet.oddFooter.left.size = 8  # Font size for footer
-        sheet.oddFooter.left.font = "Arial,Bold"
-    
-        # Optional: Set page margins and other print options for all sheets
-        sheet.page_margins = PageMargins(left=0, right=0, top=0, bottom=0, header=0, footer=0.1)
-        sheet.sheet_properties.pageSetUpPr.fitToPage = True
-        sheet.page_setup.fitToWidth = 1
-        sheet.page_setup.fitToHeight = 0
-        sheet.print_options.horizontalCentered = True
-        sheet.print_options.verticalCentered = True
-        sheet.print_options.gridLines = True
-        
-        
-    start_row = 4  # Assuming data starts from row 4
-    end_row = ws.max_row  # Last row of data
-    add_autosum(ws, insurance_paths, start_row, end_row)
-    
-    # Dynamically adjust widths for specific AutoSum columns
-    columns_to_adjust = []
-    for insurance in insurance_paths.keys():
-        t_col = get_column_letter(get_column_index(ws, f'{insurance}_T'))
-        pur_col = get_column_letter(get_column_index(ws, f'{insurance}_Pur'))
-        diff_col = get_column_letter(get_column_index(ws, f'{insurance}_Diff$'))
-
-        if t_col:
-            columns_to_adjust.append(t_col)
-        if pur_col:
-            columns_to_adjust.append(pur_col)
-        if diff_col:
-            columns_to_adjust.append(diff_col)
-
-    # Adjust only these specific columns
-    adjust_specific_columns(ws, columns_to_adjust)
+    header_fill = PatternFill(start_color="D0CECE", end_color="D0CECE", fill_type="solid")
+    thin_border = Border(left=Side(style='thin', color="A9A9A9"), right=Side(style='thin', color="A9A9A9"), top=Side(style='thin', color="A9A9A9"), bottom=Side(style='thin', color="A9A9A9"))
+    cell_fill_red = PatternFill(start_color="F88379", end_color="F88379", fill_type="solid")
+    row_fill_blue = PatternFill(start_color="ADD8E6", end_color="ADD8E6", fill_type="solid")
+
+    for col_num, header in enumerate(columns, 1):
+        cell = ws.cell(row=2, column=col_num, value=header)
+        cell.alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
+        cell.font = Font(bold=False, size=14)
+        cell.fill = header_fill
+        cell.border = thin_border
+    ws.row_dimensions[2].height = 45
+
+    # Styles by (left aligned, fill)
+    cell_styles = {
+        (left, fill): make_cell_style(wb, fill=fill, border=thin_border, alignment=Alignment(horizontal='left' if left else 'center', vertical='center'))
+        for left in (True, False) for fill in (None, cell_fill_red, row_fill_blue)
+    }
+    package_size_diff_col = columns.index("Package size Difference") + 1
+    dollar_diff_col = columns.index("$$ Difference") + 1
+    # The highlighting looks at the unrounded values
+    negative_package_size = long_data["Package size Difference"].lt(0).tolist()
+    negative_dollar = long_data["$$ Difference"].lt(0).tolist()
+    rounded_data = round_report_values(long_data)
+    rows = rounded_data.astype(object).where(rounded_data.notnull(), None).itertuples(index=False)
+    for values, has_negative, dollar_negative in zip(rows, negative_package_size, negative_dollar):
+        ws.append(list(values))
+        for cell in ws[ws.max_row]:
+            if (cell.col_idx == package_size_diff_col and has_negative) or (cell.col_idx == dollar_diff_col and dollar_negative):
+                fill = cell_fill_red
+            elif has_negative:
+                fill = row_fill_blue
+            else:
+                fill = None
+            cell._style = StyleArray(cell_styles[(cell.col_idx <= 3, fill)])
+
+    # Totals of the $$ columns below the data
+    start_row, end_row = 3, ws.max_row
+    for suffix, number_format in SheetLayout.AUTOSUM_FORMATS:
+        title = dict(SheetLayout.INSURANCE_GROUPS)[suffix]
+        col_letter = get_column_letter(columns.index(title) + 1)
+        cell = ws[f'{col_letter}{end_row + 1}']
+        cell.value = f"=SUM({col_letter}{start_row}:{col_letter}{end_row})"
+        cell.number_format = number_format
+        cell.alignment = Alignment(horizontal='center', vertical='center')
+
+    ws.column_dimensions['A'].width = 10
+    ws.column_dimensions['B'].width = 15
+    ws.column_dimensions['C'].width = 70
+    for col_num in range(4, len(columns) + 1):
+        ws.column_dimensions[get_column_letter(col_num)].width = 12
+    ws.freeze_panes = 'E3'
+    return wb, ws
+
+def write_report(final_data, missing_items, conversion_data, insurance_names, vendor_names, pharmacy_name, date_range, output_file, report_layout='wide', changes=None, job=None, compression_level=None):
+    # Write the styled report workbook with the "Processed Data" sheet and the helper sheets
+    insurance_names = list(insurance_names)
+
+    # Start the helper sheets in worker processes first, they only need the computed data
+    sheet_executor = None
+    if app.config['SHEET_WORKERS'] > 1:
+        sheet_executor = ProcessPoolExecutor(max_workers=min(app.config['SHEET_WORKERS'], len(AUX_SHEETS)))
+        sheet_futures = [
+            sheet_executor.submit(build_aux_sheet, aux_sheet, final_data, missing_items, conversion_data, insurance_names, pharmacy_name, date_range)
+            for aux_sheet in AUX_SHEETS
+        ]
+
+    try:
+        layout = None
+        if report_layout == 'long':
+            wb, ws = write_long_data_sheet(final_data, insurance_names, vendor_names, pharmacy_name, date_range)
+        else:
+            wb, ws, layout = write_wide_data_sheet(final_data, insurance_names, vendor_names, pharmacy_name, date_range, job)
+        if job:
+            job.checkpoint('writing the helper sheets')
+
+        if sheet_executor is None:
+            # Add the "Needs to be Ordered" sheet
+            add_max_difference_sheet(wb, final_data, insurance_names)
+            min_difference_sheet(wb, final_data, insurance_names)
+            #add_needs_to_order_sheet(wb, final_data, conversion_data)
+            #add_do_not_order(wb, final_data)
+            add_missing_items_sheet(wb, missing_items, conversion_data)
+            create_never_ordered_check_sheet(wb, final_data)
+
+            for sheet in wb.worksheets:
+                finish_sheet(sheet, pharmacy_name, date_range, report_layout)
+        else:
+            finish_sheet(ws, pharmacy_name, date_range, report_layout)
+            for future in sheet_futures:
+                for sheet_part in future.result():
+                    import_sheet_part(wb, sheet_part)
+    finally:
+        # Also when the job is cancelled or fails while the sheets are written
+        if sheet_executor is not None:
+            sheet_executor.shutdown(cancel_futures=True)
+
+    if changes is not None:
+        add_changes_sheet(wb, changes, pharmacy_name, date_range)
+
+    if layout is not None:
+        start_row = 4  # Assuming data starts from row 4
+        end_row = ws.max_row  # Last row of data
+        add_autosum(ws, layout, start_row, end_row)
+
+        # Dynamically adjust widths for specific AutoSum columns
+        columns_to_adjust = [get_column_letter(col_idx) for col_idx, _ in layout.autosum_targets]
+
+        # Adjust only these specific columns
+        adjust_specific_columns(ws, columns_to_adjust)
         
     ws.protection.sheet = True
-    wb.save(output_file)
+    if job:
+        job.checkpoint('saving the report')
+    save_report_workbook(wb, output_file, compression_level)
+    return output_file
 
-    
+class JobCancelled(Exception):
+    # Raised at a checkpoint of a report job that was cancelled or went over a limit
+    pass
+
+class ReportJob:
+    """
+    A running report job.
+    Cancellation is cooperative: the job stops at the next checkpoint between processing stages,
+    where the wall-clock and memory limits are checked as well.
+    """
+    def __init__(self, job_id=None):
+        self.job_id = job_id or uuid.uuid4().hex
+        self.started_at = time.monotonic()
+        self.stage = 'starting'
+        self.cancel_reason = None
+        # Memory of the process before the job, the limit applies to what the job adds to it
+        self.start_rss = get_rss_mb() if app.config['JOB_MEMORY_LIMIT_MB'] else None
+        # Files the job is writing, removed when it does not finish
+        self.temp_paths = []
+
+    def cancel(self, reason="it was cancelled"):
+        self.cancel_reason = reason
+
+    def checkpoint(self, stage):
+        # Stop the job here when it was cancelled or is over a limit, otherwise enter the next stage
+        if self.cancel_reason:
+            raise JobCancelled(self.cancel_reason)
+        time_limit = app.config['JOB_TIME_LIMIT']
+        if time_limit and time.monotonic() - self.started_at > time_limit:
+            raise JobCancelled(f"it ran longer than {time_limit} seconds")
+        memory_limit = app.config['JOB_MEMORY_LIMIT_MB']
+        rss = get_rss_mb() if memory_limit and self.start_rss is not None else None
+        if rss and rss - self.start_rss > memory_limit:
+            raise JobCancelled(f"it used {rss - self.start_rss:.0f} MB of memory, more than {memory_limit} MB")
+        self.stage = stage
+
+    def add_temp_path(self, path):
+        self.temp_paths.append(path)
+
+    def cleanup(self):
+        for path in self.temp_paths:
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+                    print(f"Removed unfinished file {path}")
+            except OSError as e:
+                print(f"Could not remove unfinished file {path}: {e}")
+        self.temp_paths = []
+
+def get_rss_mb():
+    # Resident set size of this process in MB, None when it cannot be measured on this system
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / (1024 * 1024)
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, AttributeError):
+        return None
+
+# Running report jobs by job id
+report_jobs = {}
+report_jobs_lock = threading.Lock()
+
+@app.route('/jobs')
+def list_jobs():
+    # Running report jobs with their current stage, for the progress display
+    with report_jobs_lock:
+        jobs = list(report_jobs.values())
+    return jsonify([
+        {'job_id': job.job_id, 'stage': job.stage, 'elapsed': round(time.monotonic() - job.started_at, 1)}
+        for job in jobs
+    ])
+
+@app.route('/cancel', methods=['POST'])
+def cancel_job():
+    # Cancel the report job with the posted job_id, the id the form sent with its upload
+    job_id = request.form.get('job_id') or (request.get_json(silent=True) or {}).get('job_id')
+    if not job_id:
+        return jsonify({'error': "A job_id is required"}), 400
+    with report_jobs_lock:
+        job = report_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': f"Unknown job '{job_id}', it may have finished already"}), 404
+    job.cancel()
+    return jsonify({'cancelled': [job.job_id]})
+
+def process_files(insurance_paths, vendor_paths, conversion_path, pharmacy_name, date_range, report_options=None, use_cache=True, job_id=None):
+    """
+    Generate the report as a cancellable job.
+    Files the job was writing are removed when it is cancelled, goes over a limit or fails.
+    Raises JobCancelled when the job was stopped.
+    """
+    return run_job(job_id, run_report_job, insurance_paths, vendor_paths, conversion_path, pharmacy_name, date_range, report_options, use_cache)
+
+def run_job(job_id, run, *args):
+    # Run run(job, *args) as a ReportJob listed in /jobs, so it can be cancelled. Its unfinished files are removed when it stops.
+    job = ReportJob(job_id)
+    with report_jobs_lock:
+        report_jobs[job.job_id] = job
+    try:
+        return run(job, *args)
+    except BaseException:
+        job.cleanup()
+        raise
+    finally:
+        with report_jobs_lock:
+            report_jobs.pop(job.job_id, None)
+
+def write_report_atomically(job, output_file, final_data, missing_items, conversion_data, insurance_names, vendor_names, pharmacy_name, date_range,
+                            report_layout, changes=None, compression_level=None):
+    # Written next to the report and moved over it once saved, so a stopped job leaves an earlier report in place
+    temp_file = f'{output_file}.{uuid.uuid4().hex}.tmp'
+    job.add_temp_path(temp_file)
+    write_report(final_data, missing_items, conversion_data, insurance_names, vendor_names, pharmacy_name, date_range, temp_file, report_layout, changes, job,
+                 compression_level)
+    os.replace(temp_file, output_file)
+    job.temp_paths.remove(temp_file)
+    return output_file
+
+def run_report_job(job, insurance_paths, vendor_paths, conversion_path, pharmacy_name, date_range, report_options=None, use_cache=True):
+
+    output_file = os.path.join(os.path.expanduser('~'), 'Downloads', f'{pharmacy_name} ({date_range}).xlsx')
+
+    report_options = dict(report_options or {})
+    report_layout = report_options.setdefault('layout', app.config['REPORT_LAYOUT'])
+    if report_layout not in REPORT_LAYOUTS:
+        raise ValueError(f"Unknown report layout '{report_layout}', expected one of {', '.join(REPORT_LAYOUTS)}")
+    previous_report = report_options.get('previous_report')
+    if previous_report:
+        # The changes depend on the previous report's content, not only on its path
+        report_options['previous_report_sha256'] = file_sha256(previous_report)
+
+    # Return the previously generated report when the same inputs are processed again
+    cache_key = None
+    if use_cache and app.config['RESULT_CACHE_ENABLED']:
+        cache_key = build_cache_key(insurance_paths, vendor_paths, conversion_path, pharmacy_name, date_range, report_options)
+        cached_path = get_cached_report(cache_key)
+        if cached_path:
+            shutil.copyfile(cached_path, output_file)
+            print(f"Using cached report for {pharmacy_name} ({date_range}): {output_file}")
+            cached_result = load_cached_result(cached_path)
+            if cached_result is not None:
+                store_result(**cached_result)
+            return output_file
+
+    job.checkpoint('reading the BestRx files')
+    combined_bestrx_data = read_bestrx_data(insurance_paths)
+    job.checkpoint('reading the vendor files')
+    combined_vendor_data, vendor_names = read_vendor_data(vendor_paths)
+    job.checkpoint('reading the conversion file')
+    conversion_data = load_conversion_data(conversion_path)
+
+    job.checkpoint('reconciling')
+    if app.config['AGGREGATION_WORKERS'] > 1:
+        final_data, missing_items = reconcile_data_parallel(combined_bestrx_data, combined_vendor_data, vendor_names, conversion_data, insurance_paths.keys())
+    else:
+        final_data, missing_items = reconcile_data(combined_bestrx_data, combined_vendor_data, vendor_names, conversion_data, insurance_paths.keys())
+
+    insurance_names = list(insurance_paths.keys())
+    if report_layout != 'wide':
+        final_data, insurance_names = drop_inactive_insurances(final_data, insurance_names)
+
+    previous = None
+    changes = None
+    if previous_report:
+        job.checkpoint('comparing with the previous report')
+        previous = read_previous_report(previous_report)
+        changes = build_changes(
+            previous,
+            get_run_summary(final_data),
+            report_options.get('to_order_threshold', app.config['DELTA_TO_ORDER_THRESHOLD']),
+            report_options.get('diff_threshold', app.config['DELTA_DIFF_THRESHOLD']),
+        )
+
+    job.checkpoint('writing the report')
+    inputs = get_session_inputs(combined_bestrx_data, combined_vendor_data, vendor_names, conversion_data, insurance_paths.keys(), report_options, previous)
+    result_id = store_result(final_data, missing_items, insurance_names, vendor_names, pharmacy_name, date_range, report_layout, inputs)
+    write_report_atomically(job, output_file, final_data, missing_items, conversion_data, insurance_names, vendor_names, pharmacy_name, date_range,
+                            report_layout, changes, report_options.get('compression_level'))
+
+    if cache_key:
+        store_cached_report(cache_key, output_file, get_result(result_id))
+
+    if app.config['WAREHOUSE_ENABLED']:
+        store_run_results(final_data, insurance_names, pharmacy_name, date_range, output_file)
+
+    return output_file
+
+def rerun_result(result, overrides, job_id=None):
+    """
+    Regenerate the report of a stored result with some changes, from the inputs parsed by its run.
+    No file is read again: the cached BestRx and vendor rows are filtered, the master is edited
+    in a copy and the reconciliation, which is fast next to reading the exports, is redone.
+    It runs as a cancellable job like process_files, the report replaces an earlier one only once it is saved.
+    Args:
+        result: The stored result, with its parsed inputs.
+        overrides: Dict with any of master (master row edits, see apply_master_edits),
+            exclude_vendors, exclude_insurances, layout, to_order_threshold and diff_threshold
+            (the thresholds of the Changes Since Last Run sheet).
+        job_id: Optional id of the job, to cancel it with /cancel.
+    Returns:
+        The id of the new result, whose inputs include the changes so what-if runs can be chained,
+        and the path of the new report.
+    Raises JobCancelled when the job was stopped.
+    """
+    return run_job(job_id, run_rerun_job, result, overrides)
+
+def run_rerun_job(job, result, overrides):
+    inputs = result['inputs']
+    exclude_vendors = overrides.get('exclude_vendors') or []
+    exclude_insurances = overrides.get('exclude_insurances') or []
+    unknown_names = [name for name in exclude_vendors if name not in inputs['vendor_names']] + [name for name in exclude_insurances if name not in inputs['insurance_names']]
+    if unknown_names:
+        raise ValueError(f"Unknown vendors or insurances: {', '.join(map(str, unknown_names))}")
+    required_names = [name for name in REQUIRED_INSURANCES if name in exclude_insurances]
+    if required_names:
+        raise ValueError(f"{', '.join(required_names)} cannot be excluded")
+    vendor_names = [name for name in inputs['vendor_names'] if name not in exclude_vendors]
+    if not vendor_names:
+        raise ValueError("At least one vendor must be kept")
+    insurance_names = [name for name in inputs['insurance_names'] if name not in exclude_insurances]
+    report_layout = overrides.get('layout') or result['report_layout']
+    if report_layout not in REPORT_LAYOUTS:
+        raise ValueError(f"Unknown report layout '{report_layout}'")
+    report_options = dict(inputs['report_options'], layout=report_layout)
+    for option in ['to_order_threshold', 'diff_threshold']:
+        if overrides.get(option) is not None:
+            report_options[option] = float(overrides[option])
+    conversion_data = apply_master_edits(inputs['conversion_data'], overrides.get('master') or [])
+
+    job.checkpoint('reconciling')
+    # reconcile_data adds columns to the rows it is given, the cached rows are filtered into copies
+    bestrx_data = inputs['bestrx_data']
+    bestrx_data = bestrx_data[bestrx_data['Insurance'].isin(insurance_names)].copy()
+    vendor_data = inputs['vendor_data']
+    vendor_data = vendor_data[vendor_data['Vendor'].isin(vendor_names)].copy()
+    final_data, missing_items = reconcile_data(bestrx_data, vendor_data, vendor_names, conversion_data, insurance_names)
+    new_inputs = dict(inputs, bestrx_data=bestrx_data, vendor_data=vendor_data, vendor_names=vendor_names, conversion_data=conversion_data,
+                      insurance_names=insurance_names, report_options=report_options)
+
+    report_insurance_names = insurance_names
+    if report_layout != 'wide':
+        final_data, report_insurance_names = drop_inactive_insurances(final_data, insurance_names)
+
+    changes = None
+    if inputs['previous'] is not None:
+        job.checkpoint('comparing with the previous report')
+        changes = build_changes(
+            inputs['previous'],
+            get_run_summary(final_data),
+            report_options.get('to_order_threshold', app.config['DELTA_TO_ORDER_THRESHOLD']),
+            report_options.get('diff_threshold', app.config['DELTA_DIFF_THRESHOLD']),
+        )
+
+    pharmacy_name, date_range = result['pharmacy_name'], result['date_range']
+    output_file = os.path.join(os.path.expanduser('~'), 'Downloads', f'{pharmacy_name} ({date_range}) what-if.xlsx')
+    job.checkpoint('writing the report')
+    result_id = store_result(final_data, missing_items, report_insurance_names, vendor_names, pharmacy_name, date_range, report_layout, new_inputs)
+    write_report_atomically(job, output_file, final_data, missing_items, conversion_data, report_insurance_names, vendor_names, pharmacy_name, date_range,
+                            report_layout, changes, report_options.get('compression_level'))
+    return result_id, output_file
+
+def build_period_comparison(final_data, period_names, insurance_names):
+    """
+    Turn the per-period reconciliation into one row per NDC with trend columns.
+    For each insurance the _D and _Diff$ value of every period is listed, followed by the
+    change against the previous period.
+    Args:
+        final_data: Reconciled data with a Period column.
+        period_names: The period names, oldest first.
+        insurance_names: The insurance names.
+    Returns:
+        The comparison data sorted by Drug Name.
+    """
+    value_columns = [f'{insurance}_{suffix}' for suffix in ['D', 'Diff$'] for insurance in insurance_names]
+    value_columns = [col for col in value_columns if col in final_data.columns]
+
+    trend = final_data.pivot_table(index='NDC #', columns='Period', values=value_columns, aggfunc='sum').fillna(0)
+
+    comparison_columns = {}
+    for col in value_columns:
+        previous = None
+        for period in period_names:
+            values = trend[(col, period)] if (col, period) in trend.columns else pd.Series(0, index=trend.index)
+            comparison_columns[f'{col} ({period})'] = values
+            if previous is not None:
+                comparison_columns[f'{col} Change ({period})'] = values - previous
+            previous = values
 
+    # Drug name and package size of each NDC, from the latest period that billed it
+    ndc_details = final_data.sort_values(by='Period', key=lambda periods: periods.map(period_names.index))
+    ndc_details = ndc_details.drop_duplicates(subset='NDC #', keep='last').set_index('NDC #')[['Drug Name', 'Package Size']]
+
+    comparison = ndc_details.join(pd.DataFrame(comparison_columns, index=trend.index)).reset_index()
+    comparison = comparison.rename(columns={'Package Size': 'Pkg Size'})
+    return comparison.sort_values(by='Drug Name')
+
+def add_period_comparison_sheet(wb, comparison, pharmacy_name, period_names):
+    ws = wb.create_sheet(title="Period Comparison")
+
+    # Set the header
+    ws.merge_cells(start_row=1, start_column=1, end_row=1, end_column=len(comparison.columns))
+    cell = ws.cell(row=1, column=1)
+    cell.value = f"{pharmacy_name} ({period_names[0]} - {period_names[-1]}) - Period Comparison"
+    cell.alignment = Alignment(horizontal='center', vertical='center')
+    cell.font = Font(size=25, bold=True)
+    ws.row_dimensions[1].height = 30
+
+    cell_fill_red = PatternFill(start_color="F88379", end_color="F88379", fill_type="solid")
+    thin_border = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
+
+    # Add the data to the sheet
+    for r_idx, row in enumerate(dataframe_to_rows(comparison, index=False, header=True), start=2):
+        for c_idx, value in enumerate(row, start=1):
+            if isinstance(value, float):
+                value = round(value, 2)
+            cell = ws.cell(row=r_idx, column=c_idx, value=value)
+            if r_idx == 2 and c_idx > 3:
+                cell.alignment = Alignment(horizontal='center', vertical='center', text_rotation=90, wrap_text=True)
+            elif c_idx == 2:
+                cell.alignment = Alignment(horizontal='left', vertical='center')
+            else:
+                cell.alignment = Alignment(horizontal='center', vertical='center')
+            cell.font = Font(size=12)
+            cell.border = thin_border
+            if r_idx > 2 and c_idx > 3 and isinstance(value, (int, float)) and value < 0:
+                cell.fill = cell_fill_red
+
+    column_widths = {
+        'A': 15,  # NDC #
+        'B': 60,  # Drug Name
+        'C': 7,  # Pkg Size
+    }
+    for col_idx in range(1, len(comparison.columns) + 1):
+        col_letter = get_column_letter(col_idx)
+        ws.column_dimensions[col_letter].width = column_widths.get(col_letter, 9)
+
+    ws.row_dimensions[2].height = 140
+    ws.freeze_panes = 'D3'
+
+    set_print_setup(ws, ws.ORIENTATION_LANDSCAPE)
+
+def process_period_files(periods, conversion_path, pharmacy_name):
+    """
+    Build a comparison report over several periods in one pass.
+    The conversion file is read once, every period's BestRx and vendor rows are tagged with
+    the period and aggregated together, grouped by period.
+    Args:
+        periods: List of (period name, insurance_paths, vendor_paths), oldest first.
+        conversion_path: Path of the conversion/master file shared by all periods.
+        pharmacy_name: Pharmacy name shown in the report title.
+    Returns:
+        The path of the generated comparison report.
+    """
+    conversion_data = load_conversion_data(conversion_path)
+
+    period_names = []
+    insurance_names = []
+    vendor_names = []
+    all_bestrx_data = []
+    all_vendor_data = []
+    for period_name, insurance_paths, vendor_paths in periods:
+        period_names.append(period_name)
+
+        bestrx_data = read_bestrx_data(insurance_paths)
+        bestrx_data['Period'] = period_name
+        all_bestrx_data.append(bestrx_data)
+
+        vendor_data, period_vendor_names = read_vendor_data(vendor_paths)
+        vendor_data['Period'] = period_name
+        all_vendor_data.append(vendor_data)
+
+        # Keep the first-seen order of insurances and vendors across periods
+        insurance_names += [insurance for insurance in insurance_paths.keys() if insurance not in insurance_names]
+        vendor_names += [vendor for vendor in period_vendor_names if vendor not in vendor_names]
+
+    combined_bestrx_data = pd.concat(all_bestrx_data, ignore_index=True)
+    combined_vendor_data = pd.concat(all_vendor_data, ignore_index=True)
+
+    final_data, missing_items = reconcile_data(combined_bestrx_data, combined_vendor_data, vendor_names, conversion_data, insurance_names, group_keys=['Period'])
+    comparison = build_period_comparison(final_data, period_names, insurance_names)
+
+    output_file = os.path.join(os.path.expanduser('~'), 'Downloads', f'{pharmacy_name} (Period Comparison {period_names[0]} - {period_names[-1]}).xlsx')
+    wb = Workbook()
+    wb.remove(wb.active)
+    add_period_comparison_sheet(wb, comparison, pharmacy_name, period_names)
+    add_missing_items_sheet(wb, missing_items, conversion_data)
+    save_report_workbook(wb, output_file)
+    print(f"Period comparison saved at: {output_file}")
+    return output_file
+
+CHAIN_VALUE_COLUMNS = ['Purchased', 'Billed', 'To Order', 'Order Price', 'Diff$']
+
+def get_store_rollup(final_data):
+    """
+    Reduce one store's reconciliation to the values a chain rollup needs.
+    Args:
+        final_data: The reconciled data of the store.
+    Returns:
+        One row per NDC with Drug Name, Pkg Size, PRICE, Purchased (packages), Billed (ALL_PBM
+        packages), To Order, Order Price (To Order * PRICE) and Diff$ (ALL_PBM $ difference).
+    """
+    grouped = final_data.groupby('NDC #')
+    rollup = grouped.agg({'Drug Name': 'first', 'Package Size': 'first', 'PRICE': 'first', 'Total Purchased': 'sum'})
+    rollup = rollup.rename(columns={'Package Size': 'Pkg Size', 'Total Purchased': 'Purchased'})
+    rollup['Billed'] = grouped['ALL_PBM_P'].sum() if 'ALL_PBM_P' in final_data.columns else 0
+    needs_to_order = get_needs_to_order(final_data)[0]
+    rollup['To Order'] = needs_to_order.groupby('NDC #')['To Order'].max().reindex(rollup.index, fill_value=0)
+    rollup['Order Price'] = rollup['To Order'] * rollup['PRICE'].fillna(0)
+    rollup['Diff$'] = grouped['ALL_PBM_Diff$'].sum() if 'ALL_PBM_Diff$' in final_data.columns else 0.0
+    return rollup.reset_index()
+
+def reconcile_store(insurance_paths, vendor_paths, conversion_data):
+    # Read and reconcile one store of a chain, runs in a worker process when CHAIN_WORKERS > 1
+    combined_bestrx_data = read_bestrx_data(insurance_paths)
+    combined_vendor_data, vendor_names = read_vendor_data(vendor_paths)
+    final_data, missing_items = reconcile_data(combined_bestrx_data, combined_vendor_data, vendor_names, conversion_data, insurance_paths.keys())
+    return get_store_rollup(final_data), missing_items
+
+def build_chain_rollup(store_rollups, top_count):
+    """
+    Merge the store rollups by NDC.
+    Args:
+        store_rollups: Dict of store name to its rollup from get_store_rollup, in report order.
+        top_count: Number of NDCs in the top exposure list.
+    Returns:
+        The chain rollup (one row per NDC, To Order and Diff$ of every store followed by the
+        chain totals), the store totals (one row per store and a Chain row) and the top exposure
+        NDCs (largest chain Order Price, with the number of stores short).
+    """
+    store_names = list(store_rollups)
+    rows = pd.concat([rollup.assign(Store=store_name) for store_name, rollup in store_rollups.items()], ignore_index=True)
+
+    ndc_details = rows.drop_duplicates(subset='NDC #').set_index('NDC #')[['Drug Name', 'Pkg Size', 'PRICE']]
+    by_store = rows.pivot_table(index='NDC #', columns='Store', values=['To Order', 'Diff$'], aggfunc='sum').fillna(0)
+    store_columns = {}
+    for store_name in store_names:
+        for col in ['To Order', 'Diff$']:
+            store_columns[f'{col} ({store_name})'] = by_store[(col, store_name)] if (col, store_name) in by_store.columns else 0
+    chain_totals = rows.groupby('NDC #')[CHAIN_VALUE_COLUMNS].sum().add_prefix('Chain ')
+    chain_totals['Stores Short'] = rows[rows['To Order'] > 0].groupby('NDC #')['Store'].nunique().reindex(chain_totals.index, fill_value=0)
+
+    chain_rollup = ndc_details.join(pd.DataFrame(store_columns, index=by_store.index)).join(chain_totals)
+    chain_rollup = chain_rollup.reset_index().sort_values(by='Drug Name')
+
+    store_totals = rows.groupby('Store', sort=False)[CHAIN_VALUE_COLUMNS].sum()
+    store_totals.insert(0, 'NDCs', rows.groupby('Store', sort=False)['NDC #'].nunique())
+    store_totals.insert(1, 'NDCs To Order', rows[rows['To Order'] > 0].groupby('Store', sort=False)['NDC #'].nunique().reindex(store_totals.index, fill_value=0))
+    store_totals = store_totals.reindex(store_names)
+    store_totals.loc['Chain'] = store_totals.sum()
+    store_totals.loc['Chain', 'NDCs'] = rows['NDC #'].nunique()
+    store_totals.loc['Chain', 'NDCs To Order'] = (chain_totals['Chain To Order'] > 0).sum()
+    store_totals = store_totals.rename_axis('Store').reset_index()
+
+    top_exposure = chain_rollup[chain_rollup['Chain Order Price'] > 0].nlargest(top_count, 'Chain Order Price')
+    top_exposure = top_exposure[['NDC #', 'Drug Name', 'Pkg Size', 'PRICE', 'Stores Short', 'Chain To Order', 'Chain Order Price', 'Chain Diff$']]
+    return chain_rollup, store_totals, top_exposure
+
+def add_chain_sheet(wb, title, data, heading, text_columns):
+    # Plain table sheet of a chain rollup, negative values are red and the first text_columns stay frozen
+    ws = wb.create_sheet(title=title)
+
+    ws.merge_cells(start_row=1, start_column=1, end_row=1, end_column=len(data.columns))
+    cell = ws.cell(row=1, column=1)
+    cell.value = heading
+    cell.alignment = Alignment(horizontal='center', vertical='center')
+    cell.font = Font(size=25, bold=True)
+    ws.row_dimensions[1].height = 30
+
+    cell_fill_red = PatternFill(start_color="F88379", end_color="F88379", fill_type="solid")
+    thin_border = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
+
+    for r_idx, row in enumerate(dataframe_to_rows(data, index=False, header=True), start=2):
+        for c_idx, value in enumerate(row, start=1):
+            if isinstance(value, float):
+                value = round(value, 2)
+            cell = ws.cell(row=r_idx, column=c_idx, value=value)
+            if r_idx == 2 and c_idx > text_columns:
+                cell.alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
+            elif c_idx == 2 and r_idx > 2:
+                cell.alignment = Alignment(horizontal='left', vertical='center')
+            else:
+                cell.alignment = Alignment(horizontal='center', vertical='center')
+            cell.font = Font(size=12, bold=r_idx == 2)
+            cell.border = thin_border
+            if r_idx > 2 and c_idx > text_columns and isinstance(value, (int, float)) and value < 0:
+                cell.fill = cell_fill_red
+
+    for col_idx, col in enumerate(data.columns, start=1):
+        ws.column_dimensions[get_column_letter(col_idx)].width = 60 if col == 'Drug Name' else 15
+    ws.row_dimensions[2].height = 45
+    ws.freeze_panes = ws.cell(row=3, column=text_columns + 1)
+
+    set_print_setup(ws, ws.ORIENTATION_LANDSCAPE)
+
+def write_chain_report(store_rollups, missing_items, conversion_data, chain_name, date_range):
+    """
+    Write the chain rollup workbook: Store Totals, Top Exposure, Chain Rollup and Missing Items.
+    Args:
+        store_rollups: Dict of store name to its rollup from get_store_rollup.
+        missing_items: Dict of store name to its missing items.
+        conversion_data: The conversion data for the master suggestions, or None.
+        chain_name: Chain name shown in the titles.
+        date_range: Date range shown in the titles.
+    Returns:
+        The path of the generated report.
+    """
+    chain_rollup, store_totals, top_exposure = build_chain_rollup(store_rollups, app.config['CHAIN_TOP_NDCS'])
+
+    output_file = os.path.join(os.path.expanduser('~'), 'Downloads', f'{chain_name} (Chain Rollup {date_range}).xlsx')
+    wb = Workbook()
+    wb.remove(wb.active)
+    add_chain_sheet(wb, "Store Totals", store_totals, f"{chain_name} ({date_range}) - Store Totals", 1)
+    add_chain_sheet(wb, "Top Exposure", top_exposure, f"{chain_name} ({date_range}) - Top {len(top_exposure)} NDCs by Order Price", 3)
+    add_chain_sheet(wb, "Chain Rollup", chain_rollup, f"{chain_name} ({date_range}) - Chain Rollup", 3)
+    chain_missing_items = pd.concat([items.assign(Store=store_name) for store_name, items in missing_items.items()], ignore_index=True)
+    add_missing_items_sheet(wb, chain_missing_items, conversion_data)
+    save_report_workbook(wb, output_file)
+    print(f"Chain rollup saved at: {output_file}")
+    return output_file
+
+def process_chain_files(stores, conversion_path, chain_name, date_range, workers=None):
+    """
+    Build a rollup report over the stores of a chain.
+    The conversion file is read once. Every store is read and reconciled on its own, in
+    parallel when CHAIN_WORKERS > 1, and reduced to one row per NDC before the stores are
+    merged, so no per-store workbook is built.
+    Args:
+        stores: List of (store name, insurance_paths, vendor_paths).
+        conversion_path: Path of the conversion/master file shared by all stores.
+        chain_name: Chain name shown in the report titles.
+        date_range: Date range shown in the report titles.
+        workers: Number of worker processes, defaults to CHAIN_WORKERS.
+    Returns:
+        The path of the generated rollup report.
+    """
+    workers = min(workers or app.config['CHAIN_WORKERS'], len(stores))
+    conversion_data = load_conversion_data(conversion_path)
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(reconcile_store, insurance_paths, vendor_paths, conversion_data) for _, insurance_paths, vendor_paths in stores]
+            store_results = [future.result() for future in futures]
+    else:
+        store_results = [reconcile_store(insurance_paths, vendor_paths, conversion_data) for _, insurance_paths, vendor_paths in stores]
+
+    store_names = [store_name for store_name, _, _ in stores]
+    store_rollups = {store_name: rollup for store_name, (rollup, _) in zip(store_names, store_results)}
+    missing_items = {store_name: items for store_name, (_, items) in zip(store_names, store_results)}
+    return write_chain_report(store_rollups, missing_items, conversion_data, chain_name, date_range)
+
+PREVIEW_COLUMNS = ['NDC #', 'Drug Name', 'Pkg Size', 'PRICE', 'To Order', 'Order Price', 'Diff$']
+# BestRx columns the preview needs, Total Rxs is only shown in the report
+PREVIEW_BESTRX_COLUMNS = ['Drug Name', 'NDC #', 'Quantity', 'Total']
+
+def read_preview_bestrx_data(insurance_paths):
+    # BestRx rows of all insurances with the PREVIEW_BESTRX_COLUMNS only, rounded and normalized like read_bestrx_data
+    all_bestrx_data = []
+    for insurance, path in insurance_paths.items():
+        data = pd.read_excel(path, usecols=PREVIEW_BESTRX_COLUMNS, dtype={'NDC #': str})
+        data['Total'] = data['Total'].round(0)
+        data['Insurance'] = insurance
+        all_bestrx_data.append(data)
+    combined_bestrx_data = pd.concat(all_bestrx_data, ignore_index=True)
+    combined_bestrx_data['NDC #'] = combined_bestrx_data['NDC #'].str.replace("-", "").str.zfill(11)
+    return combined_bestrx_data
+
+def get_preview_rollup(combined_bestrx_data, combined_vendor_data, conversion_data):
+    """
+    Get the preview values of every NDC without reconciling the whole report.
+    They are the values get_store_rollup gives for the reconciled data: To Order is the largest
+    shortfall (purchased less billed packages, below 0) of any insurance except ALL_PBM, and
+    Diff$ is the ALL_PBM Total less the billed packages at PRICE.
+    Args:
+        combined_bestrx_data: BestRx rows from read_preview_bestrx_data.
+        combined_vendor_data: Vendor rows from read_vendor_data.
+        conversion_data: The conversion/master data.
+    Returns:
+        One row per NDC with the PREVIEW_COLUMNS, in NDC order.
+    """
+    pkg_size_mapping = conversion_data.set_index('NDC #')['PKG SIZE'].to_dict()
+    price_mapping = conversion_data.set_index('NDC #')['PRICE'].to_dict()
+
+    bestrx_data = combined_bestrx_data.assign(Packages=combined_bestrx_data['Quantity'] / combined_bestrx_data['NDC #'].map(pkg_size_mapping))
+    billed = bestrx_data.pivot_table(index=['NDC #', 'Drug Name'], columns='Insurance', values=['Packages', 'Total'], aggfunc='sum').fillna(0)
+    purchased = pd.to_numeric(combined_vendor_data['Shipped'], errors='coerce').fillna(0).groupby(combined_vendor_data['NDC #']).sum()
+
+    rows = billed.index.to_frame(index=False)
+    rows['Pkg Size'] = rows['NDC #'].map(pkg_size_mapping)
+    rows['PRICE'] = rows['NDC #'].map(price_mapping)
+    # Same as the _D columns of the report, only their negative part is ordered
+    differences = billed['Packages'].drop(columns='ALL_PBM', errors='ignore').rsub(rows['NDC #'].map(purchased).fillna(0).to_numpy(), axis=0)
+    rows['To Order'] = (-differences.clip(upper=0)).max(axis=1).fillna(0).to_numpy()
+    if 'ALL_PBM' in billed['Packages'].columns:
+        rows['Diff$'] = billed[('Total', 'ALL_PBM')].to_numpy() - billed[('Packages', 'ALL_PBM')].to_numpy() * rows['PRICE']
+    else:
+        rows['Diff$'] = 0.0
+
+    rollup = rows.groupby('NDC #').agg({'Drug Name': 'first', 'Pkg Size': 'first', 'PRICE': 'first', 'To Order': 'max', 'Diff$': 'sum'})
+    rollup['Order Price'] = rollup['To Order'] * rollup['PRICE'].fillna(0)
+    return rollup.reset_index()[PREVIEW_COLUMNS]
+
+def build_preview(rollup, top_count):
+    """
+    Get the largest discrepancies of a preview.
+    Args:
+        rollup: The preview values from get_preview_rollup.
+        top_count: Number of NDCs in each list.
+    Returns:
+        The NDCs with the largest absolute Diff$ (ALL_PBM $ difference) and the NDCs with the
+        largest Order Price (To Order * PRICE), largest first, with the PREVIEW_COLUMNS.
+    """
+    # nlargest only selects the top values, the other NDCs are never sorted
+    top_diff = rollup.loc[rollup['Diff$'].abs().nlargest(top_count).index]
+    top_order = rollup[rollup['Order Price'] > 0].nlargest(top_count, 'Order Price')
+    return top_diff, top_order
+
+def preview_files(insurance_paths, vendor_paths, conversion_path, pharmacy_name, date_range, top_count=None):
+    """
+    Get the largest discrepancies of the files, reading only the columns they need and skipping
+    the reconciliation and the workbook entirely.
+    The conversion master is loaded through load_conversion_data, so the report that follows reuses it.
+    Returns:
+        The top Diff$ and top Order Price NDCs from build_preview.
+    """
+    started = time.monotonic()
+    combined_bestrx_data = read_preview_bestrx_data(insurance_paths)
+    combined_vendor_data, _ = read_vendor_data(vendor_paths)
+    conversion_data = load_conversion_data(conversion_path)
+    rollup = get_preview_rollup(combined_bestrx_data, combined_vendor_data, conversion_data)
+    top_diff, top_order = build_preview(rollup, top_count or app.config['PREVIEW_TOP_COUNT'])
+    print(f"Preview of {pharmacy_name} ({date_range}) ready in {time.monotonic() - started:.1f}s")
+    return top_diff, top_order
+
+def get_run_summary(final_data):
+    # One row per NDC with the Drug Name, To Order (0 when nothing needs to be ordered) and every _Diff$ column
+    diff_columns = [col for col in final_data.columns if col.endswith('_Diff$')]
+    summary = final_data.groupby('NDC #').agg({'Drug Name': 'first', **{col: 'sum' for col in diff_columns}})
+    needs_to_order = get_needs_to_order(final_data)[0]
+    summary['To Order'] = needs_to_order.groupby('NDC #')['To Order'].max().reindex(summary.index, fill_value=0)
+    summary.index = summary.index.astype(str)
+    return summary
+
+def read_report_sheet(wb, title, required_columns, header_rows=5):
+    # Data rows of a report sheet, the header is the first row holding all required columns
+    if title not in wb.sheetnames:
+        return None
+    rows = wb[title].iter_rows(values_only=True)
+    for _, row in zip(range(header_rows), rows):
+        if all(col in row for col in required_columns):
+            header = list(row)
+            break
+    else:
+        return None
+    data = pd.DataFrame([row for row in rows if any(value is not None for value in row)])
+    data = data.reindex(columns=range(len(header)))
+    data.columns = header
+    # Drop the autosum row and anything else without an NDC
+    return data[data['NDC #'].notnull()]
+
+def read_previous_report(path):
+    """
+    Read a previously generated report back into the form of get_run_summary.
+    Wide, sparse and long reports are supported. The workbook is streamed read-only and only
+    the "Processed Data" and "Needs to be ordered - All" sheets are read.
+    """
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        processed_data = read_report_sheet(wb, "Processed Data", ['NDC #', 'Drug Name'])
+        needs_to_order = read_report_sheet(wb, "Needs to be ordered - All", ['NDC #', 'To Order'])
+    finally:
+        wb.close()
+    if processed_data is None:
+        raise ValueError(f"{path} is not a generated report, the Processed Data sheet was not found")
+
+    processed_data['NDC #'] = processed_data['NDC #'].astype(str)
+    if 'Insurance' in processed_data.columns:
+        # Long layout: one row per NDC and insurance
+        processed_data['$$ Difference'] = pd.to_numeric(processed_data['$$ Difference'], errors='coerce')
+        diffs = processed_data.pivot_table(index='NDC #', columns='Insurance', values='$$ Difference', aggfunc='sum')
+        diffs.columns = [f'{insurance}_Diff$' for insurance in diffs.columns]
+    else:
+        diff_columns = [col for col in processed_data.columns if isinstance(col, str) and col.endswith('_Diff$')]
+        diffs = processed_data[['NDC #'] + diff_columns].apply(lambda col: col if col.name == 'NDC #' else pd.to_numeric(col, errors='coerce'))
+        diffs = diffs.groupby('NDC #').sum()
+    summary = processed_data.groupby('NDC #')[['Drug Name']].first().join(diffs.fillna(0))
+
+    summary['To Order'] = 0.0
+    if needs_to_order is not None:
+        needs_to_order['NDC #'] = needs_to_order['NDC #'].astype(str)
+        to_order = pd.to_numeric(needs_to_order['To Order'], errors='coerce').groupby(needs_to_order['NDC #']).max()
+        summary['To Order'] = to_order.reindex(summary.index, fill_value=0).fillna(0)
+    return summary
+
+def build_changes(previous, current, to_order_threshold, diff_threshold):
+    """
+    Compare the previous run's summary with the current one, joined on NDC.
+    Args:
+        previous: Summary of the previous report, from read_previous_report.
+        current: Summary of this run, from get_run_summary.
+        to_order_threshold: Smallest To Order change (packages) that is listed.
+        diff_threshold: Smallest change of an insurance's _Diff$ that is listed.
+    Returns:
+        The NDCs that are newly negative (nothing to order before, something now), resolved
+        (the other way round) or changed by more than a threshold, sorted by change and Drug Name.
+    """
+    joined = previous.join(current, how='outer', lsuffix=' (Previous)', rsuffix='')
+    previous_to_order = joined['To Order (Previous)'].fillna(0)
+    to_order = joined['To Order'].fillna(0)
+
+    changes = pd.DataFrame(index=joined.index)
+    changes['Drug Name'] = joined['Drug Name'].fillna(joined['Drug Name (Previous)'])
+    changes['Change'] = ''
+    changes['To Order (Previous)'] = previous_to_order
+    changes['To Order'] = to_order
+    changes['To Order Change'] = to_order - previous_to_order
+
+    # Largest _Diff$ change over the insurances of either run
+    diff_columns = sorted({col for col in previous.columns.union(current.columns) if col.endswith('_Diff$')})
+    diff_changes = pd.DataFrame(index=joined.index)
+    for col in diff_columns:
+        current_diff = joined[col].fillna(0) if col in current.columns else 0.0
+        previous_col = f'{col} (Previous)' if col in current.columns else col
+        previous_diff = joined[previous_col].fillna(0) if col in previous.columns else 0.0
+        diff_changes[col] = current_diff - previous_diff
+    if diff_columns:
+        largest = diff_changes.abs().to_numpy().argmax(axis=1)
+        changes['Diff$ Insurance'] = [diff_columns[i][:-len('_Diff$')] for i in largest]
+        changes['Diff$ Change'] = diff_changes.to_numpy()[range(len(largest)), largest]
+    else:
+        changes['Diff$ Insurance'] = ''
+        changes['Diff$ Change'] = 0.0
+
+    changed = (changes['To Order Change'].abs() > to_order_threshold) | (changes['Diff$ Change'].abs() > diff_threshold)
+    changes.loc[changed, 'Change'] = 'Changed'
+    changes.loc[(previous_to_order > 0) & (to_order == 0), 'Change'] = 'Resolved'
+    changes.loc[(previous_to_order == 0) & (to_order > 0), 'Change'] = 'Newly negative'
+
+    changes = changes[changes['Change'] != ''].rename_axis('NDC #').reset_index()
+    change_order = {'Newly negative': 0, 'Resolved': 1, 'Changed': 2}
+    return changes.sort_values(by=['Change', 'Drug Name'], key=lambda col: col.map(change_order) if col.name == 'Change' else col)
+
+def add_changes_sheet(wb, changes, pharmacy_name, date_range):
+    # "Changes Since Last Run" goes right after Processed Data, it is the first thing to review
+    ws = wb.create_sheet(title="Changes Since Last Run", index=1)
+
+    ws.merge_cells(start_row=1, start_column=1, end_row=1, end_column=len(changes.columns))
+    cell = ws.cell(row=1, column=1)
+    cell.value = f"{pharmacy_name} ({date_range}) - Changes Since Last Run"
+    cell.alignment = Alignment(horizontal='center', vertical='center')
+    cell.font = Font(size=25, bold=True)
+    ws.row_dimensions[1].height = 30
+
+    cell_fill_red = PatternFill(start_color="F88379", end_color="F88379", fill_type="solid")
+    row_fill_blue = PatternFill(start_color="ADD8E6", end_color="ADD8E6", fill_type="solid")
+    thin_border = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
+    change_col = list(changes.columns).index('Change') + 1
+
+    for r_idx, row in enumerate(dataframe_to_rows(changes, index=False, header=True), start=2):
+        for c_idx, value in enumerate(row, start=1):
+            if isinstance(value, float):
+                value = round(value, 2)
+            cell = ws.cell(row=r_idx, column=c_idx, value=value)
+            if r_idx == 2:
+                cell.alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
+                cell.font = Font(size=12, bold=True)
+            else:
+                cell.alignment = Alignment(horizontal='left' if c_idx == 2 else 'center', vertical='center')
+                cell.font = Font(size=12)
+            cell.border = thin_border
+        if r_idx > 2:
+            # Newly negative items need ordering, resolved ones can be ticked off
+            change_cell = ws.cell(row=r_idx, column=change_col)
+            if change_cell.value == 'Newly negative':
+                change_cell.fill = cell_fill_red
+            elif change_cell.value == 'Resolved':
+                change_cell.fill = row_fill_blue
+
+    column_widths = {
+        'A': 15,  # NDC #
+        'B': 60,  # Drug Name
+        'C': 16,  # Change
+    }
+    for col_idx in range(1, len(changes.columns) + 1):
+        col_letter = get_column_letter(col_idx)
+        ws.column_dimensions[col_letter].width = column_widths.get(col_letter, 12)
+    ws.row_dimensions[2].height = 35
+    ws.freeze_panes = 'C3'
+
+    set_print_setup(ws, ws.ORIENTATION_PORTRAIT)
+
+# Only one report job sent over HTTP runs at a time in the resident service. Watched folders are
+# processed one at a time in their own thread without it, so a long watched report does not hold up requests.
+service_job_lock = threading.Lock()
+
+def get_service_url():
+    return f"http://{app.config['SERVICE_HOST']}:{app.config['SERVICE_PORT']}"
+
+def is_service_running(timeout=0.5):
+    # Check whether the resident service is answering on this machine
+    try:
+        with urlopen(f'{get_service_url()}/service/status', timeout=timeout) as response:
+            return response.status == 200
+    except (URLError, OSError):
+        return False
+
+@app.route('/service/status')
+def service_status():
+    return jsonify({
+        'status': 'ok',
+        'master_path': app.config['MASTER_PATH'],
+        'master_loaded_at': master_cache.get('loaded_at'),
+    })
+
+@app.route('/service/process', methods=['POST'])
+def service_process():
+    """
+    Run a report job on files already on disk.
+    Expects JSON with insurance_paths, vendor_paths, pharmacy_name, date_range and optionally
+    conversion_path (defaults to the preloaded master), report_options and job_id.
+    """
+    job = request.get_json(force=True, silent=True)
+    error = get_service_job_error(job)
+    if error:
+        return jsonify({'error': error}), 400
+    conversion_path = job.get('conversion_path') or app.config['MASTER_PATH']
+    if not conversion_path:
+        return jsonify({'error': "No conversion file given and no master preloaded"}), 400
+
+    missing_paths = [path for path in list(job['insurance_paths'].values()) + job['vendor_paths'] + [conversion_path] if not os.path.isfile(path)]
+    if missing_paths:
+        return jsonify({'error': f"Files not found: {', '.join(missing_paths)}"}), 400
+    errors = validate_inputs(job['insurance_paths'], [(os.path.basename(path), path) for path in job['vendor_paths']], conversion_path)
+    if errors:
+        return jsonify({'error': "Invalid input files", 'errors': errors}), 400
+
+    with service_job_lock:
+        try:
+            output_file = process_files(job['insurance_paths'], job['vendor_paths'], conversion_path, job['pharmacy_name'], job['date_range'], job.get('report_options'), job_id=job.get('job_id'))
+        except JobCancelled as e:
+            return jsonify({'error': f"The report was stopped, {e}"}), 409
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+    return jsonify({'output_file': output_file})
+
+def get_service_job_error(job):
+    # What is wrong with the JSON body of a service job, None when it has every field with the right type
+    if not isinstance(job, dict):
+        return "A JSON object is required"
+    missing_fields = [field for field in ['insurance_paths', 'vendor_paths', 'pharmacy_name', 'date_range'] if not job.get(field)]
+    if missing_fields:
+        return f"Missing fields: {', '.join(missing_fields)}"
+    insurance_paths = job['insurance_paths']
+    if not isinstance(insurance_paths, dict) or not all(isinstance(name, str) and isinstance(path, str) for name, path in insurance_paths.items()):
+        return "insurance_paths must map insurance names to file paths"
+    vendor_paths = job['vendor_paths']
+    if not isinstance(vendor_paths, list) or not all(isinstance(path, str) for path in vendor_paths):
+        return "vendor_paths must be a list of file paths"
+    for field in ['pharmacy_name', 'date_range', 'conversion_path', 'job_id']:
+        if job.get(field) is not None and not isinstance(job[field], str):
+            return f"{field} must be a string"
+    if job.get('report_options') is not None and not isinstance(job['report_options'], dict):
+        return "report_options must be a JSON object"
+    return None
+
+def watch_master():
+    # Reload the preloaded master in the background as soon as its file changes
+    while True:
+        time.sleep(app.config['MASTER_WATCH_INTERVAL'])
+        master_path = app.config['MASTER_PATH']
+        if master_path and os.path.exists(master_path):
+            try:
+                get_master_index(load_conversion_data(master_path))
+            except Exception as e:
+                print(f"Could not reload conversion master {master_path}: {e}")
+
+def assign_input_files(paths):
+    """
+    Assign the files of a watched period folder to their slots, like the members of an archive.
+    Returns:
+        The insurance paths, the vendor paths (Kinray first) and the conversion path (None when missing).
+    """
+    insurance_paths = {}
+    kinray_paths = []
+    vendor_paths = []
+    conversion_path = None
+    for path in paths:
+        slot = get_archive_slot(path)
+        if slot is None:
+            continue
+        slot, name = slot
+        if slot == 'conversion':
+            conversion_path = conversion_path or path
+        elif slot == 'bestrx':
+            insurance_paths.setdefault(name, path)
+        elif name == 'kinray':
+            kinray_paths.append(path)
+        else:
+            vendor_paths.append(path)
+    return order_insurance_paths(insurance_paths), kinray_paths + vendor_paths, conversion_path
+
+def load_watch_state():
+    # What was last seen and processed in each watched period folder
+    try:
+        with open(app.config['WATCH_STATE_PATH']) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_watch_state(state):
+    with open(app.config['WATCH_STATE_PATH'], 'w') as f:
+        json.dump(state, f, indent=2)
+
+def get_watch_sets(watch_folder):
+    # (pharmacy name, period, period folder, files) of every period folder in a watched folder
+    for pharmacy_name in sorted(os.listdir(watch_folder)):
+        pharmacy_folder = os.path.join(watch_folder, pharmacy_name)
+        if not os.path.isdir(pharmacy_folder):
+            continue
+        for period in sorted(os.listdir(pharmacy_folder)):
+            period_folder = os.path.join(pharmacy_folder, period)
+            if not os.path.isdir(period_folder):
+                continue
+            files = [os.path.join(period_folder, name) for name in sorted(os.listdir(period_folder))
+                     if not name.startswith(('.', '~$')) and os.path.isfile(os.path.join(period_folder, name))]
+            yield pharmacy_name, period, os.path.abspath(period_folder), files
+
+def process_watch_set(pharmacy_name, period, period_folder, files, state):
+    """
+    Process one watched period folder when it is complete, settled and new.
+    Folders whose file sizes and times did not change since the last look are skipped without
+    reading them. Otherwise the content hash of all files decides, so only new or changed
+    inputs are processed again. The outcome is recorded in state.
+    An incomplete folder is recorded without its files, so it is looked at again on every pass
+    and picked up once the missing files, or a preloaded master, are there.
+    Returns:
+        The path of the generated report, or None when nothing was processed.
+    """
+    if not files:
+        return None
+    file_stats = [os.stat(path) for path in files]
+    # Debounce: files still being copied keep changing their modification time
+    if time.time() - max(stat.st_mtime for stat in file_stats) < app.config['WATCH_DEBOUNCE']:
+        return None
+    stats = [[os.path.basename(path), stat.st_size, stat.st_mtime_ns] for path, stat in zip(files, file_stats)]
+    entry = state.get(period_folder, {})
+    if entry.get('stats') == stats:
+        return None
+
+    insurance_paths, vendor_paths, conversion_path = assign_input_files(files)
+    conversion_path = conversion_path or app.config['MASTER_PATH']
+    if not insurance_paths or not vendor_paths or not conversion_path:
+        if entry.get('status') != 'incomplete':
+            state[period_folder] = {'status': 'incomplete', 'checked_at': time.strftime('%Y-%m-%d %H:%M:%S')}
+            print(f"Waiting for more files in {period_folder}")
+        return None
+
+    content_hash = hashlib.sha256()
+    for path in files:
+        content_hash.update(os.path.basename(path).encode('utf-8'))
+        content_hash.update(file_sha256(path).encode('ascii'))
+    content_hash = content_hash.hexdigest()
+    if entry.get('content_hash') == content_hash:
+        entry['stats'] = stats
+        return None
+
+    state[period_folder] = entry = {'stats': stats, 'content_hash': content_hash, 'checked_at': time.strftime('%Y-%m-%d %H:%M:%S')}
+    errors = validate_inputs(insurance_paths, [(os.path.basename(path), path) for path in vendor_paths], conversion_path)
+    if errors:
+        entry['status'] = format_validation_errors(errors)
+        print(f"Not processing {period_folder}: {entry['status']}")
+        return None
+
+    print(f"Processing {pharmacy_name} ({period}) from {period_folder}")
+    output_file = process_files(insurance_paths, vendor_paths, conversion_path, pharmacy_name, period)
+    entry['status'] = 'processed'
+    entry['output_file'] = output_file
     return output_file
 
+def watch_folders(folders=None):
+    # Look for new or changed period folders in the watched folders until the process stops
+    folders = folders or app.config['WATCH_FOLDERS']
+    state = load_watch_state()
+    saved_state = json.dumps(state, sort_keys=True)
+    print(f"Watching {', '.join(folders)} for new exports")
+    while True:
+        for watch_folder in folders:
+            if not os.path.isdir(watch_folder):
+                continue
+            for pharmacy_name, period, period_folder, files in get_watch_sets(watch_folder):
+                try:
+                    process_watch_set(pharmacy_name, period, period_folder, files, state)
+                except Exception as e:
+                    # Recorded with its content hash, so it is retried only when the files change
+                    state.setdefault(period_folder, {})['status'] = f"Error: {e}"
+                    print(f"Could not process {period_folder}: {e}")
+        # Most passes find nothing new, the state file is only written when something changed
+        state_json = json.dumps(state, sort_keys=True)
+        if state_json != saved_state:
+            save_watch_state(state)
+            saved_state = state_json
+        time.sleep(app.config['WATCH_INTERVAL'])
+
+def run_service(master_path=None):
+    # Keep the processing stack and the conversion master loaded, and accept jobs over HTTP
+    if master_path:
+        app.config['MASTER_PATH'] = os.path.abspath(master_path)
+    if app.config['MASTER_PATH']:
+        get_master_index(load_conversion_data(app.config['MASTER_PATH']))
+        threading.Thread(target=watch_master, daemon=True).start()
+    if app.config['WATCH_FOLDERS']:
+        threading.Thread(target=watch_folders, daemon=True).start()
+    print(f"Pharmacy data service listening on {get_service_url()}")
+    app.run(host=app.config['SERVICE_HOST'], port=app.config['SERVICE_PORT'], threaded=True)
+
+def install_autostart(master_path=None):
+    """
+    Start the resident service with the OS session.
+    Writes a startup entry for the current user: a batch file in the Windows Startup folder,
+    a LaunchAgent on macOS or an autostart desktop entry on Linux.
+    Returns:
+        The path of the startup entry.
+    """
+    if getattr(sys, 'frozen', False):
+        command = [sys.executable, '--service']
+    else:
+        command = [sys.executable, os.path.abspath(__file__), '--service']
+    if master_path:
+        command += ['--master', os.path.abspath(master_path)]
+
+    if sys.platform == 'win32':
+        startup_folder = os.path.join(os.environ['APPDATA'], 'Microsoft', 'Windows', 'Start Menu', 'Programs', 'Startup')
+        entry_path = os.path.join(startup_folder, 'PharmacyDataService.bat')
+        with open(entry_path, 'w') as f:
+            f.write(f'@echo off\ncd /d "{os.path.abspath(".")}"\nstart "" /min ' + ' '.join(f'"{part}"' for part in command) + '\n')
+    elif sys.platform == 'darwin':
+        launch_agents_folder = os.path.join(os.path.expanduser('~'), 'Library', 'LaunchAgents')
+        os.makedirs(launch_agents_folder, exist_ok=True)
+        entry_path = os.path.join(launch_agents_folder, 'com.pharmacydata.service.plist')
+        # plistlib escapes the paths, a folder name with & or < would break a hand written plist
+        launch_agent = {
+            'Label': 'com.pharmacydata.service',
+            'ProgramArguments': command,
+            'WorkingDirectory': os.path.abspath('.'),
+            'RunAtLoad': True,
+        }
+        with open(entry_path, 'wb') as f:
+            plistlib.dump(launch_agent, f)
+    else:
+        autostart_folder = os.path.join(os.path.expanduser('~'), '.config', 'autostart')
+        os.makedirs(autostart_folder, exist_ok=True)
+        entry_path = os.path.join(autostart_folder, 'pharmacy-data-service.desktop')
+        with open(entry_path, 'w') as f:
+            f.write("[Desktop Entry]\nType=Application\nName=Pharmacy Data Service\n"
+                    f"Path={os.path.abspath('.')}\nExec=" + ' '.join(f'"{part}"' for part in command) + "\n")
+    print(f"Autostart entry written to {entry_path}")
+    return entry_path
+
+SHEET_XML_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+RELATIONSHIPS_XML_NS = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+RELATIONSHIP_ID = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id'
+
+def read_package_part(archive, path):
+    # Parsed XML of a part of the workbook package, None when the package has no such part
+    try:
+        with archive.open(path) as source:
+            return ET.parse(source).getroot()
+    except KeyError:
+        return None
+
+def get_part_relationships(archive, part_path):
+    # Targets of the relationships of a part by relationship id, as paths inside the package
+    folder, name = posixpath.split(part_path)
+    relationships = read_package_part(archive, posixpath.join(folder, '_rels', f'{name}.rels'))
+    targets = {}
+    for relationship in (relationships if relationships is not None else []):
+        target = relationship.get('Target')
+        if relationship.get('TargetMode') == 'External':
+            continue
+        targets[relationship.get('Id')] = target.lstrip('/') if target.startswith('/') else posixpath.normpath(posixpath.join(folder, target))
+    return targets
+
+def get_xml_key(element):
+    # Comparable form of an XML element, its canonical XML, so the attribute order does not matter. An empty element counts as missing.
+    if element is None or (not element.attrib and len(element) == 0 and not (element.text or '').strip()):
+        return None
+    return ET.canonicalize(ET.tostring(element, encoding='unicode'), strip_text=True)
+
+def read_workbook_package(archive):
+    """
+    Read the sheet list, the shared strings and the style tables of a workbook package.
+    Only the package XML is used, so the comparison does not depend on openpyxl internals.
+    Returns:
+        Dict with 'sheets' (list of (title, sheet part path)), 'shared_strings', 'cell_styles'
+        (the cellXfs elements), 'number_formats' (custom formats by id), 'fonts', 'fills' and 'borders'.
+    """
+    package_relationships = read_package_part(archive, '_rels/.rels')
+    workbook_path = next(
+        relationship.get('Target').lstrip('/') for relationship in package_relationships
+        if relationship.get('Type', '').endswith('/officeDocument')
+    )
+    workbook = read_package_part(archive, workbook_path)
+    relationships = get_part_relationships(archive, workbook_path)
+    sheets = [(sheet.get('name'), relationships[sheet.get(RELATIONSHIP_ID)]) for sheet in workbook.iter(f'{SHEET_XML_NS}sheet')]
+
+    shared_strings = []
+    shared_strings_path = next((path for path in relationships.values() if path.endswith('sharedStrings.xml')), None)
+    shared_strings_root = read_package_part(archive, shared_strings_path) if shared_strings_path else None
+    for item in (shared_strings_root if shared_strings_root is not None else []):
+        # Plain text or rich text runs, the phonetic hints are not part of the value
+        texts = [item.find(f'{SHEET_XML_NS}t')] if item.find(f'{SHEET_XML_NS}t') is not None else [run.find(f'{SHEET_XML_NS}t') for run in item.iter(f'{SHEET_XML_NS}r')]
+        shared_strings.append(''.join(text.text or '' for text in texts if text is not None))
+
+    styles_path = next((path for path in relationships.values() if path.endswith('styles.xml')), None)
+    styles = read_package_part(archive, styles_path) if styles_path else None
+
+    def get_table(name, child):
+        table = styles.find(f'{SHEET_XML_NS}{name}') if styles is not None else None
+        return list(table.iter(f'{SHEET_XML_NS}{child}')) if table is not None else []
+
+    return {
+        'sheets': sheets,
+        'shared_strings': shared_strings,
+        'cell_styles': get_table('cellXfs', 'xf'),
+        'number_formats': {int(number_format.get('numFmtId')): number_format.get('formatCode') for number_format in get_table('numFmts', 'numFmt')},
+        'fonts': get_table('fonts', 'font'),
+        'fills': get_table('fills', 'fill'),
+        'borders': get_table('borders', 'border'),
+    }
+
+def iter_sheet_cells(archive, sheet_path, shared_strings, sheet_info):
+    """
+    Stream the cells of a worksheet straight from its XML in the workbook package.
+    Yields (row, column, value, formula, style index) in sheet order. The merged ranges, the
+    frozen pane, the row heights and the column widths are put into sheet_info once the sheet has been read.
+    """
+    sheet_info['merged_cells'] = set()
+    sheet_info['freeze_panes'] = None
+    sheet_info['rows'] = {}
+    sheet_info['columns'] = {}
+    sheet_info['default_row_height'] = None
+    column_indices = {}
+    with archive.open(sheet_path) as source:
+        for _, element in ET.iterparse(source):
+            tag = element.tag
+            if tag == f'{SHEET_XML_NS}c':
+                coordinate = element.get('r')
+                column_letter = coordinate.rstrip('0123456789')
+                if column_letter not in column_indices:
+                    column_indices[column_letter] = column_index_from_string(column_letter)
+                cell_type = element.get('t', 'n')
+                value_element = element.find(f'{SHEET_XML_NS}v')
+                formula_element = element.find(f'{SHEET_XML_NS}f')
+                value = value_element.text if value_element is not None else None
+                if cell_type == 's' and value is not None:
+                    value = shared_strings[int(value)]
+                elif cell_type == 'inlineStr':
+                    value = ''.join(text.text or '' for text in element.iter(f'{SHEET_XML_NS}t'))
+                elif cell_type == 'n' and value is not None:
+                    value = float(value)
+                formula = formula_element.text if formula_element is not None else None
+                yield int(coordinate[len(column_letter):]), column_indices[column_letter], value, formula, int(element.get('s', 0))
+                element.clear()
+            elif tag == f'{SHEET_XML_NS}row':
+                if element.get('ht') is not None or element.get('hidden') in ('1', 'true'):
+                    sheet_info['rows'][int(element.get('r'))] = (element.get('ht') and float(element.get('ht')), element.get('hidden') in ('1', 'true'))
+                element.clear()
+            elif tag == f'{SHEET_XML_NS}col':
+                sheet_info['columns'][(int(element.get('min')), int(element.get('max')))] = (element.get('width') and float(element.get('width')), element.get('hidden') in ('1', 'true'))
+            elif tag == f'{SHEET_XML_NS}sheetFormatPr':
+                sheet_info['default_row_height'] = element.get('defaultRowHeight') and float(element.get('defaultRowHeight'))
+            elif tag == f'{SHEET_XML_NS}pane' and element.get('state') in ('frozen', 'frozenSplit'):
+                sheet_info['freeze_panes'] = element.get('topLeftCell')
+            elif tag == f'{SHEET_XML_NS}mergeCell':
+                sheet_info['merged_cells'].add(element.get('ref'))
+
+def get_cell_style(package, style_index, style_cache):
+    # Resolved style of a cellXfs index as comparable parts, cached per workbook
+    if style_index not in style_cache:
+        cell_style = package['cell_styles'][style_index] if style_index < len(package['cell_styles']) else ET.Element('xf')
+
+        def get_table_entry(table, attribute):
+            entries = package[table]
+            entry_id = int(cell_style.get(attribute, 0))
+            return get_xml_key(entries[entry_id]) if entry_id < len(entries) else None
+
+        number_format_id = int(cell_style.get('numFmtId', 0))
+        style_cache[style_index] = {
+            'number_format': package['number_formats'].get(number_format_id, BUILTIN_FORMATS.get(number_format_id, 'General')),
+            'font': get_table_entry('fonts', 'fontId'),
+            'fill': get_table_entry('fills', 'fillId'),
+            'border': get_table_entry('borders', 'borderId'),
+            'alignment': get_xml_key(cell_style.find(f'{SHEET_XML_NS}alignment')),
+            'protection': get_xml_key(cell_style.find(f'{SHEET_XML_NS}protection')),
+        }
+    return style_cache[style_index]
+
+def compare_workbooks(path_a, path_b, max_differences=100):
+    """
+    Compare two report workbooks cell by cell.
+    Both workbooks are streamed from their package XML: the cells of a sheet are merge-joined
+    by position straight from the sheet XML, and styles are resolved once per style index.
+    Args:
+        path_a: The reference workbook.
+        path_b: The workbook to check.
+        max_differences: Number of differences returned in detail, all of them are counted.
+    Returns:
+        A Counter of (sheet, kind) to number of differences, and up to max_differences of
+        (sheet, cell, kind, value in a, value in b). The kinds are sheet, merged_cells,
+        freeze_panes, row_dimensions, column_dimensions, default_row_height, value, formula,
+        number_format, font, fill, border, alignment and protection.
+    """
+    counts = Counter()
+    differences = []
+
+    def add_difference(sheet, cell, kind, value_a, value_b):
+        counts[(sheet, kind)] += 1
+        if len(differences) < max_differences:
+            differences.append((sheet, cell, kind, value_a, value_b))
+
+    archive_a = zipfile.ZipFile(path_a)
+    archive_b = zipfile.ZipFile(path_b)
+    try:
+        package_a = read_workbook_package(archive_a)
+        package_b = read_workbook_package(archive_b)
+        sheets_a, sheets_b = dict(package_a['sheets']), dict(package_b['sheets'])
+        if list(sheets_a) != list(sheets_b):
+            add_difference('', '', 'sheet', list(sheets_a), list(sheets_b))
+        style_cache_a, style_cache_b = {}, {}
+        # Differing style parts of each (style index in a, style index in b) pair seen so far
+        style_pair_differences = {}
+        empty_cell = (None, None, 0)
+
+        for title in [title for title in sheets_a if title in sheets_b]:
+            info_a, info_b = {}, {}
+            cells_a = iter_sheet_cells(archive_a, sheets_a[title], package_a['shared_strings'], info_a)
+            cells_b = iter_sheet_cells(archive_b, sheets_b[title], package_b['shared_strings'], info_b)
+            cell_a, cell_b = next(cells_a, None), next(cells_b, None)
+            while cell_a is not None or cell_b is not None:
+                # Merge-join on (row, column), a cell missing on one side compares as empty
+                position_a = cell_a[:2] if cell_a is not None else None
+                position_b = cell_b[:2] if cell_b is not None else None
+                if position_b is None or (position_a is not None and position_a < position_b):
+                    position, values_a, values_b = position_a, cell_a[2:], empty_cell
+                    cell_a = next(cells_a, None)
+                elif position_a is None or position_b < position_a:
+                    position, values_a, values_b = position_b, empty_cell, cell_b[2:]
+                    cell_b = next(cells_b, None)
+                else:
+                    position, values_a, values_b = position_a, cell_a[2:], cell_b[2:]
+                    cell_a, cell_b = next(cells_a, None), next(cells_b, None)
+
+                value_a, formula_a, style_a = values_a
+                value_b, formula_b, style_b = values_b
+                style_pair = (style_a, style_b)
+                if style_pair not in style_pair_differences:
+                    parts_a = get_cell_style(package_a, style_a, style_cache_a)
+                    parts_b = get_cell_style(package_b, style_b, style_cache_b)
+                    style_pair_differences[style_pair] = [(part, part_a, parts_b[part]) for part, part_a in parts_a.items() if part_a != parts_b[part]]
+                if formula_a == formula_b and (formula_a is not None or value_a == value_b) and not style_pair_differences[style_pair]:
+                    continue
+
+                coordinate = f'{get_column_letter(position[1])}{position[0]}'
+                if formula_a != formula_b:
+                    add_difference(title, coordinate, 'formula', formula_a, formula_b)
+                elif formula_a is None and value_a != value_b:
+                    add_difference(title, coordinate, 'value', value_a, value_b)
+                for part, part_a, part_b in style_pair_differences[style_pair]:
+                    add_difference(title, coordinate, part, part_a, part_b)
+
+            if info_a['merged_cells'] != info_b['merged_cells']:
+                add_difference(title, '', 'merged_cells', sorted(info_a['merged_cells'] - info_b['merged_cells']), sorted(info_b['merged_cells'] - info_a['merged_cells']))
+            if info_a['freeze_panes'] != info_b['freeze_panes']:
+                add_difference(title, '', 'freeze_panes', info_a['freeze_panes'], info_b['freeze_panes'])
+            if info_a['default_row_height'] != info_b['default_row_height']:
+                add_difference(title, '', 'default_row_height', info_a['default_row_height'], info_b['default_row_height'])
+            for row_idx in sorted(set(info_a['rows']) | set(info_b['rows'])):
+                if info_a['rows'].get(row_idx) != info_b['rows'].get(row_idx):
+                    add_difference(title, str(row_idx), 'row_dimensions', info_a['rows'].get(row_idx), info_b['rows'].get(row_idx))
+            for columns in sorted(set(info_a['columns']) | set(info_b['columns'])):
+                if info_a['columns'].get(columns) != info_b['columns'].get(columns):
+                    column_range = f'{get_column_letter(columns[0])}:{get_column_letter(columns[1])}'
+                    add_difference(title, column_range, 'column_dimensions', info_a['columns'].get(columns), info_b['columns'].get(columns))
+    finally:
+        archive_a.close()
+        archive_b.close()
+    return counts, differences
+
+def run_diff(args):
+    # Print the differences between two workbooks, exit status 1 when they differ
+    started = time.monotonic()
+    counts, differences = compare_workbooks(args.reference, args.candidate, args.max_differences)
+    for sheet, cell, kind, value_a, value_b in differences:
+        print(f"{sheet}!{cell} {kind}: {value_a!r} != {value_b!r}")
+    for (sheet, kind), count in sorted(counts.items()):
+        print(f"{sheet or 'workbook'}: {count} {kind} difference(s)")
+    print(f"{sum(counts.values())} difference(s) found in {time.monotonic() - started:.1f}s")
+    return 1 if counts else 0
+
+# (AGGREGATION_WORKERS, SHEET_WORKERS) of the report check runs, the first one is the serial reference
+CHECK_CONFIGURATIONS = [(1, 1), (2, 1), (1, 2), (2, 2)]
+
+def make_check_inputs(folder, ndc_count, seed):
+    """
+    Write synthetic BestRx, vendor and conversion files for the report check.
+    Some NDCs have no item number (missing items), some have two drug names, and the
+    insurances and vendors each cover a random half of the NDCs.
+    Returns:
+        The insurance paths, the vendor paths and the conversion path.
+    """
+    rnd = random.Random(seed)
+    ndcs = [f"{rnd.randint(10000, 99999)}-{rnd.randint(1000, 9999)}-{rnd.randint(10, 99)}" for _ in range(ndc_count)]
+    drug_names = [f"{rnd.choice(['AMOXICILLIN', 'LISINOPRIL', 'METFORMIN', 'ATORVASTATIN', 'OMEPRAZOLE'])} {rnd.randint(1, 500)}MG TAB" for _ in range(ndc_count)]
+    conversion_data = pd.DataFrame({
+        'DRUG NAME': drug_names,
+        'ITEM NO': [f'IT{i}' if i % 17 else None for i in range(ndc_count)],
+        'NDC #': ndcs,
+        'PKG SIZE': [rnd.choice([30, 90, 100, 500]) for _ in range(ndc_count)],
+        'PRICE': [round(rnd.uniform(1, 200), 2) for _ in range(ndc_count)],
+    })
+    conversion_path = os.path.join(folder, 'conversion.xlsx')
+    conversion_data.to_excel(conversion_path, index=False)
+
+    insurance_paths = {}
+    for insurance in ['ALL_PBM', 'CVS', 'ESI', 'OPTUM', 'MEDIMP', 'NYM', 'CAREMARK']:
+        rows = rnd.sample(range(ndc_count), ndc_count // 2)
+        bestrx_data = pd.DataFrame({
+            'Drug Name': [drug_names[row] if row % 23 else f'{drug_names[row]} (GENERIC)' for row in rows],
+            'NDC #': [ndcs[row] for row in rows],
+            'Total Rxs': [rnd.randint(1, 5) for _ in rows],
+            'Quantity': [rnd.randint(1, 400) for _ in rows],
+            'Total': [round(rnd.uniform(1, 900), 2) for _ in rows],
+        })
+        insurance_paths[insurance] = os.path.join(folder, f'{insurance}.xlsx')
+        bestrx_data.to_excel(insurance_paths[insurance], index=False)
+
+    vendor_paths = []
+    for vendor_name in ['kinray', 'vendor1', 'vendor2']:
+        rows = rnd.sample(range(ndc_count), ndc_count // 2)
+        vendor_paths.append(os.path.join(folder, f'{vendor_name}.xlsx'))
+        pd.DataFrame({'NDC #': [ndcs[row] for row in rows], 'Shipped': [rnd.randint(0, 5) for _ in rows]}).to_excel(vendor_paths[-1], index=False)
+    return insurance_paths, vendor_paths, conversion_path
+
+def run_check(args):
+    """
+    Check that the parallel paths write the same reports as the serial one: generate synthetic
+    inputs, write the report of every layout with each of CHECK_CONFIGURATIONS and compare it
+    with compare_workbooks against the serial report. Run it after changing the report writer
+    or upgrading openpyxl.
+    Returns:
+        The exit status, 1 when a report differs.
+    """
+    folder = tempfile.mkdtemp(prefix='report-check-')
+    saved_config = {key: app.config[key] for key in ['AGGREGATION_WORKERS', 'SHEET_WORKERS', 'WAREHOUSE_ENABLED']}
+    app.config['WAREHOUSE_ENABLED'] = False
+    failed = False
+    try:
+        insurance_paths, vendor_paths, conversion_path = make_check_inputs(folder, args.ndcs, args.seed)
+        for layout in REPORT_LAYOUTS:
+            reference_path = None
+            for aggregation_workers, sheet_workers in CHECK_CONFIGURATIONS:
+                app.config['AGGREGATION_WORKERS'] = aggregation_workers
+                app.config['SHEET_WORKERS'] = sheet_workers
+                output_file = process_files(insurance_paths, vendor_paths, conversion_path, "Report check", "January 2024",
+                                            {'layout': layout}, use_cache=False)
+                report_path = os.path.join(folder, f'{layout}-{aggregation_workers}-{sheet_workers}.xlsx')
+                shutil.move(output_file, report_path)
+                if reference_path is None:
+                    reference_path = report_path
+                    continue
+
+                counts, differences = compare_workbooks(reference_path, report_path, args.max_differences)
+                name = f"{layout} layout, {aggregation_workers} aggregation and {sheet_workers} sheet worker(s)"
+                if counts:
+                    failed = True
+                    print(f"FAILED {name}: {sum(counts.values())} difference(s) from the serial report")
+                    for sheet, cell, kind, value_a, value_b in differences:
+                        print(f"  {sheet}!{cell} {kind}: {value_a!r} != {value_b!r}")
+                else:
+                    print(f"OK {name}")
+    finally:
+        app.config.update(saved_config)
+        if args.keep:
+            print(f"Inputs and reports kept in {folder}")
+        else:
+            shutil.rmtree(folder, ignore_errors=True)
+    return 1 if failed else 0
+
+def get_cli_input_paths(args):
+    # Insurance paths, vendor paths and conversion path (None when not given) of the process and preview commands
+    insurance_paths = {}
+    vendor_paths = []
+    conversion_path = None
+    if args.archive:
+        archive_folder = os.path.abspath(make_archive_folder())
+        atexit.register(shutil.rmtree, archive_folder, True)
+        try:
+            insurance_paths, vendor_paths, conversion_path = extract_archive(args.archive, archive_folder)
+        except (ValueError, zipfile.BadZipFile) as e:
+            raise SystemExit(f"Could not use {args.archive}: {e}")
+    elif not args.insurance or not args.vendor:
+        raise SystemExit("--archive or both --insurance and --vendor are required")
+    for insurance in args.insurance or []:
+        name, _, path = insurance.partition('=')
+        insurance_paths[name] = os.path.abspath(path)
+    vendor_paths += [os.path.abspath(path) for path in args.vendor or []]
+    if args.conversion:
+        conversion_path = os.path.abspath(args.conversion)
+    return insurance_paths, vendor_paths, conversion_path
+
+def run_cli_job(args):
+    # Run one report from the command line, on the resident service when it is running
+    insurance_paths, vendor_paths, conversion_path = get_cli_input_paths(args)
+    report_options = {'layout': args.layout}
+    if args.compression_level is not None:
+        report_options['compression_level'] = args.compression_level
+    if args.previous:
+        report_options['previous_report'] = os.path.abspath(args.previous)
+        report_options['to_order_threshold'] = args.to_order_threshold
+        report_options['diff_threshold'] = args.diff_threshold
+
+    if is_service_running():
+        job = {
+            'insurance_paths': insurance_paths,
+            'vendor_paths': vendor_paths,
+            'conversion_path': conversion_path,
+            'pharmacy_name': args.pharmacy_name,
+            'date_range': args.date_range,
+            'report_options': report_options,
+        }
+        service_request = Request(f'{get_service_url()}/service/process', data=json.dumps(job).encode('utf-8'), headers={'Content-Type': 'application/json'})
+        try:
+            with urlopen(service_request) as response:
+                output_file = json.loads(response.read())['output_file']
+        except HTTPError as e:
+            raise SystemExit(f"The service did not run the report: {e.read().decode('utf-8', 'replace')}")
+    else:
+        if not conversion_path:
+            raise SystemExit("--conversion is required when the service is not running")
+        try:
+            output_file = process_files(insurance_paths, vendor_paths, conversion_path, args.pharmacy_name, args.date_range, report_options)
+        except JobCancelled as e:
+            raise SystemExit(f"The report was stopped, {e}")
+    print(f"Report saved at: {output_file}")
+    return output_file
+
+def run_preview_job(args):
+    # Print the largest discrepancies from the command line, without generating the report
+    insurance_paths, vendor_paths, conversion_path = get_cli_input_paths(args)
+    if not conversion_path:
+        raise SystemExit("--conversion is required when the archive has no master")
+    if args.top < 1:
+        raise SystemExit("--top must be at least 1")
+    top_diff, top_order = preview_files(insurance_paths, vendor_paths, conversion_path, args.pharmacy_name, args.date_range, args.top)
+    print(f"Largest Diff$ ({args.pharmacy_name}, {args.date_range}):")
+    print(top_diff.to_string(index=False))
+    print()
+    print(f"Largest Order Price ({args.pharmacy_name}, {args.date_range}):")
+    print(top_order.to_string(index=False))
+    return top_diff, top_order
+
+def run_chain_job(args):
+    # Roll the stores' archives up from the command line
+    stores = []
+    conversion_path = os.path.abspath(args.conversion) if args.conversion else None
+    for store in args.store:
+        store_name, _, archive = store.partition('=')
+        archive_folder = os.path.abspath(make_archive_folder())
+        atexit.register(shutil.rmtree, archive_folder, True)
+        try:
+            insurance_paths, vendor_paths, archive_conversion_path = extract_archive(archive, archive_folder)
+        except (ValueError, zipfile.BadZipFile) as e:
+            raise SystemExit(f"Could not use {archive}: {e}")
+        conversion_path = conversion_path or archive_conversion_path
+        stores.append((store_name, insurance_paths, vendor_paths))
+    if not conversion_path:
+        raise SystemExit("--conversion is required when no archive has a master")
+    errors = validate_group_inputs(stores, conversion_path)
+    if errors:
+        raise SystemExit(format_validation_errors(errors))
+    return process_chain_files(stores, conversion_path, args.chain_name, args.date_range, args.workers)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Pharmacy Data Processing Application")
+    parser.add_argument('--service', action='store_true', help="Run the resident background service instead of the window")
+    parser.add_argument('--master', help="Conversion master to preload in the service")
+    parser.add_argument('--install-autostart', action='store_true', help="Start the service with the OS session")
+    parser.add_argument('--watch', action='append', help="Watch this folder for <pharmacy>/<period> exports and process them, repeatable")
+    subparsers = parser.add_subparsers(dest='command')
+    process_parser = subparsers.add_parser('process', help="Generate a report from files on disk")
+    process_parser.add_argument('--pharmacy-name', required=True)
+    process_parser.add_argument('--date-range', required=True)
+    process_parser.add_argument('--archive', help="Zip archive of the month's exports, each file is assigned by its name and header")
+    process_parser.add_argument('--insurance', action='append', help="NAME=path, in column order (ALL_PBM first)")
+    process_parser.add_argument('--vendor', action='append', help="Vendor file, Kinray first")
+    process_parser.add_argument('--conversion', help="Conversion/master file, defaults to the service's preloaded master")
+    process_parser.add_argument('--layout', choices=REPORT_LAYOUTS, default=app.config['REPORT_LAYOUT'], help="Layout of the Processed Data sheet")
+    process_parser.add_argument('--previous', help="Previous report, adds a Changes Since Last Run sheet")
+    process_parser.add_argument('--compression-level', type=int, choices=range(10), help="zlib level of the saved report, 0 stores it uncompressed")
+    process_parser.add_argument('--to-order-threshold', type=float, default=app.config['DELTA_TO_ORDER_THRESHOLD'])
+    process_parser.add_argument('--diff-threshold', type=float, default=app.config['DELTA_DIFF_THRESHOLD'])
+    preview_parser = subparsers.add_parser('preview', help="Print the largest discrepancies without generating the report")
+    preview_parser.add_argument('--pharmacy-name', required=True)
+    preview_parser.add_argument('--date-range', required=True)
+    preview_parser.add_argument('--archive', help="Zip archive of the month's exports, each file is assigned by its name and header")
+    preview_parser.add_argument('--insurance', action='append', help="NAME=path, in column order (ALL_PBM first)")
+    preview_parser.add_argument('--vendor', action='append', help="Vendor file, Kinray first")
+    preview_parser.add_argument('--conversion', help="Conversion/master file, defaults to the master in the archive")
+    preview_parser.add_argument('--top', type=int, default=app.config['PREVIEW_TOP_COUNT'], help="Number of NDCs in each list")
+    chain_parser = subparsers.add_parser('chain', help="Roll several stores of a chain up into one report")
+    chain_parser.add_argument('--chain-name', required=True)
+    chain_parser.add_argument('--date-range', required=True)
+    chain_parser.add_argument('--store', action='append', required=True, help="NAME=archive.zip, one zip archive of exports per store")
+    chain_parser.add_argument('--conversion', help="Conversion/master file, defaults to the master in the first archive that has one")
+    chain_parser.add_argument('--workers', type=int, help="Number of stores reconciled in parallel")
+    diff_parser = subparsers.add_parser('diff', help="Compare two report workbooks cell by cell")
+    diff_parser.add_argument('reference', help="Reference workbook, such as the output of the current version")
+    diff_parser.add_argument('candidate', help="Workbook to check against the reference")
+    diff_parser.add_argument('--max-differences', type=int, default=100, help="Number of differences listed in detail")
+    check_parser = subparsers.add_parser('check', help="Check that the parallel report paths write the same workbook as the serial one")
+    check_parser.add_argument('--ndcs', type=int, default=500, help="Number of NDCs in the synthetic inputs")
+    check_parser.add_argument('--seed', type=int, default=1)
+    check_parser.add_argument('--max-differences', type=int, default=20, help="Number of differences listed in detail per report")
+    check_parser.add_argument('--keep', action='store_true', help="Keep the synthetic inputs and the reports")
+    return parser.parse_args(argv)
+
 if __name__ == '__main__':
-    window = webview.create_window('Pharmacy Data Processing Application with price', app, width=800, height=screen_height)
-    webview.start()
+    # Needed for the aggregation worker processes in the packaged app
+    multiprocessing.freeze_support()
+    args = parse_args()
+    if args.install_autostart:
+        install_autostart(args.master)
+    elif args.service:
+        if args.watch:
+            app.config['WATCH_FOLDERS'] = [os.path.abspath(folder) for folder in args.watch]
+        run_service(args.master)
+    elif args.watch:
+        if args.master:
+            app.config['MASTER_PATH'] = os.path.abspath(args.master)
+        watch_folders([os.path.abspath(folder) for folder in args.watch])
+    elif args.command == 'process':
+        run_cli_job(args)
+    elif args.command == 'preview':
+        run_preview_job(args)
+    elif args.command == 'chain':
+        run_chain_job(args)
+    elif args.command == 'diff':
+        sys.exit(run_diff(args))
+    elif args.command == 'check':
+        sys.exit(run_check(args))
+    else:
+        # Use the resident service when it is running, it already has everything loaded
+        window_target = get_service_url() if is_service_running() else app
+        screen_width, screen_height = get_screen_size()
+        window = webview.create_window('Pharmacy Data Processing Application with price', window_target, width=800, height=screen_height)
+        webview.start()
@@ -0,0 +1,82 @@
+"""
+Shared fixtures of the test suite.
+app$.py is not an importable module name, it is loaded from its path as the "app" module.
+"""
+import importlib
+import importlib.util
+import os
+import sys
+import types
+
+import pandas as pd
+import pytest
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app$.py')
+
+def install_window_modules():
+    # The window modules are only used when the app is opened as a desktop window, headless runs may not have them
+    for name in ['webview', 'flaskwebgui', 'tkinter']:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            sys.modules[name] = types.ModuleType(name)
+    if not hasattr(sys.modules['flaskwebgui'], 'FlaskUI'):
+        sys.modules['flaskwebgui'].FlaskUI = object
+    if not hasattr(sys.modules['tkinter'], 'filedialog'):
+        sys.modules['tkinter'].filedialog = sys.modules['tkinter.filedialog'] = types.ModuleType('tkinter.filedialog')
+
+@pytest.fixture(scope='session')
+def app_module(tmp_path_factory):
+    # The app creates its upload, processed and cache folders in the working directory when it is loaded
+    folder = tmp_path_factory.mktemp('app')
+    cwd = os.getcwd()
+    os.chdir(folder)
+    install_window_modules()
+    spec = importlib.util.spec_from_file_location('app', APP_PATH)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['app'] = module
+    spec.loader.exec_module(module)
+    module.app.config.update({'TESTING': True, 'RESULT_CACHE_ENABLED': False, 'WAREHOUSE_ENABLED': False})
+    yield module
+    os.chdir(cwd)
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+@pytest.fixture
+def downloads(monkeypatch, tmp_path):
+    # Reports are written to ~/Downloads
+    monkeypatch.setenv('HOME', str(tmp_path))
+    folder = tmp_path / 'Downloads'
+    folder.mkdir()
+    return folder
+
+@pytest.fixture
+def store_inputs():
+    # A small store: three NDCs, one without an item number, billed by two insurances and bought from one vendor
+    bestrx_data = pd.DataFrame({
+        'Drug Name': ['AMOXICILLIN 500MG CAP', 'LISINOPRIL 10MG TAB', 'AMOXICILLIN 500MG CAP', 'METFORMIN 500MG TAB', 'LISINOPRIL 10MG TAB'],
+        'NDC #': ['00093-3109-01', '68180-0514-01', '00093-3109-01', '00378-0234-10', '68180-0514-01'],
+        'Total Rxs': [1, 2, 1, 1, 3],
+        'Quantity': [200, 90, 100, 60, 180],
+        'Total': [40.0, 12.0, 20.0, 9.0, 30.0],
+        'Insurance': ['ALL_PBM', 'ALL_PBM', 'CVS', 'CVS', 'CVS'],
+    })
+    bestrx_data['NDC #'] = bestrx_data['NDC #'].str.replace("-", "")
+    vendor_data = pd.DataFrame({'NDC #': ['00093310901', '68180051401'], 'Shipped': [1.0, 5.0], 'Vendor': ['Vendor1', 'Vendor1']})
+    conversion_data = pd.DataFrame({
+        'DRUG NAME': ['AMOXICILLIN 500MG CAP', 'LISINOPRIL 10MG TAB', 'METFORMIN 500MG TAB'],
+        'ITEM NO': ['IT1', 'IT2', None],
+        'NDC #': ['00093310901', '68180051401', '00378023410'],
+        'PKG SIZE': [100, 90, 1000],
+        'PRICE': [10.0, 4.0, 15.0],
+    })
+    return bestrx_data, vendor_data, ['Vendor1'], conversion_data, ['ALL_PBM', 'CVS']
+
+@pytest.fixture
+def stored_result(app_module, store_inputs):
+    # Id of a result in the results store, reconciled from store_inputs
+    bestrx_data, vendor_data, vendor_names, conversion_data, insurance_names = store_inputs
+    final_data, missing_items = app_module.reconcile_data(bestrx_data, vendor_data, vendor_names, conversion_data, insurance_names)
+    return app_module.store_result(final_data, missing_items, insurance_names, vendor_names, "Test Pharmacy", "January 2024")
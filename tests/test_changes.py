@@ -0,0 +1,35 @@
+import pandas as pd
+
+def summary(rows):
+    # A run summary as get_run_summary gives it: Drug Name, the _Diff$ columns and To Order by NDC
+    return pd.DataFrame(rows, columns=['NDC #', 'Drug Name', 'CVS_Diff$', 'ESI_Diff$', 'To Order']).set_index('NDC #')
+
+def test_build_changes_lists_new_resolved_and_changed_ndcs(app_module):
+    previous = summary([
+        ('00000000001', 'ASPIRIN', 0.0, 0.0, 0.0),
+        ('00000000002', 'IBUPROFEN', 0.0, 0.0, 3.0),
+        ('00000000003', 'NAPROXEN', 10.0, 0.0, 1.0),
+        ('00000000004', 'ACETAMINOPHEN', 5.0, 5.0, 2.0),
+    ])
+    current = summary([
+        ('00000000001', 'ASPIRIN', 0.0, 0.0, 2.0),
+        ('00000000002', 'IBUPROFEN', 0.0, 0.0, 0.0),
+        ('00000000003', 'NAPROXEN', 10.0, -90.0, 1.0),
+        ('00000000004', 'ACETAMINOPHEN', 5.5, 5.0, 2.5),
+    ])
+    changes = app_module.build_changes(previous, current, to_order_threshold=1, diff_threshold=50)
+    assert changes['NDC #'].tolist() == ['00000000001', '00000000002', '00000000003']
+    assert changes['Change'].tolist() == ['Newly negative', 'Resolved', 'Changed']
+    assert changes['To Order Change'].tolist() == [2.0, -3.0, 0.0]
+    changed = changes.iloc[2]
+    assert changed['Diff$ Insurance'] == 'ESI'
+    assert changed['Diff$ Change'] == -90.0
+
+def test_build_changes_joins_ndcs_of_either_run(app_module):
+    previous = summary([('00000000001', 'ASPIRIN', 0.0, 0.0, 4.0)])
+    current = summary([('00000000002', 'IBUPROFEN', 0.0, 0.0, 1.0)]).drop(columns='ESI_Diff$')
+    changes = app_module.build_changes(previous, current, to_order_threshold=1, diff_threshold=50).set_index('NDC #')
+    assert changes.loc['00000000001', 'Change'] == 'Resolved'
+    assert changes.loc['00000000001', 'Drug Name'] == 'ASPIRIN'
+    assert changes.loc['00000000002', 'Change'] == 'Newly negative'
+    assert changes.loc['00000000002', 'To Order (Previous)'] == 0
@@ -0,0 +1,62 @@
+from openpyxl import Workbook, load_workbook
+from openpyxl.styles import Font, PatternFill
+import pytest
+
+def save_workbook(path, value='ASPIRIN', fill='ADD8E6', merged=True, freeze='A3', formula='=B3*2', hidden=False):
+    # A small report-like sheet, the arguments are the parts a test changes
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "Processed Data"
+    ws['A1'] = "Test Pharmacy (January 2024)"
+    ws['A1'].font = Font(size=25, bold=True)
+    if merged:
+        ws.merge_cells('A1:C1')
+    ws.append([])
+    ws['A2'], ws['B2'], ws['C2'] = 'Drug Name', 'Quantity', 'Packages'
+    ws['A3'], ws['B3'], ws['C3'] = value, 30, formula
+    ws['B3'].number_format = '0.00'
+    ws['A3'].fill = PatternFill(start_color=fill, end_color=fill, fill_type='solid')
+    ws.freeze_panes = freeze
+    ws.column_dimensions['A'].width = 30
+    ws.row_dimensions[3].hidden = hidden
+    wb.create_sheet("Missing Items")['A1'] = "NDC #"
+    wb.save(path)
+    return str(path)
+
+@pytest.fixture
+def reference(tmp_path):
+    return save_workbook(tmp_path / 'reference.xlsx')
+
+def test_same_workbooks_have_no_differences(app_module, tmp_path, reference):
+    counts, differences = app_module.compare_workbooks(reference, save_workbook(tmp_path / 'same.xlsx'))
+    assert not counts
+    assert differences == []
+
+@pytest.mark.parametrize('changes, kind, cell', [
+    ({'value': 'IBUPROFEN'}, 'value', 'A3'),
+    ({'fill': 'F88379'}, 'fill', 'A3'),
+    ({'formula': '=B3*3'}, 'formula', 'C3'),
+    ({'merged': False}, 'merged_cells', ''),
+    ({'freeze': 'B3'}, 'freeze_panes', ''),
+    ({'hidden': True}, 'row_dimensions', '3'),
+])
+def test_each_kind_of_difference_is_found(app_module, tmp_path, reference, changes, kind, cell):
+    counts, differences = app_module.compare_workbooks(reference, save_workbook(tmp_path / 'changed.xlsx', **changes))
+    assert counts == {("Processed Data", kind): 1}
+    sheet, difference_cell, difference_kind, _, _ = differences[0]
+    assert (sheet, difference_kind) == ("Processed Data", kind)
+    if cell:
+        assert difference_cell == cell
+
+def test_differences_are_counted_beyond_the_detail_limit(app_module, tmp_path, reference):
+    counts, differences = app_module.compare_workbooks(reference, save_workbook(tmp_path / 'changed.xlsx', value='IBUPROFEN', fill='F88379', freeze='B3'), max_differences=1)
+    assert sum(counts.values()) == 3
+    assert len(differences) == 1
+
+def test_missing_sheets_are_reported(app_module, tmp_path, reference):
+    path = save_workbook(tmp_path / 'changed.xlsx')
+    wb = load_workbook(path)
+    del wb["Missing Items"]
+    wb.save(path)
+    counts, _ = app_module.compare_workbooks(reference, path)
+    assert ('', 'sheet') in counts
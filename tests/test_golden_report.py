@@ -0,0 +1,24 @@
+"""
+The wide report of fixed synthetic inputs, compared cell by cell with the baseline report in
+tests/data. After an intended change to the report, write a new baseline with
+UPDATE_BASELINE=1 python -m pytest tests/test_golden_report.py
+and review it before committing it.
+"""
+import os
+import shutil
+
+import pytest
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'baseline_wide.xlsx')
+
+@pytest.mark.parametrize('aggregation_workers, sheet_workers', [(1, 1), (2, 2)])
+def test_wide_report_matches_the_baseline(app_module, downloads, tmp_path, monkeypatch, aggregation_workers, sheet_workers):
+    monkeypatch.setitem(app_module.app.config, 'AGGREGATION_WORKERS', aggregation_workers)
+    monkeypatch.setitem(app_module.app.config, 'SHEET_WORKERS', sheet_workers)
+    insurance_paths, vendor_paths, conversion_path = app_module.make_check_inputs(str(tmp_path), 120, 1)
+    output_file = app_module.process_files(insurance_paths, vendor_paths, conversion_path, "Baseline Pharmacy", "January 2024", {'layout': 'wide'}, use_cache=False)
+
+    if os.environ.get('UPDATE_BASELINE') and (aggregation_workers, sheet_workers) == (1, 1):
+        shutil.copyfile(output_file, BASELINE_PATH)
+    counts, differences = app_module.compare_workbooks(BASELINE_PATH, output_file, max_differences=10)
+    assert not counts, differences
@@ -0,0 +1,43 @@
+import pandas as pd
+import pytest
+
+@pytest.fixture
+def conversion_data():
+    return pd.DataFrame({
+        'DRUG NAME': ['AMOXICILLIN 500MG CAP', 'AMOXICILLIN 250MG CAP', 'AMOXICILLIN 500MG CAP', 'LISINOPRIL 10MG TAB', 'AMOXICILLIN 500MG CAP'],
+        'ITEM NO': ['IT1', 'IT2', 'IT3', 'IT4', None],
+        'NDC #': ['00093310901', '00093310801', '65862001701', '68180051401', '00093310905'],
+        'PKG SIZE': [100, 100, 500, 90, 100],
+        'PRICE': [10.0, 8.0, 40.0, 4.0, 10.0],
+    })
+
+def test_suggest_ranks_the_same_product_first(app_module, conversion_data):
+    index = app_module.MasterNameIndex(conversion_data)
+    suggestions = index.suggest('00093310910', 'Amoxicillin-500mg cap')
+    ranked = [index.item_numbers[row] for _, row in suggestions]
+    # Same name and product, same name from another labeler, similar name of the same labeler
+    assert ranked == ['IT1', 'IT3', 'IT2']
+    scores = [score for score, _ in suggestions]
+    assert scores == sorted(scores, reverse=True)
+    assert scores[0] == pytest.approx(1.0)
+
+def test_suggest_leaves_out_rows_without_an_item_number(app_module, conversion_data):
+    index = app_module.MasterNameIndex(conversion_data)
+    assert 'IT4' not in [index.item_numbers[row] for _, row in index.suggest('00093310905', 'AMOXICILLIN 500MG CAP', top_k=10)]
+    assert None not in index.item_numbers
+
+def test_suggest_finds_nothing_for_an_unrelated_item(app_module, conversion_data):
+    index = app_module.MasterNameIndex(conversion_data)
+    assert index.suggest('99999999999', 'ZZZZ') == []
+
+def test_master_suggestions_keep_one_row_per_item(app_module, conversion_data, monkeypatch):
+    missing_items = pd.DataFrame({'NDC #': ['00093310910', '99999999999'], 'Drug Name': ['AMOXICILLIN 500MG CAP', 'ZZZZ'], 'Store': ['Main', 'Main']}, index=[7, 3])
+    monkeypatch.setitem(app_module.app.config, 'MASTER_SUGGESTION_MIN_SCORE', 0.745)
+    suggestions = app_module.add_master_suggestions(missing_items, conversion_data)
+    assert list(suggestions.columns[:7]) == ['NDC #', 'Drug Name', 'Store', 'Suggestion 1 Item No', 'Suggestion 1 NDC #', 'Suggestion 1 Drug Name', 'Suggestion 1 Match %']
+    assert len(suggestions.columns) == 3 + 3 * 4
+    assert suggestions['NDC #'].tolist() == ['00093310910', '99999999999']
+    matched, unmatched = suggestions.iloc[0], suggestions.iloc[1]
+    assert [matched['Suggestion 1 Item No'], matched['Suggestion 2 Item No'], matched['Suggestion 3 Item No']] == ['IT1', 'IT3', '']
+    assert [matched['Suggestion 1 Match %'], matched['Suggestion 2 Match %']] == [100, 75]
+    assert (unmatched[3:] == '').all()
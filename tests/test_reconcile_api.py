@@ -0,0 +1,15 @@
+import pytest
+
+@pytest.mark.parametrize('form, error', [
+    ({'pharmacy_name': None}, "pharmacy_name and date_range are required"),
+    ({'report_layout': 'tall'}, "Unknown report layout 'tall'"),
+    ({'vendor_count': 'two'}, "vendor_count must be a number"),
+    ({'optional_insurance_count': '1'}, "Missing fields: optional_insurance_name1"),
+    ({}, "Kinray, conversion and at least one insurance file are required"),
+])
+def test_reconcile_checks_the_form_before_reading_files(client, form, error):
+    data = {'pharmacy_name': 'Test Pharmacy', 'date_range': 'January 2024', 'optional_insurance_count': '0', 'vendor_count': '0'}
+    data.update(form)
+    response = client.post('/api/reconcile', data={key: value for key, value in data.items() if value is not None})
+    assert response.status_code == 400
+    assert response.get_json()['error'] == error
@@ -0,0 +1,30 @@
+import pytest
+
+def test_memory_limit_counts_only_what_the_job_adds(app_module, monkeypatch):
+    monkeypatch.setitem(app_module.app.config, 'JOB_MEMORY_LIMIT_MB', 100)
+    rss = [3000.0]
+    monkeypatch.setattr(app_module, 'get_rss_mb', lambda: rss[0])
+    job = app_module.ReportJob()
+
+    # The process was already over the limit before the job started
+    rss[0] = 3090.0
+    job.checkpoint('reading the BestRx files')
+    assert job.stage == 'reading the BestRx files'
+
+    rss[0] = 3150.0
+    with pytest.raises(app_module.JobCancelled, match="it used 150 MB of memory, more than 100 MB"):
+        job.checkpoint('reconciling')
+    assert job.stage == 'reading the BestRx files'
+
+def test_memory_limit_is_skipped_when_memory_cannot_be_measured(app_module, monkeypatch):
+    monkeypatch.setitem(app_module.app.config, 'JOB_MEMORY_LIMIT_MB', 1)
+    monkeypatch.setattr(app_module, 'get_rss_mb', lambda: None)
+    job = app_module.ReportJob()
+    job.checkpoint('reconciling')
+    assert job.stage == 'reconciling'
+
+def test_cancelled_job_stops_at_the_next_checkpoint(app_module):
+    job = app_module.ReportJob()
+    job.cancel()
+    with pytest.raises(app_module.JobCancelled, match="it was cancelled"):
+        job.checkpoint('reconciling')
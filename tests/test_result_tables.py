@@ -0,0 +1,61 @@
+import pandas as pd
+import pytest
+
+@pytest.fixture
+def table():
+    return pd.DataFrame({
+        'NDC #': ['00000000001', '00000000002', '00000000003', '00000000004', '00000000005'],
+        'Drug Name': ['ASPIRIN 81MG', 'IBUPROFEN 200MG', 'ASPIRIN 81MG', 'NAPROXEN 220MG', 'ACETAMINOPHEN 500MG'],
+        'CVS_D': [-2.0, 0.0, -0.5, 3.0, -1.0],
+    })
+
+def test_apply_filters_compares_numbers_and_text(app_module, table):
+    filtered = app_module.apply_filters(table, ['CVS_D<0', 'Drug Name==ASPIRIN 81MG'])
+    assert filtered['NDC #'].tolist() == ['00000000001', '00000000003']
+    assert app_module.apply_filters(table, ['CVS_D>=0'])['NDC #'].tolist() == ['00000000002', '00000000004']
+    assert app_module.apply_filters(table, [])['NDC #'].tolist() == table['NDC #'].tolist()
+
+@pytest.mark.parametrize('expression', ['CVS_D', 'Unknown<0', 'CVS_D<abc'])
+def test_apply_filters_rejects_bad_filters(app_module, table, expression):
+    with pytest.raises(ValueError):
+        app_module.apply_filters(table, [expression])
+
+def test_paginate_table_walks_every_row_once(app_module, table):
+    rows = []
+    cursor = None
+    for _ in range(len(table)):
+        page = app_module.paginate_table(table, cursor, 2, ['NDC #'])
+        assert page['total_rows'] == len(table)
+        assert page['columns'] == ['NDC #']
+        rows += [row['NDC #'] for row in page['rows']]
+        cursor = page['next_cursor']
+        if cursor is None:
+            break
+    assert rows == table['NDC #'].tolist()
+
+@pytest.mark.parametrize('cursor, limit', [('abc', 2), ('-1', 2), (None, 0)])
+def test_paginate_table_rejects_bad_cursors_and_limits(app_module, table, cursor, limit):
+    with pytest.raises(ValueError):
+        app_module.paginate_table(table, cursor, limit)
+
+def test_result_table_api_pages_with_a_cursor(client, stored_result):
+    first = client.get(f'/api/results/{stored_result}/rows?limit=2').get_json()
+    assert len(first['rows']) == 2
+    assert first['total_rows'] == 3
+    second = client.get(f'/api/results/{stored_result}/rows?limit=2&cursor={first["next_cursor"]}').get_json()
+    assert len(second['rows']) == 1
+    assert second['next_cursor'] is None
+
+def test_result_table_api_filters(client, stored_result):
+    page = client.get(f'/api/results/{stored_result}/rows', query_string={'filter': 'CVS_D<0', 'columns': 'NDC #,CVS_D'}).get_json()
+    assert page['rows'] and all(row['CVS_D'] < 0 for row in page['rows'])
+
+@pytest.mark.parametrize('query', ['cursor=abc', 'cursor=-1', 'filter=Unknown<0', 'filter=CVS_D<abc'])
+def test_result_table_api_rejects_bad_queries(client, stored_result, query):
+    response = client.get(f'/api/results/{stored_result}/rows?{query}')
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+def test_result_table_api_unknown_result_and_table(client, stored_result):
+    assert client.get('/api/results/unknown/rows').status_code == 404
+    assert client.get(f'/api/results/{stored_result}/unknown').status_code == 404
@@ -0,0 +1,25 @@
+import plistlib
+
+import pytest
+
+@pytest.mark.parametrize('body, error', [
+    (b'not json', "A JSON object is required"),
+    (b'[1, 2]', "A JSON object is required"),
+    (b'{"vendor_paths": []}', "Missing fields: insurance_paths, vendor_paths, pharmacy_name, date_range"),
+    (b'{"insurance_paths": ["a.xlsx"], "vendor_paths": ["b.xlsx"], "pharmacy_name": "P", "date_range": "J"}', "insurance_paths must map insurance names to file paths"),
+    (b'{"insurance_paths": {"CVS": "a.xlsx"}, "vendor_paths": ["b.xlsx"], "pharmacy_name": "P", "date_range": "J", "conversion_path": "c.xlsx"}', "Files not found: a.xlsx, b.xlsx, c.xlsx"),
+])
+def test_service_process_rejects_bad_jobs(client, body, error):
+    response = client.post('/service/process', data=body, content_type='application/json')
+    assert response.status_code == 400
+    assert response.get_json()['error'] == error
+
+def test_autostart_launch_agent_is_a_valid_plist(app_module, monkeypatch, tmp_path):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    monkeypatch.setattr(app_module.sys, 'platform', 'darwin')
+    entry_path = app_module.install_autostart(str(tmp_path / 'R&D <master>.xlsx'))
+    with open(entry_path, 'rb') as f:
+        launch_agent = plistlib.load(f)
+    assert launch_agent['Label'] == 'com.pharmacydata.service'
+    assert launch_agent['ProgramArguments'][-2:] == ['--master', str(tmp_path / 'R&D <master>.xlsx')]
+    assert launch_agent['RunAtLoad'] is True
@@ -0,0 +1,44 @@
+from io import BytesIO
+
+import pandas as pd
+import pytest
+
+def excel_file(data):
+    # An upload as the file object Flask gives the app
+    file = BytesIO()
+    data.to_excel(file, index=False)
+    file.seek(0)
+    return file
+
+@pytest.fixture
+def bestrx_data():
+    return pd.DataFrame({'Drug Name': ['ASPIRIN 81MG'], 'NDC #': ['00000-0000-01'], 'Total Rxs': [1], 'Quantity': [30], 'Total': [5.0]})
+
+def test_validate_upload_accepts_each_slot(app_module, bestrx_data):
+    assert app_module.validate_upload(excel_file(bestrx_data), 'bestrx') == []
+    assert app_module.validate_upload(excel_file(pd.DataFrame({'NDC #': ['00000000001'], 'Shipped': [2]})), 'vendor') == []
+    conversion_data = pd.DataFrame({'DRUG NAME': ['ASPIRIN 81MG'], 'ITEM NO': ['IT1'], 'NDC #': ['00000000001'], 'PKG SIZE': [100], 'PRICE': [3.0]})
+    assert app_module.validate_upload(excel_file(conversion_data), 'conversion') == []
+
+def test_validate_upload_names_the_slot_a_file_belongs_in(app_module, bestrx_data):
+    errors = app_module.validate_upload(excel_file(bestrx_data), 'conversion')
+    assert len(errors) == 1
+    assert "missing the column(s) DRUG NAME, ITEM NO, PKG SIZE, PRICE" in errors[0]
+    assert "BestRx insurance file" in errors[0]
+
+def test_validate_upload_checks_the_sample_ndcs(app_module, bestrx_data):
+    bestrx_data['NDC #'] = ['NOT AN NDC']
+    assert app_module.validate_upload(excel_file(bestrx_data), 'bestrx') == ["has values in 'NDC #' that are not NDCs, for example 'NOT AN NDC'"]
+
+def test_validate_upload_rejects_files_that_are_not_workbooks(app_module):
+    errors = app_module.validate_upload(BytesIO(b'not a workbook'), 'bestrx')
+    assert errors[0].startswith("could not be opened as an Excel (.xlsx) workbook")
+
+def test_validate_upload_rejects_empty_sheets(app_module, bestrx_data):
+    assert app_module.validate_upload(excel_file(bestrx_data.iloc[:0]), 'bestrx') == ["has no data rows"]
+
+def test_validate_inputs_leaves_uploads_at_the_start(app_module, bestrx_data):
+    file = excel_file(bestrx_data)
+    errors = app_module.validate_inputs({'CVS': file}, [('Kinray', excel_file(bestrx_data))], None)
+    assert list(errors) == ['Kinray vendor file']
+    assert file.tell() == 0
@@ -0,0 +1,50 @@
+from io import BytesIO
+
+import pytest
+
+def test_read_vendor_csv_finds_the_columns_by_alias(app_module):
+    content = b'\xef\xbb\xbfItem NDC;Description;Qty Shipped\n00093-3109-01;AMOXICILLIN;"1,200"\n;NO NDC;3\n 68180051401 ;LISINOPRIL;2\n'
+    vendor_data = app_module.read_vendor_csv(BytesIO(content))
+    assert list(vendor_data.columns) == ['NDC #', 'Shipped']
+    assert vendor_data['NDC #'].tolist() == ['00093-3109-01', '68180051401']
+    assert vendor_data['Shipped'].tolist() == [1200.0, 2.0]
+
+def test_read_vendor_csv_requires_the_columns(app_module):
+    with pytest.raises(ValueError, match="no column for Shipped in the header"):
+        app_module.read_vendor_csv(BytesIO(b'NDC,Description\n00093310901,AMOXICILLIN\n'))
+
+def edi_interchange(*segments):
+    # An interchange with "*" between elements and "~" after each segment, the ISA segment is fixed width
+    isa = 'ISA*00*          *00*          *ZZ*SENDER         *ZZ*RECEIVER       *240101*1200*U*00401*000000001*0*P*>'
+    assert len(isa) == 105
+    return ('~'.join((isa,) + segments) + '~').encode('latin-1')
+
+def test_read_vendor_edi_reads_810_invoice_lines(app_module):
+    content = edi_interchange('ST*810*0001', 'IT1*1*12*EA*4.50**N4*00093310901', 'IT1*2*3*EA*1.00**VN*12345*N4*68180051401', 'IT1*3*5*EA*1.00**VN*999', 'SE*5*0001')
+    vendor_data = app_module.read_vendor_edi(BytesIO(content))
+    assert vendor_data.values.tolist() == [['00093310901', 12.0], ['68180051401', 3.0]]
+
+def test_read_vendor_edi_reads_856_ship_notices(app_module):
+    content = edi_interchange('ST*856*0001', 'HL*1**S', 'HL*2*1*I', 'LIN**N4*00093310901', 'SN1**6*EA', 'HL*3*1*I', 'SN1**4*EA', 'HL*4*1*I', 'LIN**ND*68180051401', 'SN1**2*EA')
+    vendor_data = app_module.read_vendor_edi(BytesIO(content))
+    assert vendor_data.values.tolist() == [['00093310901', 6.0], ['68180051401', 2.0]]
+
+def test_read_vendor_edi_requires_an_interchange_header(app_module):
+    with pytest.raises(ValueError, match="no ISA interchange header"):
+        app_module.read_vendor_edi(BytesIO(b'ST*810*0001~'))
+
+@pytest.mark.parametrize('segments, error', [
+    (('ST*810*0001', 'IT1*1*12 EA*EA*4.50**N4*00093310901'), "invoice.810, segment 3 (IT1): quantity '12 EA' is not a number"),
+    (('ST*856*0001', 'HL*1**S', 'LIN**N4*00093310901', 'SN1**six*EA'), "invoice.810, segment 5 (SN1): quantity 'six' is not a number"),
+])
+def test_read_vendor_edi_names_a_bad_quantity(app_module, tmp_path, segments, error):
+    path = tmp_path / 'invoice.810'
+    path.write_bytes(edi_interchange(*segments))
+    with pytest.raises(ValueError) as e:
+        app_module.read_vendor_edi(str(path))
+    assert str(e.value) == error
+
+def test_bad_edi_quantity_fails_the_validation(app_module, tmp_path):
+    path = tmp_path / 'kinray.edi'
+    path.write_bytes(edi_interchange('ST*810*0001', 'IT1*1*1O*EA*4.50**N4*00093310901'))
+    assert app_module.validate_upload(str(path), 'vendor') == ["could not be read as a EDI vendor feed: kinray.edi, segment 3 (IT1): quantity '1O' is not a number"]
@@ -0,0 +1,74 @@
+import datetime
+import sqlite3
+
+import pytest
+
+@pytest.fixture
+def warehouse(app_module, monkeypatch, tmp_path):
+    path = str(tmp_path / 'warehouse.db')
+    monkeypatch.setitem(app_module.app.config, 'WAREHOUSE_PATH', path)
+    return path
+
+@pytest.fixture
+def final_data(app_module, store_inputs):
+    bestrx_data, vendor_data, vendor_names, conversion_data, insurance_names = store_inputs
+    return app_module.reconcile_data(bestrx_data, vendor_data, vendor_names, conversion_data, insurance_names)[0]
+
+@pytest.mark.parametrize('date_range, period_end', [
+    ("01/01/2024 - 01/31/2024", '2024-01-31'),
+    ("2024-01-01 to 2024-02-15", '2024-02-15'),
+    ("Jan 2024", '2024-01-31'),
+    ("January-March 2024", '2024-03-31'),
+    ("2/2024-4/2024", '2024-04-30'),
+    ("Feb 2023", '2023-02-28'),
+    ("last month", None),
+])
+def test_get_period_end(app_module, date_range, period_end):
+    assert app_module.get_period_end(date_range) == period_end
+
+def test_rerun_replaces_the_earlier_run(app_module, warehouse, final_data):
+    first_run = app_module.store_run_results(final_data, ['ALL_PBM', 'CVS'], "Test Pharmacy", "Jan 2024")
+    app_module.store_run_results(final_data, ['ALL_PBM', 'CVS'], "Other Pharmacy", "Jan 2024")
+    second_run = app_module.store_run_results(final_data, ['ALL_PBM', 'CVS'], "Test Pharmacy", "Jan 2024")
+    assert first_run != second_run
+
+    conn = sqlite3.connect(warehouse)
+    try:
+        runs = conn.execute("SELECT run_id, pharmacy_name, period_end FROM runs ORDER BY pharmacy_name").fetchall()
+        rows = dict(conn.execute("SELECT run_id, COUNT(*) FROM reconciliation GROUP BY run_id").fetchall())
+    finally:
+        conn.close()
+    assert [(pharmacy_name, period_end) for _, pharmacy_name, period_end in runs] == [("Other Pharmacy", '2024-01-31'), ("Test Pharmacy", '2024-01-31')]
+    assert runs[1][0] == second_run
+    assert first_run not in rows
+    assert rows[second_run] == 2 * len(final_data)
+
+def test_shortfall_history_goes_by_the_data_period(app_module, warehouse, final_data):
+    today = datetime.date.today()
+    recent = today.strftime('%b %Y')
+    app_module.store_run_results(final_data, ['ALL_PBM', 'CVS'], "Test Pharmacy", recent)
+    app_module.store_run_results(final_data, ['ALL_PBM', 'CVS'], "Test Pharmacy", f'Jan {today.year - 3}')
+
+    history = app_module.query_ndc_shortfall('00378-0234-10', months=12, insurance='CVS')
+    assert [row['date_range'] for row in history] == [recent]
+    assert history[0]['shortfall'] == pytest.approx(0.06)
+    assert len(app_module.query_ndc_shortfall('00378023410', months=48, insurance='CVS')) == 2
+
+def test_an_older_warehouse_is_migrated_once(app_module, warehouse, monkeypatch):
+    conn = sqlite3.connect(warehouse)
+    conn.execute("CREATE TABLE runs (run_id TEXT PRIMARY KEY, pharmacy_name TEXT NOT NULL, date_range TEXT NOT NULL, created_at TEXT NOT NULL, output_file TEXT)")
+    conn.execute("INSERT INTO runs VALUES ('run1', 'Test Pharmacy', 'Jan 2024', '2024-02-01T00:00:00', NULL)")
+    conn.commit()
+    conn.close()
+
+    conn = app_module.get_warehouse_connection()
+    try:
+        assert conn.execute("SELECT period_end FROM runs WHERE run_id = 'run1'").fetchone() == ('2024-01-31',)
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == app_module.WAREHOUSE_SCHEMA_VERSION
+    finally:
+        conn.close()
+
+    def init_warehouse(conn):
+        raise AssertionError("the warehouse was initialised again")
+    monkeypatch.setattr(app_module, 'init_warehouse', init_warehouse)
+    app_module.get_warehouse_connection().close()
@@ -0,0 +1,65 @@
+import shutil
+
+import pytest
+
+class StopWatching(Exception):
+    pass
+
+@pytest.fixture
+def watch_folder(app_module, tmp_path, monkeypatch):
+    # <folder>/<pharmacy name>/<period> with the BestRx and Kinray exports of the check inputs, without the conversion file
+    inputs_folder = tmp_path / 'inputs'
+    inputs_folder.mkdir()
+    insurance_paths, vendor_paths, conversion_path = app_module.make_check_inputs(str(inputs_folder), 20, 1)
+    period_folder = tmp_path / 'watch' / 'Main St' / 'January 2024'
+    period_folder.mkdir(parents=True)
+    for path in list(insurance_paths.values()) + vendor_paths[:1]:
+        shutil.copy(path, period_folder)
+    monkeypatch.setitem(app_module.app.config, 'WATCH_DEBOUNCE', 0)
+    monkeypatch.setitem(app_module.app.config, 'MASTER_PATH', None)
+    monkeypatch.setitem(app_module.app.config, 'WATCH_STATE_PATH', str(tmp_path / 'watch_state.json'))
+    return tmp_path / 'watch', conversion_path
+
+def watch_pass(app_module, folder, state):
+    return [app_module.process_watch_set(*watch_set, state) for watch_set in app_module.get_watch_sets(str(folder))]
+
+def test_incomplete_folder_is_processed_once_the_master_is_preloaded(app_module, downloads, watch_folder, monkeypatch):
+    folder, conversion_path = watch_folder
+    state = {}
+    assert watch_pass(app_module, folder, state) == [None]
+    (entry,) = state.values()
+    assert entry['status'] == 'incomplete'
+    assert 'content_hash' not in entry
+
+    # The files did not change, only the master became available
+    monkeypatch.setitem(app_module.app.config, 'MASTER_PATH', conversion_path)
+    (output_file,) = watch_pass(app_module, folder, state)
+    assert output_file == str(downloads / "Main St (January 2024).xlsx")
+    assert state[str(folder / 'Main St' / 'January 2024')]['status'] == 'processed'
+    assert watch_pass(app_module, folder, state) == [None]
+
+def test_watched_reports_do_not_hold_the_service_lock(app_module, watch_folder, monkeypatch):
+    folder, conversion_path = watch_folder
+    monkeypatch.setitem(app_module.app.config, 'MASTER_PATH', conversion_path)
+    lock_held = []
+    monkeypatch.setattr(app_module, 'process_files', lambda *args, **kwargs: lock_held.append(app_module.service_job_lock.locked()) or 'report.xlsx')
+    assert watch_pass(app_module, folder, {}) == ['report.xlsx']
+    assert lock_held == [False]
+
+def test_state_is_written_only_when_it_changes(app_module, watch_folder, monkeypatch):
+    folder, conversion_path = watch_folder
+    monkeypatch.setitem(app_module.app.config, 'MASTER_PATH', conversion_path)
+    monkeypatch.setattr(app_module, 'process_files', lambda *args, **kwargs: 'report.xlsx')
+    saved_states = []
+    monkeypatch.setattr(app_module, 'save_watch_state', lambda state: saved_states.append(dict(state)))
+    passes = iter(range(3))
+
+    def sleep(seconds):
+        if next(passes) == 2:
+            raise StopWatching()
+
+    monkeypatch.setattr(app_module.time, 'sleep', sleep)
+    with pytest.raises(StopWatching):
+        app_module.watch_folders([str(folder)])
+    assert len(saved_states) == 1
+    assert [entry['status'] for entry in saved_states[0].values()] == ['processed']
@@ -0,0 +1,34 @@
+import pytest
+
+@pytest.fixture
+def result(app_module, store_inputs):
+    # A stored result with its parsed inputs, as a report run keeps it
+    bestrx_data, vendor_data, vendor_names, conversion_data, insurance_names = store_inputs
+    inputs = app_module.get_session_inputs(bestrx_data, vendor_data, vendor_names, conversion_data, insurance_names)
+    final_data, missing_items = app_module.reconcile_data(bestrx_data.copy(), vendor_data.copy(), vendor_names, conversion_data, insurance_names)
+    result_id = app_module.store_result(final_data, missing_items, insurance_names, vendor_names, "Test Pharmacy", "January 2024", inputs=inputs)
+    return app_module.get_result(result_id)
+
+def test_rerun_writes_the_what_if_report(app_module, downloads, result):
+    result_id, output_file = app_module.rerun_result(result, {'master': [{'NDC #': '00378023410', 'ITEM NO': 'IT3'}]})
+    assert output_file == str(downloads / "Test Pharmacy (January 2024) what-if.xlsx")
+    assert app_module.get_result(result_id)['missing_items'].empty
+    assert [path.name for path in downloads.iterdir()] == ["Test Pharmacy (January 2024) what-if.xlsx"]
+    assert not app_module.report_jobs
+
+def test_stopped_rerun_keeps_the_earlier_report(app_module, downloads, result, monkeypatch):
+    earlier_report = downloads / "Test Pharmacy (January 2024) what-if.xlsx"
+    earlier_report.write_bytes(b'earlier report')
+    checkpoint = app_module.ReportJob.checkpoint
+
+    def cancel_while_saving(job, stage):
+        if stage == 'saving the report':
+            job.cancel()
+        checkpoint(job, stage)
+
+    monkeypatch.setattr(app_module.ReportJob, 'checkpoint', cancel_while_saving)
+    with pytest.raises(app_module.JobCancelled):
+        app_module.rerun_result(result, {}, job_id='whatif-job')
+    assert earlier_report.read_bytes() == b'earlier report'
+    assert [path.name for path in downloads.iterdir()] == [earlier_report.name]
+    assert not app_module.report_jobs